@@ -0,0 +1,269 @@
+"""
+In-process stand-ins for kachery_p2p and hither2 so that labbox can be benchmarked without a daemon
+
+The fake kachery storage lives in a temporary directory (shared with worker
+processes through the FAKE_KACHERY_STORAGE_DIR environment variable), so that
+content stored or appended in one process is visible in the others. Set
+FAKE_KACHERY_LATENCY_MSEC to simulate the round trip to the daemon.
+
+Call install_fakes() before importing labbox.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+def install_fakes(*, latency_msec: float=0):
+    if 'FAKE_KACHERY_STORAGE_DIR' not in os.environ:
+        os.environ['FAKE_KACHERY_STORAGE_DIR'] = tempfile.mkdtemp(prefix='fake_kachery_')
+    os.environ['FAKE_KACHERY_LATENCY_MSEC'] = str(latency_msec)
+    # calling this again only changes the latency, so that registered hither functions are kept
+    if getattr(sys.modules.get('hither2', None), '_is_fake', False):
+        return
+    sys.modules['kachery_p2p'] = _create_fake_kachery_p2p()
+    sys.modules['hither2'] = _create_fake_hither2()
+
+########################################################################
+# kachery_p2p
+
+def _storage_dir():
+    return os.environ['FAKE_KACHERY_STORAGE_DIR']
+
+def _simulate_latency():
+    latency_msec = float(os.environ.get('FAKE_KACHERY_LATENCY_MSEC', '0'))
+    if latency_msec > 0:
+        time.sleep(latency_msec / 1000)
+
+def _sha1_of_string(txt: str) -> str:
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+def _subfeed_hash_from_name(subfeed_name):
+    if isinstance(subfeed_name, str):
+        if subfeed_name.startswith('~'):
+            return subfeed_name[1:]
+        return _sha1_of_string(subfeed_name)
+    else:
+        return _sha1_of_string(json.dumps(subfeed_name, sort_keys=True, separators=(',', ':')))
+
+def _sha1_path(sha1: str):
+    return os.path.join(_storage_dir(), 'sha1', sha1)
+
+def _store_bytes(b: bytes, basename: str) -> str:
+    sha1 = hashlib.sha1(b).hexdigest()
+    path = _sha1_path(sha1)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(b)
+        os.rename(tmp_path, path)
+    return f'sha1://{sha1}/{basename}'
+
+def _sha1_from_uri(uri: str):
+    return uri.split('/')[2].split('.')[0]
+
+def _subfeed_path(feed_id: str, subfeed_hash: str):
+    return os.path.join(_storage_dir(), 'feeds', feed_id, subfeed_hash + '.jsonl')
+
+def _read_subfeed_messages(feed_id: str, subfeed_hash: str, position: int):
+    path = _subfeed_path(feed_id, subfeed_hash)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    return [json.loads(line) for line in lines[position:]]
+
+def _num_subfeed_messages(feed_id: str, subfeed_hash: str):
+    path = _subfeed_path(feed_id, subfeed_hash)
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        return f.read().count(b'\n')
+
+class _FakeSubfeed:
+    def __init__(self, feed_id: str, subfeed_name):
+        self._feed_id = feed_id
+        self._subfeed_hash = _subfeed_hash_from_name(subfeed_name)
+        self._position = 0
+    def set_position(self, position: int):
+        self._position = position
+    def get_position(self):
+        return self._position
+    def get_next_messages(self, wait_msec=0):
+        _simulate_latency()
+        timer = time.time()
+        while True:
+            messages = _read_subfeed_messages(self._feed_id, self._subfeed_hash, self._position)
+            if len(messages) > 0 or (time.time() - timer) * 1000 >= wait_msec:
+                break
+            time.sleep(0.002)
+        self._position += len(messages)
+        return messages
+    def append_messages(self, messages: list):
+        _simulate_latency()
+        path = _subfeed_path(self._feed_id, self._subfeed_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(''.join([json.dumps(m) + '\n' for m in messages]))
+
+class _FakeFeed:
+    def __init__(self, feed_id: str):
+        self._feed_id = feed_id
+    def get_uri(self):
+        return f'feed://{self._feed_id}'
+    def get_feed_id(self):
+        return self._feed_id
+    def get_subfeed(self, subfeed_name):
+        return _FakeSubfeed(self._feed_id, subfeed_name)
+
+def _create_fake_kachery_p2p():
+    kp = types.ModuleType('kachery_p2p')
+    def get_node_id():
+        _simulate_latency()
+        return 'fake-node-id'
+    def get_feed_id(feed_name: str, create: bool=False):
+        _simulate_latency()
+        return _sha1_of_string('feed-name:' + feed_name)
+    def load_feed(feed_name_or_uri: str, create: bool=False):
+        _simulate_latency()
+        if feed_name_or_uri.startswith('feed://'):
+            return _FakeFeed(feed_name_or_uri.split('/')[2])
+        return _FakeFeed(get_feed_id(feed_name_or_uri, create=create))
+    def store_text(txt: str, basename: str='file.txt'):
+        _simulate_latency()
+        return _store_bytes(txt.encode('utf-8'), basename)
+    def store_json(x, basename: str='file.json'):
+        _simulate_latency()
+        return _store_bytes(json.dumps(x).encode('utf-8'), basename)
+    def store_file(path: str, basename: str=None):
+        _simulate_latency()
+        with open(path, 'rb') as f:
+            return _store_bytes(f.read(), basename or os.path.basename(path))
+    def load_file(uri: str, p2p: bool=True):
+        _simulate_latency()
+        path = _sha1_path(_sha1_from_uri(uri))
+        return path if os.path.exists(path) else None
+    def load_bytes(uri: str, start: int=None, end: int=None, p2p: bool=True):
+        path = load_file(uri)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            b = f.read()
+        return b[start:end]
+    def load_text(uri: str, p2p: bool=True):
+        b = load_bytes(uri)
+        return b.decode('utf-8') if b is not None else None
+    def load_json(uri: str, p2p: bool=True):
+        txt = load_text(uri)
+        return json.loads(txt) if txt is not None else None
+    def watch_for_new_messages(subfeed_watches: dict, wait_msec: float):
+        _simulate_latency()
+        timer = time.time()
+        while True:
+            ret = {}
+            for watch_name, w in subfeed_watches.items():
+                if _num_subfeed_messages(w['feedId'], w['subfeedHash']) > w['position']:
+                    ret[watch_name] = _read_subfeed_messages(w['feedId'], w['subfeedHash'], w['position'])
+            if len(ret) > 0 or (time.time() - timer) * 1000 >= wait_msec:
+                return ret
+            time.sleep(0.002)
+    for f in [get_node_id, get_feed_id, load_feed, store_text, store_json, store_file, load_file, load_bytes, load_text, load_json, watch_for_new_messages]:
+        setattr(kp, f.__name__, f)
+    return kp
+
+########################################################################
+# hither2
+
+class _FakeJobResult:
+    def __init__(self, return_value=None, error=None):
+        self.return_value = return_value
+        self.error = error
+
+class _FakeJobHandler:
+    is_remote = False
+
+class _FakeParallelJobHandler(_FakeJobHandler):
+    def __init__(self, num_workers: int):
+        self._num_workers = num_workers
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+_job_index = [0]
+
+class _FakeJob:
+    def __init__(self, *, function, function_name: str, function_version: str, kwargs: dict, job_handler):
+        _job_index[0] += 1
+        self.job_id = f'fake-job-{os.getpid()}-{_job_index[0]}'
+        self.function_name = function_name
+        self.function_version = function_version
+        self.status = 'queued'
+        self.result = None
+        self._function = function
+        self._kwargs = kwargs
+        if job_handler is not None:
+            job_handler._executor.submit(self._run)
+        else:
+            self._run()
+    def _run(self):
+        if self.status == 'error':
+            return
+        self.status = 'running'
+        try:
+            return_value = self._function(**self._kwargs)
+        except Exception as err:
+            self.result = _FakeJobResult(error=err)
+            self.status = 'error'
+            return
+        self.result = _FakeJobResult(return_value=return_value)
+        self.status = 'finished'
+    def cancel(self):
+        if self.status in ['queued', 'running']:
+            self.result = _FakeJobResult(error=Exception('Job cancelled'))
+            self.status = 'error'
+
+def _create_fake_hither2():
+    hi2 = types.ModuleType('hither2')
+    hi2._is_fake = True
+    registered_functions = {}
+    config_stack = [{'job_handler': None}]
+    class Config:
+        def __init__(self, **kwargs):
+            self._kwargs = kwargs
+        def __enter__(self):
+            config_stack.append({**config_stack[-1], **self._kwargs})
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            config_stack.pop()
+    def function(name: str, version: str):
+        def wrap(f):
+            def run(**kwargs):
+                return _FakeJob(function=f, function_name=name, function_version=version, kwargs=kwargs, job_handler=config_stack[-1].get('job_handler'))
+            setattr(f, 'run', run)
+            setattr(f, '_hither_function_name', name)
+            setattr(f, '_hither_function_version', version)
+            registered_functions[name] = f
+            return f
+        return wrap
+    def get_function(name: str):
+        return registered_functions.get(name, None)
+    def wait(timeout=None):
+        pass
+    class Log:
+        pass
+    class JobCache:
+        def __init__(self, feed_uri: str=None):
+            self._feed_uri = feed_uri
+    hi2.Config = Config
+    hi2.function = function
+    hi2.get_function = get_function
+    hi2.wait = wait
+    hi2.Log = Log
+    hi2.JobCache = JobCache
+    hi2.Job = _FakeJob
+    hi2.JobHandler = _FakeJobHandler
+    hi2.ParallelJobHandler = _FakeParallelJobHandler
+    return hi2
@@ -0,0 +1,65 @@
+"""
+Hither functions used by the benchmark suite
+
+Import this module after install_fakes(), so that the functions are registered
+with the fake hither2. The benchmark_createjob_* functions are the ones that
+clients call by name with hitherCreateJob.
+"""
+
+import time
+import numpy as np
+import hither2 as hi2
+from labbox import JobProgress
+from labbox.serialize import serialize
+
+@hi2.function('benchmark_noop', '0.1.0')
+def benchmark_noop(x: int):
+    return x
+
+@hi2.function('benchmark_large_array', '0.1.0')
+@serialize(encoding='binary')
+def benchmark_large_array(num_values: int, seed: int):
+    return {'values': np.random.RandomState(seed).randn(num_values).astype(np.float32)}
+
+@hi2.function('benchmark_sleep', '0.1.0')
+def benchmark_sleep(sec: float, x: int):
+    time.sleep(sec)
+    return x
+
+@hi2.function('benchmark_progressive', '0.1.0')
+def benchmark_progressive(num_chunks: int, chunk_sec: float, chunk_size: int, progress):
+    # a computation whose result is the concatenation of chunks, reported as they are done
+    p = JobProgress(progress)
+    chunks = []
+    for i in range(num_chunks):
+        time.sleep(chunk_sec)
+        chunk = np.random.RandomState(i).randn(chunk_size).astype(np.float32)
+        chunks.append(chunk)
+        p.report((i + 1) / num_chunks, partial={'chunk_index': i, 'values': chunk.tolist()})
+    return {'values': np.concatenate(chunks).tolist()}
+
+_job_handler = []
+def _get_job_handler():
+    if len(_job_handler) == 0:
+        _job_handler.append(hi2.ParallelJobHandler(4))
+    return _job_handler[0]
+
+@hi2.function('benchmark_createjob_noop', '0.1.0')
+def benchmark_createjob_noop(labbox, x: int):
+    with hi2.Config(job_handler=_get_job_handler()):
+        return benchmark_noop.run(x=x)
+
+@hi2.function('benchmark_createjob_large_array', '0.1.0')
+def benchmark_createjob_large_array(labbox, num_values: int, seed: int):
+    with hi2.Config(job_handler=_get_job_handler()):
+        return benchmark_large_array.run(num_values=num_values, seed=seed)
+
+@hi2.function('benchmark_createjob_sleep', '0.1.0')
+def benchmark_createjob_sleep(labbox, sec: float, x: int):
+    with hi2.Config(job_handler=_get_job_handler()):
+        return benchmark_sleep.run(sec=sec, x=x)
+
+@hi2.function('benchmark_createjob_progressive', '0.1.0')
+def benchmark_createjob_progressive(labbox, num_chunks: int, chunk_sec: float, chunk_size: int, x: int):
+    with hi2.Config(job_handler=_get_job_handler()):
+        return benchmark_progressive.run(num_chunks=num_chunks, chunk_sec=chunk_sec, chunk_size=chunk_size, progress=labbox.job_progress_channel())
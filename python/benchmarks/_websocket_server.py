@@ -0,0 +1,42 @@
+"""
+Runs bin/labbox_start_api_websocket against the fake kachery/hither stand-ins
+
+The server imports its hither functions from $LABBOX_EXTENSIONS_DIR/../extensions,
+so this writes an extensions package that imports the benchmark functions. The
+fake kachery storage is shared with the process that started this one through
+FAKE_KACHERY_STORAGE_DIR.
+
+Usage: python benchmarks/_websocket_server.py <port>
+"""
+
+import os
+import sys
+import tempfile
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+sys.path.insert(0, thisdir)
+
+from _fakes import install_fakes
+
+def main():
+    port = int(sys.argv[1])
+    install_fakes(latency_msec=float(os.environ.get('FAKE_KACHERY_LATENCY_MSEC', '0')))
+    tmpdir = tempfile.mkdtemp(prefix='labbox_benchmark_extensions_')
+    os.makedirs(f'{tmpdir}/extensions')
+    with open(f'{tmpdir}/extensions/__init__.py', 'w') as f:
+        f.write('import _functions\n')
+    os.environ['LABBOX_EXTENSIONS_DIR'] = f'{tmpdir}/extensions'
+    os.environ['LABBOX_WEBSOCKET_PORT'] = str(port)
+    os.environ.setdefault('LABBOX_DEFAULT_FEED_NAME', 'benchmark')
+    path = f'{thisdir}/../bin/labbox_start_api_websocket'
+    loader = SourceFileLoader('labbox_start_api_websocket', path)
+    spec = importlib.util.spec_from_loader('labbox_start_api_websocket', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    module.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+Fetching a window of a large array result: whole binary result vs chunked result with /array slices
+
+A (num_timepoints x num_channels) float32 timeseries is stored
+* binary: @serialize(encoding='binary'), one blob (write_binary + kp.store_file),
+  which the client downloads in full (/sha1) before it can show any window
+* chunked: @serialize(encoding='chunked'), a chunk grid plus manifest, of which
+  the client downloads only the windows it shows (/array?slice=...)
+
+Reported: time to store, and time and bytes to get the first window and then
+further windows at random offsets (the server side of the request plus decoding,
+without the network). Each window is checked against slicing the original array.
+
+Usage: python benchmarks/bench_array_slices.py [--num-timepoints 4000000] [--num-channels 16] [--window 20000]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import numpy as np
+import kachery_p2p as kp
+from labbox.serialize import write_binary, decode_binary, store_chunked_ndarray
+from labbox.api import Sha1ContentCache, Sha1File, ArraySliceReader
+
+def store_binary(x) -> str:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = f'{tmpdir}/result.lbxb'
+        with open(path, 'wb') as f:
+            write_binary(x, f)
+        return kp.store_file(path).split('/')[2]
+
+def main():
+    parser = argparse.ArgumentParser(description='Whole binary result vs chunked result with slices')
+    parser.add_argument('--num-timepoints', type=int, default=4000000)
+    parser.add_argument('--num-channels', type=int, default=16)
+    parser.add_argument('--window', type=int, default=20000, help='Number of timepoints per window')
+    parser.add_argument('--num-windows', type=int, default=20)
+    args = parser.parse_args()
+
+    x = np.random.RandomState(0).randn(args.num_timepoints, args.num_channels).astype(np.float32)
+    offsets = np.random.RandomState(1).randint(0, args.num_timepoints - args.window, size=args.num_windows)
+    print(f'array {x.shape} {x.dtype}, {x.nbytes / 1e6:.1f} MB, windows of {args.window} timepoints')
+
+    timer = time.time()
+    binary_sha1 = store_binary(x)
+    print(f'{"store binary":28s} {(time.time() - timer) * 1000:9.1f} ms')
+    timer = time.time()
+    ref = store_chunked_ndarray(x)
+    print(f'{"store chunked":28s} {(time.time() - timer) * 1000:9.1f} ms   chunks {ref["chunks"]}')
+
+    # binary: the whole result has to be downloaded and decoded before the first window is available
+    sha1_cache = Sha1ContentCache(max_bytes=0, compress_min_bytes=1)
+    timer = time.time()
+    _, _, body = sha1_cache.create_response(binary_sha1, accept_encoding=None, if_none_match=None)
+    if isinstance(body, Sha1File):
+        # streamed by the server
+        with open(body.path, 'rb') as f:
+            body = f.read()
+    y = decode_binary(body)
+    w = y[offsets[0]:offsets[0] + args.window]
+    assert np.array_equal(w, x[offsets[0]:offsets[0] + args.window])
+    print(f'{"binary first window":28s} {(time.time() - timer) * 1000:9.1f} ms   {len(body) / 1e6:9.3f} MB')
+
+    reader = ArraySliceReader(sha1_cache=sha1_cache, max_slice_bytes=256 * 1024 * 1024, max_open_chunks=256)
+    elapsed = []
+    num_bytes = []
+    for offset in offsets:
+        timer = time.time()
+        _, _, body = reader.create_response(ref['manifest_sha1'], f'{offset}:{offset + args.window}')
+        w = decode_binary(body)
+        elapsed.append(time.time() - timer)
+        num_bytes.append(len(body))
+        assert np.array_equal(w, x[offset:offset + args.window])
+    print(f'{"chunked first window":28s} {elapsed[0] * 1000:9.1f} ms   {num_bytes[0] / 1e6:9.3f} MB')
+    rest = sorted(elapsed[1:])
+    print(f'{"chunked further windows":28s} {rest[len(rest) // 2] * 1000:9.1f} ms   {np.mean(num_bytes[1:]) / 1e6:9.3f} MB   (p50)')
+    print(f'{"":28s} {reader.get_stats()}')
+
+if __name__ == '__main__':
+    main()
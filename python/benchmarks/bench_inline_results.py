@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Measure end-to-end latency of small jobs with and without inline results
+
+For each mode this starts a Session (with its worker process) against the fake
+kachery/hither stand-ins and runs many jobs returning a small dict, as the unit
+table metrics do. The latency is from hitherCreateJob sent to the result being
+available on the client: directly from hitherJobFinished when the result is
+inlined, otherwise after loading result_sha1 (in place of the http GET of the
+client). Set --latency-msec to simulate the round trip to the kachery daemon.
+
+Usage: python benchmarks/bench_inline_results.py [--num-trials 200] [--latency-msec 2]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure job latency with and without inline results')
+    parser.add_argument('--num-trials', type=int, default=200)
+    parser.add_argument('--latency-msec', type=float, default=2)
+    args = parser.parse_args()
+
+    install_fakes(latency_msec=args.latency_msec)
+
+    import numpy as np
+    import hither2 as hi2
+    import kachery_p2p as kp
+    from labbox.api import Session
+
+    @hi2.function('benchmark_unit_metric', '0.1.0')
+    def benchmark_unit_metric(unit_id: int):
+        return {'unit_id': unit_id, 'snr': 3.2, 'firing_rate': 12.5, 'num_events': 1024}
+
+    _job_handler = []
+    @hi2.function('benchmark_createjob_unit_metric', '0.1.0')
+    def benchmark_createjob_unit_metric(labbox, unit_id: int):
+        if len(_job_handler) == 0:
+            _job_handler.append(hi2.ParallelJobHandler(2))
+        with hi2.Config(job_handler=_job_handler[0]):
+            return benchmark_unit_metric.run(unit_id=unit_id)
+
+    labbox_config = {'job_handlers': {}}
+
+    async def run_mode(inline_max_bytes: int):
+        # read by the worker session, which is created in the worker process
+        os.environ['LABBOX_INLINE_RESULT_MAX_BYTES'] = str(inline_max_bytes)
+        session = Session(labbox_config=labbox_config, default_feed_name='benchmark', event_driven=True)
+        latencies = []
+        num_inline = 0
+        for i in range(args.num_trials):
+            client_job_id = f'job-{inline_max_bytes}-{i}'
+            timer = time.time()
+            session.handle_message({'type': 'hitherCreateJob', 'functionName': 'benchmark_createjob_unit_metric', 'kwargs': {'unit_id': i}, 'clientJobId': client_job_id})
+            result = None
+            while result is None:
+                await session.wait_for_outgoing_messages(timeout_sec=5)
+                for msg in session.check_for_outgoing_messages():
+                    if msg['type'] == 'hitherJobFinished' and msg['client_job_id'] == client_job_id:
+                        if 'result' in msg:
+                            num_inline += 1
+                            result = msg['result']
+                        else:
+                            result = json.loads(kp.load_text(f'sha1://{msg["result_sha1"]}'))
+            latencies.append(time.time() - timer)
+        session.cleanup()
+        return latencies, num_inline
+
+    for inline_max_bytes in [0, 8 * 1024]:
+        latencies, num_inline = asyncio.get_event_loop().run_until_complete(run_mode(inline_max_bytes))
+        x = np.array(latencies) * 1000
+        print(f'{"inline results" if inline_max_bytes > 0 else "sha1 results"} ({num_inline}/{args.num_trials} inlined):')
+        print(f'    job create -> result on client:    p50 {np.percentile(x, 50):7.1f} ms   p99 {np.percentile(x, 99):7.1f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Time to the first data of a long job, with partial results vs waiting for the result
+
+A job computes --num-chunks chunks, --chunk-sec each, and reports every chunk
+as a partial result (labbox.JobProgress) before returning all of them. A
+Session (event-driven, with its worker process) runs the job against the fake
+kachery/hither stand-ins, and the client side records when the first
+hitherJobProgress with a partial result arrives, and when hitherJobFinished
+does. Partial results larger than LABBOX_INLINE_RESULT_MAX_BYTES are loaded by
+sha1, as the client does over http.
+
+Reported: job create -> first partial, and job create -> result, plus the
+number of progress messages received.
+
+Usage: python benchmarks/bench_job_progress.py [--num-trials 3] [--num-chunks 10] [--chunk-sec 0.2] [--chunk-size 1000]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import numpy as np
+import kachery_p2p as kp
+import _functions
+from labbox.api import Session
+
+def _load_result_fields(x: dict):
+    if 'result' in x:
+        return x['result']
+    return json.loads(kp.load_text(f'sha1://{x["result_sha1"]}'))
+
+async def run_trial(session, *, trial: int, num_chunks: int, chunk_sec: float, chunk_size: int):
+    client_job_id = f'progress-{trial}'
+    timer = time.time()
+    session.handle_message({'type': 'hitherCreateJob', 'functionName': 'benchmark_createjob_progressive', 'kwargs': {'num_chunks': num_chunks, 'chunk_sec': chunk_sec, 'chunk_size': chunk_size, 'x': trial}, 'clientJobId': client_job_id})
+    first_partial_sec = None
+    chunk_indices = []
+    num_progress_messages = 0
+    while True:
+        await session.wait_for_outgoing_messages(timeout_sec=5)
+        for msg in session.check_for_outgoing_messages():
+            if msg.get('client_job_id', None) != client_job_id:
+                continue
+            if msg['type'] == 'hitherJobProgress':
+                num_progress_messages += 1
+                if 'partial' in msg:
+                    partial = _load_result_fields(msg['partial'])
+                    chunk_indices.append(partial['chunk_index'])
+                    if first_partial_sec is None:
+                        first_partial_sec = time.time() - timer
+            elif msg['type'] == 'hitherJobFinished':
+                result = _load_result_fields(msg)
+                assert len(result['values']) == num_chunks * chunk_size
+                # every partial result arrives, in order, before the result
+                assert chunk_indices == list(range(num_chunks)), chunk_indices
+                return first_partial_sec, time.time() - timer, num_progress_messages
+            elif msg['type'] == 'hitherJobError':
+                raise Exception(msg['error_message'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Time to the first partial result vs time to the result of a long job')
+    parser.add_argument('--num-trials', type=int, default=3)
+    parser.add_argument('--num-chunks', type=int, default=10)
+    parser.add_argument('--chunk-sec', type=float, default=0.2)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    async def run():
+        session = Session(labbox_config={'job_handlers': {}}, default_feed_name='benchmark', event_driven=True)
+        try:
+            return [
+                await run_trial(session, trial=i, num_chunks=args.num_chunks, chunk_sec=args.chunk_sec, chunk_size=args.chunk_size)
+                for i in range(args.num_trials)
+            ]
+        finally:
+            session.cleanup()
+    results = asyncio.get_event_loop().run_until_complete(run())
+    first = np.array([r[0] for r in results]) * 1000
+    total = np.array([r[1] for r in results]) * 1000
+    print(f'{args.num_chunks} chunks of {args.chunk_sec:.2f} s, {args.num_trials} trials')
+    print(f'    job create -> first partial:   p50 {np.percentile(first, 50):8.1f} ms')
+    print(f'    job create -> result:          p50 {np.percentile(total, 50):8.1f} ms')
+    print(f'    progress messages per job:     {np.mean([r[2] for r in results]):8.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Measure result encoding: the previous two-pass path against the single-pass encoder
+
+* previous: _make_json_safe (tree rebuild with json.dumps per leaf) followed by json.dumps (as in kp.store_json)
+* single-pass: labbox.serialize.encode_json
+
+Also compares the previous @serialize conversion with the copy-on-write _serialize.
+
+Usage: python benchmarks/bench_json_encoding.py
+"""
+
+import os
+import sys
+import json
+import time
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import numpy as np
+from labbox.serialize import _serialize, encode_json
+
+# the implementation that was used before the single-pass encoder (for comparison)
+def previous_make_json_safe(x):
+    if isinstance(x, np.integer):
+        return int(x)
+    elif isinstance(x, np.floating):
+        return float(x)
+    elif type(x) == dict:
+        ret = dict()
+        for key, val in x.items():
+            ret[key] = previous_make_json_safe(val)
+        return ret
+    elif (type(x) == list) or (type(x) == tuple):
+        return [previous_make_json_safe(val) for val in x]
+    elif isinstance(x, np.ndarray):
+        raise Exception('Cannot make ndarray json safe')
+    else:
+        if previous_is_jsonable(x):
+            return x
+    raise Exception(f'Item is not json safe: {type(x)}')
+
+def previous_is_jsonable(x) -> bool:
+    try:
+        json.dumps(x)
+        return True
+    except:
+        return False
+
+def unit_metrics_numpy(num_units: int):
+    # typical output of a unit metrics calculation: numpy scalars everywhere
+    rng = np.random.default_rng(0)
+    return {
+        'units': [
+            {
+                'unitId': np.int64(i),
+                'snr': np.float64(rng.random() * 10),
+                'firingRate': np.float32(rng.random() * 50),
+                'isolation': np.float32(rng.random()),
+                'peakChannels': (np.int32(i % 64), np.int32((i + 1) % 64)),
+                'label': 'accept'
+            }
+            for i in range(num_units)
+        ]
+    }
+
+def unit_metrics_python(num_units: int):
+    # same result, but already JSON-safe
+    return json.loads(json.dumps(previous_make_json_safe(unit_metrics_numpy(num_units))))
+
+def _time(fn, num_trials: int=5):
+    elapsed = []
+    for _ in range(num_trials):
+        timer = time.perf_counter()
+        fn()
+        elapsed.append(time.perf_counter() - timer)
+    return min(elapsed)
+
+def main():
+    num_units = 100000
+    print(f'{"result (" + str(num_units) + " dicts)":<30} {"previous ms":>12} {"new ms":>10} {"speedup":>8}')
+    for label, x in [('numpy scalars', unit_metrics_numpy(num_units)), ('already JSON-safe', unit_metrics_python(num_units))]:
+        assert json.loads(encode_json(x)) == json.loads(json.dumps(previous_make_json_safe(x)))
+        t_previous = _time(lambda: json.dumps(previous_make_json_safe(x)))
+        t_new = _time(lambda: encode_json(x))
+        print(f'{"store: " + label:<30} {t_previous * 1000:12.1f} {t_new * 1000:10.1f} {t_previous / t_new:7.1f}x')
+        t_previous = _time(lambda: previous_make_json_safe(x))
+        t_new = _time(lambda: _serialize(x))
+        print(f'{"@serialize: " + label:<30} {t_previous * 1000:12.1f} {t_new * 1000:10.1f} {t_previous / t_new:7.1f}x')
+
+if __name__ == '__main__':
+    main()
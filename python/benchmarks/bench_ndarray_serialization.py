@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Compare the base64/JSON ndarray encoding with the binary encoding of labbox.serialize
+
+For each array size this measures encode time, decode time and encoded size of
+* json: @serialize -> json.dumps, then json.loads + base64 decode (what the browser does)
+* binary: write_binary into a file (as the result store does), then decode_binary
+
+Usage: python benchmarks/bench_ndarray_serialization.py
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import tempfile
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import numpy as np
+from labbox.serialize import _serialize, write_binary, decode_binary
+
+def encode_json(x, path):
+    txt = json.dumps(_serialize(x))
+    with open(path, 'w') as f:
+        f.write(txt)
+
+def decode_json(path):
+    with open(path, 'r') as f:
+        y = json.loads(f.read())
+    return {
+        k: np.frombuffer(base64.b64decode(v['data_b64']), dtype=v['dtype']).reshape(v['shape'])
+        for k, v in y.items()
+    }
+
+def encode_binary(x, path):
+    with open(path, 'wb') as f:
+        write_binary(x, f)
+
+def decode_binary_file(path):
+    with open(path, 'rb') as f:
+        return decode_binary(f.read())
+
+def _time(fn, num_trials: int):
+    elapsed = []
+    for _ in range(num_trials):
+        timer = time.perf_counter()
+        fn()
+        elapsed.append(time.perf_counter() - timer)
+    return min(elapsed)
+
+def main():
+    print(f'{"result":<36} {"mode":<8} {"size MB":>9} {"encode ms":>10} {"decode ms":>10}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = f'{tmpdir}/result'
+        for num_channels, num_timepoints in [(32, 30000), (64, 300000)]:
+            traces = np.random.randn(num_channels * 2, num_timepoints).astype(np.float32)
+            for label, x in [
+                (f'traces {num_channels}x{num_timepoints} float32', {'traces': traces[:num_channels]}),
+                (f'strided view {num_channels}x{num_timepoints}', {'traces': traces[::2]})
+            ]:
+                num_trials = 3
+                for mode, encode, decode in [('json', encode_json, decode_json), ('binary', encode_binary, decode_binary_file)]:
+                    encode_sec = _time(lambda: encode(x, path), num_trials)
+                    decode_sec = _time(lambda: decode(path), num_trials)
+                    y = decode(path)
+                    assert np.array_equal(y['traces'], x['traces'])
+                    size_mb = os.path.getsize(path) / 1e6
+                    print(f'{label:<36} {mode:<8} {size_mb:9.1f} {encode_sec * 1000:10.1f} {decode_sec * 1000:10.1f}')
+
+if __name__ == '__main__':
+    main()
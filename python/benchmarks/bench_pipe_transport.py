@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Throughput of the pipe between a Session and its worker process, with and without shared memory for large messages
+
+A worker process is started on a SharedMemoryPipe, as by Session, and
+* large kwargs: the parent sends incoming hitherCreateJob messages whose kwargs
+  hold --num-values floats (as from a notebook), and the worker confirms each one
+* binary kwargs: the same with the floats as bytes, as they arrive with the
+  msgpack websocket framing (bin values)
+* outgoing batch: the worker sends batches of --batch-size messages (as
+  check_for_outgoing_messages gets them after a burst of jobs) on request
+* small: a 200 byte message each way, which stays on the pipe in both modes
+
+Each is run with everything on the pipe (LABBOX_PIPE_SHM_MIN_BYTES=0, as before)
+and with messages from LABBOX_PIPE_SHM_MIN_BYTES (default 256 KiB) on through
+shared memory. Reported: the time from sending to the other side having the
+message, the time the sender is blocked in send() (in the server, the event
+loop), and the throughput.
+
+Usage: python benchmarks/bench_pipe_transport.py [--num-trials 20] [--num-values 1000000] [--batch-size 2000]
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+import numpy as np
+from labbox.api import create_shared_memory_pipe_from_env
+
+def _create_batch(batch_size: int) -> list:
+    return [
+        {'type': 'hitherJobProgress', 'job_id': f'job-{i}', 'client_job_id': f'client-job-{i}', 'fraction': i / batch_size, 'partial': {'result': {'unit_id': i, 'values': list(range(100))}}}
+        for i in range(batch_size)
+    ]
+
+def _run_worker(pipe_to_parent, batch_size: int):
+    batch = _create_batch(batch_size)
+    while True:
+        x = pipe_to_parent.recv()
+        if x == 'exit':
+            pipe_to_parent.close()
+            return
+        if x['type'] == 'incoming_message':
+            pipe_to_parent.send({'type': 'received', 'timestamp': time.time()})
+        elif x['type'] == 'send_batch':
+            pipe_to_parent.send({'type': 'outgoing_messages', 'messages': batch})
+        elif x['type'] == 'ping':
+            pipe_to_parent.send({'type': 'pong', 'payload': x['payload']})
+
+def run_mode(args, shm_min_bytes: int) -> dict:
+    os.environ['LABBOX_PIPE_SHM_MIN_BYTES'] = str(shm_min_bytes)
+    pipe_to_parent, pipe_to_child = create_shared_memory_pipe_from_env()
+    worker = multiprocessing.Process(target=_run_worker, args=(pipe_to_parent, args.batch_size))
+    worker.start()
+    kwargs = {'values': np.random.RandomState(0).randn(args.num_values).tolist()}
+    binary_kwargs = {'values': np.random.RandomState(0).randn(args.num_values).tobytes()}
+    ret = {'large kwargs': [], 'binary kwargs': [], 'outgoing batch': [], 'small': []}
+    blocked = {'large kwargs': [], 'binary kwargs': []}
+    try:
+        for _ in range(args.num_trials):
+            for name, kw in [('large kwargs', kwargs), ('binary kwargs', binary_kwargs)]:
+                timer = time.time()
+                pipe_to_child.send({'type': 'incoming_message', 'message': {'type': 'hitherCreateJob', 'functionName': 'f', 'kwargs': kw, 'clientJobId': 'x'}})
+                blocked[name].append(time.time() - timer)
+                msg = pipe_to_child.recv()
+                ret[name].append(msg['timestamp'] - timer)
+
+            timer = time.time()
+            pipe_to_child.send({'type': 'send_batch'})
+            msg = pipe_to_child.recv()
+            assert len(msg['messages']) == args.batch_size
+            ret['outgoing batch'].append(time.time() - timer)
+
+            timer = time.time()
+            pipe_to_child.send({'type': 'ping', 'payload': 'x' * 200})
+            pipe_to_child.recv()
+            ret['small'].append(time.time() - timer)
+        stats = pipe_to_child.get_stats()
+    finally:
+        pipe_to_child.send('exit')
+        worker.join()
+        pipe_to_child.close()
+    ret['blocked'] = blocked
+    ret['stats'] = stats
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser(description='Pipe vs shared memory for large messages between a session and its worker process')
+    parser.add_argument('--num-trials', type=int, default=20)
+    parser.add_argument('--num-values', type=int, default=1000000, help='Number of floats in the kwargs of the large incoming messages')
+    parser.add_argument('--batch-size', type=int, default=2000, help='Number of messages in each outgoing batch')
+    parser.add_argument('--shm-min-bytes', type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    import pickle
+    kwargs_nbytes = len(pickle.dumps(np.random.RandomState(0).randn(args.num_values).tolist(), protocol=5))
+    binary_kwargs_nbytes = args.num_values * 8
+    batch_nbytes = len(pickle.dumps(_create_batch(args.batch_size), protocol=5))
+    print(f'large kwargs {kwargs_nbytes / 1e6:.1f} MB, binary kwargs {binary_kwargs_nbytes / 1e6:.1f} MB, outgoing batch {batch_nbytes / 1e6:.1f} MB')
+    for label, shm_min_bytes in [('pipe only', 0), (f'shared memory from {args.shm_min_bytes // 1024} KiB', args.shm_min_bytes)]:
+        r = run_mode(args, shm_min_bytes)
+        print(f'{label}:')
+        for name, nbytes in [('large kwargs', kwargs_nbytes), ('binary kwargs', binary_kwargs_nbytes), ('outgoing batch', batch_nbytes), ('small', 200)]:
+            x = sorted(r[name])
+            p50 = x[len(x) // 2]
+            print(f'    {name:16s} p50 {p50 * 1000:8.2f} ms   p99 {x[int(len(x) * 0.99)] * 1000:8.2f} ms   {nbytes / p50 / 1e6:9.1f} MB/s')
+        for name, x in r['blocked'].items():
+            x = sorted(x)
+            print(f'    {"send() blocked":16s} p50 {x[len(x) // 2] * 1000:8.2f} ms   ({name})')
+        print(f'    {r["stats"]}')
+
+if __name__ == '__main__':
+    main()
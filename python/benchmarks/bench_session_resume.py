@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Cost of a dropped websocket connection while a job is running, with and without resuming the session
+
+bin/labbox_start_api_websocket is run in a subprocess (event-driven, a worker
+process per session). A client starts a job that takes --job-sec, and drops the
+connection after --drop-after-sec. After --offline-sec it reconnects and
+* resume: presents its session token and the number of messages received,
+  and gets the hitherJobFinished of the job that kept running
+* resubmit: starts a new session (as without resume tokens) and creates the job again
+
+Reported: time from reconnecting to the job result. With an offline time longer
+than the job, the result has been buffered by the server and comes right away.
+
+Usage: python benchmarks/bench_session_resume.py [--num-trials 5] [--job-sec 2] [--drop-after-sec 0.5] [--offline-sec 0.5]
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import subprocess
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import websockets
+from run_suite import _get_free_port, _wait_for_port
+
+class Client:
+    """
+    Counts the numbered session messages, as ApiConnection.ts does, and keeps the session token
+    """
+    def __init__(self):
+        self.token = None
+        self.num_received = 0
+    async def connect(self, port: int, *, resume: bool):
+        url = f'ws://127.0.0.1:{port}'
+        if resume and self.token is not None:
+            url += f'?resumeToken={self.token}&received={self.num_received}'
+        ws = await websockets.connect(url, max_size=None)
+        first = json.loads(await ws.recv())[0]
+        assert first['type'] == 'reportSessionToken', first
+        if not first['resumed']:
+            self.num_received = 0
+        self.token = first['token']
+        return ws, first['resumed']
+    async def wait_for_job_finished(self, ws, client_job_id: str) -> dict:
+        while True:
+            for msg in json.loads(await ws.recv()):
+                self.num_received += 1
+                if msg['type'] == 'hitherJobFinished' and msg.get('client_job_id', None) == client_job_id:
+                    return msg
+
+async def create_job(ws, client_job_id: str, sec: float):
+    await ws.send(json.dumps({'type': 'hitherCreateJob', 'functionName': 'benchmark_createjob_sleep', 'kwargs': {'sec': sec, 'x': 1}, 'clientJobId': client_job_id}))
+
+async def run_trial(port: int, *, resume: bool, job_sec: float, drop_after_sec: float, offline_sec: float, trial: int) -> float:
+    client = Client()
+    ws, _ = await client.connect(port, resume=False)
+    client_job_id = f'{"resume" if resume else "resubmit"}-{trial}'
+    await create_job(ws, client_job_id, job_sec)
+    try:
+        await asyncio.wait_for(client.wait_for_job_finished(ws, client_job_id), timeout=drop_after_sec)
+        raise Exception('The job finished before the connection was dropped')
+    except asyncio.TimeoutError:
+        pass
+    await ws.close()
+    await asyncio.sleep(offline_sec)
+    timer = time.time()
+    ws, resumed = await client.connect(port, resume=resume)
+    assert resumed == resume, resumed
+    if not resume:
+        await create_job(ws, client_job_id, job_sec)
+    await asyncio.wait_for(client.wait_for_job_finished(ws, client_job_id), timeout=job_sec + 30)
+    elapsed = time.time() - timer
+    await ws.close()
+    return elapsed
+
+async def run(args):
+    port = _get_free_port()
+    env = {
+        **os.environ,
+        'LABBOX_EVENT_DRIVEN': '1',
+        'LABBOX_DEFAULT_FEED_NAME': 'benchmark'
+    }
+    server = subprocess.Popen([sys.executable, f'{thisdir}/_websocket_server.py', str(port)], env=env, stdout=subprocess.DEVNULL, start_new_session=True)
+    try:
+        await _wait_for_port(port, server, timeout_sec=60)
+        for offline_sec in [args.offline_sec, args.job_sec + 0.5]:
+            for resume in [False, True]:
+                x = [await run_trial(port, resume=resume, job_sec=args.job_sec, drop_after_sec=args.drop_after_sec, offline_sec=offline_sec, trial=i) for i in range(args.num_trials)]
+                x = sorted(x)
+                label = f'{"resume" if resume else "resubmit"} (offline {offline_sec:.1f} s)'
+                print(f'{label:32s} reconnect -> result: p50 {x[len(x) // 2] * 1000:8.1f} ms   max {x[-1] * 1000:8.1f} ms')
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Dropped connection during a job, with and without session resume')
+    parser.add_argument('--num-trials', type=int, default=5)
+    parser.add_argument('--job-sec', type=float, default=2)
+    parser.add_argument('--drop-after-sec', type=float, default=0.5)
+    parser.add_argument('--offline-sec', type=float, default=0.5)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+if __name__ == '__main__':
+    main()
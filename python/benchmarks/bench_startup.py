@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Startup cost of labbox: import times, and time to the first reportServerInfo of a new Session
+
+* import: time to import labbox, to get labbox.api.Session, and to get
+  labbox.WorkerSession, each in a fresh interpreter (hither2 and kachery_p2p are
+  the fake stand-ins here, so their own import time is not included)
+* first reportServerInfo: Session created -> reportServerInfo received, with a
+  new worker process for each session, and with a pre-warmed spare worker
+  process (prewarm_worker_session, LABBOX_PREWARM_WORKER=1 in the websocket server)
+
+Usage: python benchmarks/bench_startup.py [--num-trials 10] [--latency-msec 20]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+
+# each is run after installing the fakes, and times the statements after the marker
+_IMPORT_SCENARIOS = {
+    'import labbox': 'import labbox',
+    'labbox.api.Session': 'import labbox.api; labbox.api.Session',
+    'labbox.WorkerSession': 'import labbox; labbox.WorkerSession'
+}
+
+def measure_import_sec(statement: str) -> float:
+    code = '; '.join([
+        'import sys, time',
+        f'sys.path[:0] = [{repr(thisdir + "/..")}, {repr(thisdir)}]',
+        'from _fakes import install_fakes',
+        'install_fakes()',
+        'timer = time.perf_counter()',
+        statement,
+        'print(time.perf_counter() - timer)'
+    ])
+    out = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE).stdout
+    return float(out.decode().strip().splitlines()[-1])
+
+async def measure_first_report_sec(num_trials: int, prewarm: bool) -> list:
+    from labbox.api import Session, prewarm_worker_session
+    labbox_config = {'job_handlers': {}}
+    if prewarm:
+        prewarm_worker_session(labbox_config=labbox_config, default_feed_name='benchmark', event_driven=True)
+    ret = []
+    for _ in range(num_trials):
+        # connections are assumed to be further apart than it takes to start a worker process
+        await asyncio.sleep(1)
+        timer = time.time()
+        session = Session(labbox_config=labbox_config, default_feed_name='benchmark', event_driven=True)
+        found = False
+        while not found:
+            await session.wait_for_outgoing_messages(timeout_sec=5)
+            found = any([msg['type'] == 'reportServerInfo' for msg in session.check_for_outgoing_messages()])
+        ret.append(time.time() - timer)
+        session.cleanup()
+    return ret
+
+def _format_sec(x: list) -> str:
+    x = sorted(x)
+    return f'p50 {x[len(x) // 2] * 1000:7.1f} ms   max {x[-1] * 1000:7.1f} ms'
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time and time to first reportServerInfo')
+    parser.add_argument('--num-trials', type=int, default=10)
+    parser.add_argument('--latency-msec', type=float, default=20, help='Simulated round trip to the kachery daemon')
+    args = parser.parse_args()
+
+    for name, statement in _IMPORT_SCENARIOS.items():
+        print(f'{name:36s} {_format_sec([measure_import_sec(statement) for _ in range(args.num_trials)])}')
+
+    install_fakes(latency_msec=args.latency_msec)
+    loop = asyncio.get_event_loop()
+    for prewarm in [False, True]:
+        x = loop.run_until_complete(measure_first_report_sec(args.num_trials, prewarm))
+        print(f'{"first reportServerInfo" + (" (prewarmed)" if prewarm else ""):36s} {_format_sec(x)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Measure how many daemon calls the process-wide subfeed watch registry saves
+
+Starts a SessionPool with a single worker process. Many sessions each send a
+subfeedMessageRequest for the same subfeed position (as when everybody has the
+same curation feed open), then wait for a message. Reports the registry stats of
+the worker: daemon calls made, calls saved, and watches deduplicated.
+
+Usage: python benchmarks/bench_subfeed_watch_dedup.py [--num-sessions 50] [--idle-sec 5]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import kachery_p2p as kp
+from labbox.api import SessionPool
+
+labbox_config = {'job_handlers': {}}
+
+async def run_mode(event_driven: bool, num_sessions: int, idle_sec: float):
+    pool = SessionPool(labbox_config=labbox_config, default_feed_name='benchmark', num_workers=1, event_driven=event_driven)
+    sessions = [pool.create_session() for _ in range(num_sessions)]
+    feed = kp.load_feed('benchmark-dedup-feed', create=True)
+    subfeed_name = f'curation-{int(event_driven)}'
+    subfeed = feed.get_subfeed(subfeed_name)
+    for i, session in enumerate(sessions):
+        session.handle_message({'type': 'subfeedMessageRequest', 'requestId': f'request-{i}', 'feedUri': feed.get_uri(), 'subfeedName': subfeed_name, 'position': 0, 'waitMsec': 60000})
+    await asyncio.sleep(idle_sec)
+    timer = time.time()
+    subfeed.append_messages([{'action': 'accept'}])
+    notified = set()
+    while len(notified) < num_sessions and time.time() - timer < 10:
+        for i, session in enumerate(sessions):
+            for msg in session.check_for_outgoing_messages():
+                if msg['type'] == 'subfeedMessageRequestResponse' and msg['numNewMessages'] > 0:
+                    notified.add(i)
+        await asyncio.sleep(0.005)
+    elapsed = time.time() - timer
+    # wait for the next load report of the worker
+    await asyncio.sleep(2.5)
+    stats = pool.get_load()[0]['subfeed_watches']
+    for session in sessions:
+        session.cleanup()
+    pool.cleanup()
+    return len(notified), elapsed, stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the deduplication of subfeed watches across sessions')
+    parser.add_argument('--num-sessions', type=int, default=50)
+    parser.add_argument('--idle-sec', type=float, default=5)
+    args = parser.parse_args()
+
+    for event_driven in [False, True]:
+        num_notified, elapsed, stats = asyncio.get_event_loop().run_until_complete(run_mode(event_driven, args.num_sessions, args.idle_sec))
+        num_calls_without_dedup = stats['numWatchCalls'] + stats['numWatchCallsSaved']
+        print(f'{"event-driven" if event_driven else "polling"} ({args.num_sessions} sessions, {args.idle_sec} s idle):')
+        print(f'    notified {num_notified}/{args.num_sessions} sessions in {elapsed * 1000:.1f} ms')
+        print(f'    daemon calls: {stats["numWatchCalls"]} (would have been {num_calls_without_dedup}), watches deduplicated: {stats["numWatchesDeduplicated"]}/{stats["numWatchesRequested"]}')
+
+if __name__ == '__main__':
+    main()
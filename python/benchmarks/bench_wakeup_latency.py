@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+Compare polling mode with event-driven mode (LABBOX_EVENT_DRIVEN=1)
+
+For each mode this starts a Session (with its worker process) against the fake
+kachery/hither stand-ins and measures:
+* job latency: hitherCreateJob sent -> hitherJobFinished received
+* subfeed latency: message appended -> subfeedMessageRequestResponse received
+* idle CPU usage of the worker process
+
+Usage: python benchmarks/bench_wakeup_latency.py [--num-trials 20]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import numpy as np
+import hither2 as hi2
+import kachery_p2p as kp
+from labbox.api import Session
+
+@hi2.function('benchmark_noop', '0.1.0')
+def benchmark_noop(x: int):
+    return x
+
+_job_handler = []
+@hi2.function('benchmark_createjob_noop', '0.1.0')
+def benchmark_createjob_noop(labbox, x: int):
+    if len(_job_handler) == 0:
+        _job_handler.append(hi2.ParallelJobHandler(2))
+    with hi2.Config(job_handler=_job_handler[0]):
+        return benchmark_noop.run(x=x)
+
+labbox_config = {'job_handlers': {}}
+
+class SessionClient:
+    # does what the outgoing message handler of labbox_start_api_websocket does
+    def __init__(self, session, event_driven: bool):
+        self._session = session
+        self._event_driven = event_driven
+        self._waiters = {}
+    def expect(self, key):
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters[key] = fut
+        return fut
+    async def run(self):
+        while True:
+            if self._event_driven:
+                await self._session.wait_for_outgoing_messages(timeout_sec=5)
+            messages = self._session.check_for_outgoing_messages()
+            for msg in messages:
+                key = msg.get('client_job_id', None) or msg.get('requestId', None) or msg['type']
+                if key in self._waiters and not self._waiters[key].done():
+                    self._waiters[key].set_result(time.time())
+            if not self._event_driven:
+                await asyncio.sleep(0.05)
+
+async def run_mode(event_driven: bool, num_trials: int):
+    session = Session(labbox_config=labbox_config, default_feed_name='benchmark', event_driven=event_driven)
+    client = SessionClient(session, event_driven)
+    pump = asyncio.ensure_future(client.run())
+    await asyncio.wait_for(client.expect('reportServerInfo'), timeout=10)
+
+    job_latencies = []
+    for i in range(num_trials):
+        client_job_id = f'job-{i}'
+        fut = client.expect(client_job_id)
+        timer = time.time()
+        session.handle_message({'type': 'hitherCreateJob', 'functionName': 'benchmark_createjob_noop', 'kwargs': {'x': i}, 'clientJobId': client_job_id})
+        job_latencies.append(await asyncio.wait_for(fut, timeout=10) - timer)
+
+    subfeed = kp.load_feed('benchmark-feed', create=True).get_subfeed(f'subfeed-{int(event_driven)}')
+    feed_uri = kp.load_feed('benchmark-feed').get_uri()
+    subfeed_latencies = []
+    for i in range(num_trials):
+        request_id = f'request-{i}'
+        fut = client.expect(request_id)
+        session.handle_message({'type': 'subfeedMessageRequest', 'requestId': request_id, 'feedUri': feed_uri, 'subfeedName': f'subfeed-{int(event_driven)}', 'position': i, 'waitMsec': 10000})
+        await asyncio.sleep(0.3)
+        timer = time.time()
+        subfeed.append_messages([{'index': i}])
+        subfeed_latencies.append(await asyncio.wait_for(fut, timeout=15) - timer)
+
+    cpu_timer = time.time()
+    cpu_start = _process_cpu_sec(session._worker_process.pid)
+    await asyncio.sleep(3)
+    idle_cpu_fraction = (_process_cpu_sec(session._worker_process.pid) - cpu_start) / (time.time() - cpu_timer)
+
+    pump.cancel()
+    session.cleanup()
+    return {
+        'job_latencies': job_latencies,
+        'subfeed_latencies': subfeed_latencies,
+        'idle_cpu_fraction': idle_cpu_fraction
+    }
+
+def _process_cpu_sec(pid: int):
+    # linux only
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().split(')')[-1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def _format_latencies(x):
+    x = np.array(x) * 1000
+    return f'p50 {np.percentile(x, 50):7.1f} ms   p99 {np.percentile(x, 99):7.1f} ms'
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare worker wakeup latency of polling and event-driven modes')
+    parser.add_argument('--num-trials', type=int, default=20)
+    args = parser.parse_args()
+
+    for event_driven in [False, True]:
+        result = asyncio.get_event_loop().run_until_complete(run_mode(event_driven, args.num_trials))
+        print(f'{"event-driven" if event_driven else "polling"}:')
+        print(f'    job create -> finished:        {_format_latencies(result["job_latencies"])}')
+        print(f'    subfeed append -> notified:    {_format_latencies(result["subfeed_latencies"])}')
+        print(f'    idle worker cpu:               {result["idle_cpu_fraction"] * 100:.1f}%')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Load test of labbox_start_api_http against a slow fake kachery daemon
+
+Many clients poll /feed/getMessages concurrently while every kachery call takes
+--latency-msec. Meanwhile a canary client fetches a cached /sha1 result, which
+should stay fast no matter how busy the kachery thread pool is.
+
+Usage: python benchmarks/loadtest_http_server.py [--num-clients 300] [--duration-sec 10] [--latency-msec 200]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import numpy as np
+import aiohttp
+from aiohttp import web
+import kachery_p2p as kp
+
+def load_http_server_module():
+    path = f'{thisdir}/../bin/labbox_start_api_http'
+    loader = SourceFileLoader('labbox_start_api_http', path)
+    spec = importlib.util.spec_from_loader('labbox_start_api_http', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+async def poll_feed(session: aiohttp.ClientSession, url: str, feed_uri: str, deadline: float, results: dict):
+    while time.time() < deadline:
+        timer = time.time()
+        async with session.post(f'{url}/feed/getMessages', json={'feedUri': feed_uri, 'subfeedName': 'main', 'position': 0, 'waitMsec': 0}) as resp:
+            await resp.read()
+            if resp.status == 200:
+                results['latencies'].append(time.time() - timer)
+            elif resp.status == 503:
+                results['num_503'] += 1
+                await asyncio.sleep(float(resp.headers.get('Retry-After', '1')))
+            else:
+                results['num_errors'] += 1
+
+async def canary(session: aiohttp.ClientSession, url: str, sha1: str, deadline: float, latencies: list):
+    while time.time() < deadline:
+        timer = time.time()
+        async with session.get(f'{url}/sha1/{sha1}') as resp:
+            await resp.read()
+            assert resp.status == 200
+        latencies.append(time.time() - timer)
+        await asyncio.sleep(0.05)
+
+async def run_load_test(num_clients: int, duration_sec: float):
+    module = load_http_server_module()
+    app = module.create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    url = f'http://127.0.0.1:{port}'
+
+    feed = kp.load_feed('loadtest-feed', create=True)
+    feed.get_subfeed('main').append_messages([{'index': i} for i in range(10)])
+    sha1 = kp.store_json({'result': list(range(1000))}).split('/')[2]
+
+    results = {'latencies': [], 'num_503': 0, 'num_errors': 0}
+    canary_latencies = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        # warm up the sha1 cache
+        async with session.get(f'{url}/sha1/{sha1}') as resp:
+            await resp.read()
+        deadline = time.time() + duration_sec
+        await asyncio.gather(
+            *[poll_feed(session, url, feed.get_uri(), deadline, results) for _ in range(num_clients)],
+            canary(session, url, sha1, deadline, canary_latencies)
+        )
+        async with session.get(f'{url}/stats/kacheryExecutor') as resp:
+            executor_stats = json.loads(await resp.text())
+    await runner.cleanup()
+    return results, canary_latencies, executor_stats
+
+def _format_latencies(x):
+    if len(x) == 0:
+        return 'no samples'
+    x = np.array(x) * 1000
+    return f'p50 {np.percentile(x, 50):8.1f} ms   p99 {np.percentile(x, 99):8.1f} ms'
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the labbox http server with a slow fake kachery daemon')
+    parser.add_argument('--num-clients', type=int, default=300)
+    parser.add_argument('--duration-sec', type=float, default=10)
+    parser.add_argument('--latency-msec', type=float, default=200)
+    args = parser.parse_args()
+
+    os.environ['FAKE_KACHERY_LATENCY_MSEC'] = str(args.latency_msec)
+    results, canary_latencies, executor_stats = asyncio.get_event_loop().run_until_complete(run_load_test(args.num_clients, args.duration_sec))
+    print(f'{args.num_clients} polling clients, {args.duration_sec} s, kachery latency {args.latency_msec} ms')
+    print(f'    /feed/getMessages:   {len(results["latencies"]) / args.duration_sec:7.1f} req/s   {_format_latencies(results["latencies"])}')
+    print(f'    503 responses:       {results["num_503"]}   other errors: {results["num_errors"]}')
+    print(f'    cached /sha1 canary: {_format_latencies(canary_latencies)}')
+    print(f'    executor: {json.dumps(executor_stats)}')
+
+if __name__ == '__main__':
+    main()
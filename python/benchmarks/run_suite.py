@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for labbox, against in-process stand-ins for kachery_p2p and hither2
+
+Scenarios (latencies as p50/p99, plus throughput where it applies):
+* session_job: hitherCreateJob -> hitherJobFinished on an event-driven Session,
+  one job at a time and as a burst of concurrent jobs
+* session_subfeed_notification: subfeed message appended -> subfeedMessageRequestResponse
+* websocket_job: the same job round trip through bin/labbox_start_api_websocket
+  (run in a subprocess, with a session pool) and a websocket client, with json
+  and msgpack framing (_msgpack suffix); num_frames of the burst shows the coalescing
+* websocket_large_array_job: job returning a large ndarray (binary encoding)
+  through the websocket server, until the result is fetched from /sha1 of
+  bin/labbox_start_api_http
+* http_sha1: /sha1 fetches of bin/labbox_start_api_http, cold and cached
+* ndarray_encoding: encoding of a large ndarray result, json (base64) and binary
+
+The results are written as JSON (--output), so that runs can be compared with
+--compare previous.json. --quick runs far fewer trials, as a smoke test.
+
+Usage: python benchmarks/run_suite.py [--output results.json] [--compare previous.json] [--latency-msec 0] [--quick]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import platform
+import subprocess
+from typing import Dict, List, Union
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+
+from _fakes import install_fakes
+install_fakes()
+
+import numpy as np
+import msgpack
+import aiohttp
+import websockets
+from aiohttp import web
+import kachery_p2p as kp
+import _functions
+from labbox.api import Session, SUBPROTOCOL_MSGPACK, decode_message
+from labbox.serialize import encode_json, encode_binary
+from loadtest_http_server import load_http_server_module
+
+labbox_config = {'job_handlers': {}}
+
+########################################################################
+# Summaries
+
+def summarize(latencies_sec: List[float], *, total_sec: Union[float, None]=None, num_bytes: Union[int, None]=None) -> dict:
+    x = np.array(latencies_sec) * 1000
+    ret = {
+        'n': len(latencies_sec),
+        'p50_ms': float(np.percentile(x, 50)),
+        'p99_ms': float(np.percentile(x, 99)),
+        'mean_ms': float(np.mean(x))
+    }
+    if total_sec is not None:
+        ret['throughput_per_sec'] = len(latencies_sec) / total_sec
+    if num_bytes is not None:
+        ret['mb_per_sec'] = num_bytes / 1e6 / (ret['p50_ms'] / 1000)
+    return ret
+
+def print_summary(name: str, s: dict):
+    line = f'{name:<40} n={s["n"]:<6} p50 {s["p50_ms"]:9.2f} ms   p99 {s["p99_ms"]:9.2f} ms'
+    if 'throughput_per_sec' in s:
+        line += f'   {s["throughput_per_sec"]:9.1f} /s'
+    if 'mb_per_sec' in s:
+        line += f'   {s["mb_per_sec"]:9.1f} MB/s'
+    print(line)
+
+########################################################################
+# Session scenarios
+
+class SessionClient:
+    # does what the outgoing message handler of labbox_start_api_websocket does in event-driven mode
+    def __init__(self, session):
+        self._session = session
+        self._waiters: Dict[str, asyncio.Future] = {}
+    def expect(self, key: str) -> asyncio.Future:
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters[key] = fut
+        return fut
+    async def run(self):
+        while True:
+            await self._session.wait_for_outgoing_messages(timeout_sec=1)
+            for msg in self._session.check_for_outgoing_messages():
+                if msg['type'] == 'hitherJobCreated':
+                    continue
+                key = msg.get('client_job_id', None) or msg.get('requestId', None) or msg['type']
+                fut = self._waiters.pop(key, None)
+                if fut is not None and not fut.done():
+                    fut.set_result((time.time(), msg))
+
+async def run_session_scenarios(num_trials: int, burst_size: int) -> dict:
+    session = Session(labbox_config=labbox_config, default_feed_name='benchmark', event_driven=True)
+    client = SessionClient(session)
+    pump = asyncio.ensure_future(client.run())
+    await asyncio.wait_for(client.expect('reportServerInfo'), timeout=30)
+    results = {}
+
+    latencies = []
+    for i in range(num_trials):
+        client_job_id = f'sequential-{i}'
+        fut = client.expect(client_job_id)
+        timer = time.time()
+        session.handle_message({'type': 'hitherCreateJob', 'functionName': 'benchmark_createjob_noop', 'kwargs': {'x': i}, 'clientJobId': client_job_id})
+        t, msg = await asyncio.wait_for(fut, timeout=30)
+        assert msg['type'] == 'hitherJobFinished', msg
+        latencies.append(t - timer)
+    results['session_job_sequential'] = summarize(latencies)
+
+    futs = [client.expect(f'burst-{i}') for i in range(burst_size)]
+    timer = time.time()
+    for i in range(burst_size):
+        session.handle_message({'type': 'hitherCreateJob', 'functionName': 'benchmark_createjob_noop', 'kwargs': {'x': num_trials + i}, 'clientJobId': f'burst-{i}'})
+    finished = await asyncio.wait_for(asyncio.gather(*futs), timeout=120)
+    results['session_job_burst'] = summarize([t - timer for t, _ in finished], total_sec=max([t for t, _ in finished]) - timer)
+
+    feed = kp.load_feed('benchmark-suite-feed', create=True)
+    subfeed_name = f'notification-{os.getpid()}-{time.time()}'
+    subfeed = feed.get_subfeed(subfeed_name)
+    latencies = []
+    for i in range(num_trials):
+        request_id = f'request-{i}'
+        fut = client.expect(request_id)
+        session.handle_message({'type': 'subfeedMessageRequest', 'requestId': request_id, 'feedUri': feed.get_uri(), 'subfeedName': subfeed_name, 'position': i, 'waitMsec': 30000})
+        # let the worker start watching
+        await asyncio.sleep(0.05)
+        timer = time.time()
+        subfeed.append_messages([{'index': i}])
+        t, _ = await asyncio.wait_for(fut, timeout=30)
+        latencies.append(t - timer)
+    results['session_subfeed_notification'] = summarize(latencies)
+
+    pump.cancel()
+    session.cleanup()
+    return results
+
+########################################################################
+# Server scenarios
+
+def _get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def _wait_for_port(port: int, process: subprocess.Popen, timeout_sec: float):
+    timer = time.time()
+    while True:
+        if process.poll() is not None:
+            raise Exception(f'Server exited with code {process.returncode}')
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.time() - timer > timeout_sec:
+                raise
+            await asyncio.sleep(0.1)
+
+async def _start_http_server():
+    app = load_http_server_module().create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+async def run_http_scenarios(num_trials: int, concurrency: int) -> dict:
+    runner, url = await _start_http_server()
+    results = {}
+    sha1s = [kp.store_json({'unit_id': i, 'values': list(range(2000))}).split('/')[2] for i in range(num_trials)]
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+        async def fetch(sha1: str) -> float:
+            timer = time.time()
+            async with http.get(f'{url}/sha1/{sha1}') as resp:
+                await resp.read()
+                assert resp.status == 200
+            return time.time() - timer
+        # each sha1 fetched for the first time
+        results['http_sha1_cold'] = summarize([await fetch(sha1) for sha1 in sha1s])
+        # served from the sha1 cache, many clients at once
+        per_client = max(1, num_trials // concurrency)
+        async def client(k: int):
+            return [await fetch(sha1s[(k + j) % len(sha1s)]) for j in range(per_client)]
+        timer = time.time()
+        latencies = await asyncio.gather(*[client(k) for k in range(concurrency)])
+        results['http_sha1_cached'] = summarize([a for b in latencies for a in b], total_sec=time.time() - timer)
+    await runner.cleanup()
+    return results
+
+async def run_websocket_scenarios(num_trials: int, burst_size: int, num_array_values: int, *, framing: str='json') -> dict:
+    # with msgpack framing, only the job round trips are run (with a _msgpack suffix)
+    suffix = '' if framing == 'json' else f'_{framing}'
+    subprotocols = [SUBPROTOCOL_MSGPACK] if framing == 'msgpack' else None
+    port = _get_free_port()
+    env = {
+        **os.environ,
+        'LABBOX_EVENT_DRIVEN': '1',
+        'LABBOX_SESSION_POOL_SIZE': '2',
+        'LABBOX_DEFAULT_FEED_NAME': 'benchmark'
+    }
+    server = subprocess.Popen([sys.executable, f'{thisdir}/_websocket_server.py', str(port)], env=env, stdout=subprocess.DEVNULL, start_new_session=True)
+    runner = None
+    results = {}
+    try:
+        await _wait_for_port(port, server, timeout_sec=60)
+        runner, url = await _start_http_server()
+        async with websockets.connect(f'ws://127.0.0.1:{port}', max_size=None, subprotocols=subprotocols) as ws:
+            assert ws.subprotocol == (subprotocols[0] if subprotocols else None), ws.subprotocol
+            waiters: Dict[str, asyncio.Future] = {}
+            num_frames = [0]
+            async def receive():
+                async for message in ws:
+                    num_frames[0] += 1
+                    for msg in decode_message(message):
+                        fut = waiters.pop(msg.get('client_job_id', '') if msg['type'] != 'hitherJobCreated' else '', None)
+                        if fut is not None and not fut.done():
+                            fut.set_result((time.time(), msg))
+            receiver = asyncio.ensure_future(receive())
+            async def create_job(client_job_id: str, function_name: str, kwargs: dict) -> asyncio.Future:
+                fut = asyncio.get_event_loop().create_future()
+                waiters[client_job_id] = fut
+                msg = {'type': 'hitherCreateJob', 'functionName': function_name, 'kwargs': kwargs, 'clientJobId': client_job_id}
+                # the client sends single messages (not lists), as ApiConnection.ts does
+                await ws.send(msgpack.packb(msg) if framing == 'msgpack' else json.dumps(msg))
+                return fut
+
+            latencies = []
+            for i in range(num_trials):
+                timer = time.time()
+                fut = await create_job(f'sequential-{i}', 'benchmark_createjob_noop', {'x': i})
+                t, msg = await asyncio.wait_for(fut, timeout=30)
+                assert msg['type'] == 'hitherJobFinished', msg
+                latencies.append(t - timer)
+            results[f'websocket_job_sequential{suffix}'] = summarize(latencies)
+
+            timer = time.time()
+            num_frames[0] = 0
+            futs = [await create_job(f'burst-{i}', 'benchmark_createjob_noop', {'x': num_trials + i}) for i in range(burst_size)]
+            finished = await asyncio.wait_for(asyncio.gather(*futs), timeout=120)
+            results[f'websocket_job_burst{suffix}'] = summarize([t - timer for t, _ in finished], total_sec=max([t for t, _ in finished]) - timer)
+            # fewer frames than messages means the server coalesced notifications
+            results[f'websocket_job_burst{suffix}']['num_frames'] = num_frames[0]
+            if framing != 'json':
+                receiver.cancel()
+                return results
+
+            latencies = []
+            num_bytes = 0
+            async with aiohttp.ClientSession() as http:
+                for i in range(max(1, num_trials // 10)):
+                    timer = time.time()
+                    fut = await create_job(f'array-{i}', 'benchmark_createjob_large_array', {'num_values': num_array_values, 'seed': i})
+                    _, msg = await asyncio.wait_for(fut, timeout=60)
+                    assert msg['type'] == 'hitherJobFinished', msg
+                    async with http.get(f'{url}/sha1/{msg["result_sha1"]}') as resp:
+                        body = await resp.read()
+                    latencies.append(time.time() - timer)
+                    num_bytes = len(body)
+            results['websocket_large_array_job'] = summarize(latencies, num_bytes=num_bytes)
+            receiver.cancel()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        # the server and its worker processes
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+    return results
+
+########################################################################
+# Encoding
+
+def run_encoding_scenarios(num_trials: int, num_array_values: int) -> dict:
+    x = {'values': np.random.RandomState(0).randn(num_array_values).astype(np.float32)}
+    results = {}
+    for mode in ['json', 'binary']:
+        latencies = []
+        for _ in range(num_trials):
+            timer = time.time()
+            if mode == 'json':
+                num_bytes = len(encode_json(x, ndarray_encoding='json'))
+            else:
+                num_bytes = len(encode_binary(x))
+            latencies.append(time.time() - timer)
+        results[f'ndarray_encoding_{mode}'] = summarize(latencies, num_bytes=num_bytes)
+    return results
+
+########################################################################
+
+def compare(results: dict, previous: dict):
+    print()
+    print(f'Compared with {previous.get("git_commit", None)} ({previous.get("timestamp", None)}):')
+    for name, s in results['results'].items():
+        p = previous['results'].get(name, None)
+        if p is None:
+            continue
+        line = f'{name:<40} p50 {_format_change(s["p50_ms"], p["p50_ms"])}   p99 {_format_change(s["p99_ms"], p["p99_ms"])}'
+        if 'throughput_per_sec' in s and 'throughput_per_sec' in p:
+            line += f'   throughput {_format_change(s["throughput_per_sec"], p["throughput_per_sec"])}'
+        print(line)
+
+def _format_change(value: float, previous_value: float) -> str:
+    if previous_value == 0:
+        return f'{value:9.2f} (n/a)'
+    return f'{value:9.2f} ({(value - previous_value) / previous_value * 100:+6.1f}%)'
+
+def _git_commit() -> Union[str, None]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=thisdir, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the labbox benchmark suite against fake kachery/hither stand-ins')
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--compare', type=str, default=None, help='Results of a previous run to compare with')
+    parser.add_argument('--latency-msec', type=float, default=0, help='Simulated round trip to the kachery daemon')
+    parser.add_argument('--quick', action='store_true', help='Few trials, as a smoke test')
+    args = parser.parse_args()
+
+    os.environ['FAKE_KACHERY_LATENCY_MSEC'] = str(args.latency_msec)
+    params = {
+        'num_trials': 10 if args.quick else 200,
+        'burst_size': 20 if args.quick else 500,
+        'concurrency': 4 if args.quick else 50,
+        'num_array_values': 100000 if args.quick else 10000000,
+        'latency_msec': args.latency_msec
+    }
+    loop = asyncio.get_event_loop()
+    results: Dict[str, dict] = {}
+    results.update(loop.run_until_complete(run_session_scenarios(params['num_trials'], params['burst_size'])))
+    results.update(loop.run_until_complete(run_websocket_scenarios(params['num_trials'], params['burst_size'], params['num_array_values'])))
+    results.update(loop.run_until_complete(run_websocket_scenarios(params['num_trials'], params['burst_size'], params['num_array_values'], framing='msgpack')))
+    results.update(loop.run_until_complete(run_http_scenarios(params['num_trials'], params['concurrency'])))
+    results.update(run_encoding_scenarios(3 if args.quick else 10, params['num_array_values']))
+
+    output = {
+        'version': 1,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': params,
+        'results': results
+    }
+    for name, s in results.items():
+        print_summary(name, s)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=4)
+    print(f'Wrote {args.output}')
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(output, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,31 @@ from .version import __version__
 
 import os
 import sys
+import importlib
 
-from .api._workersession import WorkerSession, LabboxContext
+# serialize is used as a decorator when extensions are imported, so it is bound right away
+# (the labbox.serialize submodule would otherwise shadow it once imported)
 from .serialize import serialize
+from .memoize import memoize_result
 
-try:
-    from .request_handlers import load_jupyter_server_extension
-except:
-    print('WARNING: unable to import load_jupyter_server_extension - okay if not using jupyterlab')
+# everything else is imported on first use, so that importing labbox does not load
+# hither2, kachery_p2p or the notebook server
+_LAZY_ATTRIBUTES = {
+    'WorkerSession': '.api._workersession',
+    'LabboxContext': '.api._workersession',
+    'JobProgress': '.api._jobprogress',
+    'load_jupyter_server_extension': '.request_handlers'
+}
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_LAZY_ATTRIBUTES.keys()))
 
 dummy = 0
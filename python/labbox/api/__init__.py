@@ -1 +1,30 @@
-from ._session import Session
\ No newline at end of file
+import importlib
+
+# attributes are imported from their submodule on first use, so that using one of them
+# (e.g. Session or get_metrics) does not load kachery_p2p, hither2 and numpy for all the others
+_LAZY_ATTRIBUTES = {
+    **{name: '._session' for name in ['Session', 'prewarm_worker_session']},
+    **{name: '._sessionpool' for name in ['SessionPool', 'PooledSession']},
+    **{name: '._sha1cache' for name in ['Sha1ContentCache', 'Sha1File', 'create_sha1_content_cache_from_env']},
+    **{name: '._kacheryexecutor' for name in ['KacheryExecutor', 'ServerBusyError', 'RequestTimeoutError', 'create_kachery_executor_from_env']},
+    **{name: '._subfeedwatchhub' for name in ['SubfeedWatchHub', 'create_subfeed_watch_hub_from_env']},
+    **{name: '._metrics' for name in ['Metrics', 'get_metrics', 'format_prometheus_text', 'PROMETHEUS_CONTENT_TYPE']},
+    **{name: '._batch' for name in ['InvalidBatchRequestError', 'group_subfeed_requests_by_feed', 'get_messages_for_feed', 'get_messages_batch', 'load_sha1_content_batch']},
+    **{name: '._framing' for name in ['get_websocket_subprotocols', 'encode_messages', 'decode_message', 'SUBPROTOCOL_MSGPACK', 'SUBPROTOCOL_JSON']},
+    **{name: '._feedpool' for name in ['FeedHandlePool', 'create_feed_handle_pool_from_env', 'get_feed_handle_pool']},
+    **{name: '._arrayslice' for name in ['ArraySliceReader', 'InvalidSliceError', 'create_array_slice_reader_from_env', 'parse_slice']},
+    **{name: '._sessionresume' for name in ['SessionRegistry', 'ResumableSession', 'create_session_registry_from_env', 'parse_num_received']},
+    **{name: '._jobprogress' for name in ['JobProgress', 'create_job_progress_channel']},
+    **{name: '._shmpipe' for name in ['SharedMemoryPipe', 'create_shared_memory_pipe_from_env']}
+}
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_LAZY_ATTRIBUTES.keys()))
@@ -0,0 +1,179 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import kachery_p2p as kp
+
+from ..serialize import encode_binary
+from ._sha1cache import IMMUTABLE_CACHE_CONTROL, Sha1ContentCache
+
+_MAX_MANIFESTS = 100
+
+class InvalidSliceError(Exception):
+    # a slice that is malformed, out of range, or too large (400 for the /array endpoints)
+    pass
+
+class ArraySliceReader:
+    """
+    Serves slices of chunked ndarray results (see labbox.serialize.store_chunked_ndarray) for the /array endpoints
+
+    Only the chunks that intersect the requested slice are read, through
+    memory maps of the chunk files in the kachery storage, so the size of the
+    array does not matter, only the size of the slice. Parsed manifests and
+    open chunk maps are kept (LRU) across requests.
+    """
+    def __init__(self, *, sha1_cache: Sha1ContentCache, max_slice_bytes: int, max_open_chunks: int):
+        self._sha1_cache = sha1_cache
+        self._max_slice_bytes = max_slice_bytes
+        self._max_open_chunks = max_open_chunks
+        # manifest sha1 -> parsed manifest
+        self._manifests: OrderedDict = OrderedDict()
+        # (chunk sha1, shape, dtype) -> np.memmap
+        # (identical chunks of arrays with different chunk shapes have the same sha1)
+        self._chunk_maps: OrderedDict = OrderedDict()
+        self._num_requests = 0
+        self._num_chunk_reads = 0
+        self._num_chunk_loads = 0
+        self._num_bytes_served = 0
+        self._lock = threading.Lock()
+    def create_response(self, manifest_sha1: str, slice_str: Union[str, None]) -> Tuple[int, Dict[str, str], Union[bytes, None]]:
+        """
+        Returns (status, headers, body) for an /array request, or (404, {}, None) if the manifest is not found
+
+        The body is the slice as a binary-encoded ndarray (see labbox.serialize.encode_binary).
+        Raises InvalidSliceError if the slice cannot be served.
+        """
+        manifest = self._load_manifest(manifest_sha1)
+        if manifest is None:
+            return 404, {}, None
+        ranges = parse_slice(slice_str, manifest['shape'])
+        x = self._read_slice(manifest, ranges)
+        body = encode_binary(x)
+        with self._lock:
+            self._num_requests += 1
+            self._num_bytes_served += len(body)
+        headers = {
+            # the slice of an immutable array never changes either
+            'ETag': f'"{manifest_sha1}:{format_slice(ranges)}"',
+            'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+            'Content-Type': 'application/octet-stream'
+        }
+        return 200, headers, body
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'numManifests': len(self._manifests),
+                'numOpenChunks': len(self._chunk_maps),
+                'numRequests': self._num_requests,
+                'numChunkReads': self._num_chunk_reads,
+                'numChunkLoads': self._num_chunk_loads,
+                'numBytesServed': self._num_bytes_served
+            }
+    def _load_manifest(self, manifest_sha1: str) -> Union[dict, None]:
+        with self._lock:
+            manifest = self._manifests.get(manifest_sha1, None)
+            if manifest is not None:
+                self._manifests.move_to_end(manifest_sha1)
+                return manifest
+        data = self._sha1_cache.load(manifest_sha1)
+        if data is None:
+            return None
+        try:
+            manifest = json.loads(data)
+        except ValueError:
+            manifest = None
+        if type(manifest) != dict or manifest.get('_type', None) != 'ndarray_chunk_manifest':
+            # no array with this sha1
+            return None
+        if manifest['version'] != 1:
+            raise Exception(f'Unexpected chunked ndarray manifest version: {manifest["version"]}')
+        with self._lock:
+            self._manifests[manifest_sha1] = manifest
+            while len(self._manifests) > _MAX_MANIFESTS:
+                self._manifests.popitem(last=False)
+        return manifest
+    def _read_slice(self, manifest: dict, ranges: List[Tuple[int, int]]) -> np.ndarray:
+        dtype = np.dtype(manifest['dtype']).newbyteorder('<')
+        out_shape = [b - a for a, b in ranges]
+        nbytes = int(np.prod(out_shape, dtype=np.int64)) * dtype.itemsize
+        if nbytes > self._max_slice_bytes:
+            raise InvalidSliceError(f'Slice is too large: {nbytes} > {self._max_slice_bytes} bytes')
+        out = np.zeros(out_shape, dtype=dtype)
+        if nbytes == 0:
+            return out
+        shape = manifest['shape']
+        chunks = manifest['chunks']
+        grid = [(s + c - 1) // c for s, c in zip(shape, chunks)]
+        # only visit the chunks of the grid that intersect the slice
+        lo = [a // c for (a, _), c in zip(ranges, chunks)]
+        hi = [(b - 1) // c + 1 for (_, b), c in zip(ranges, chunks)]
+        for index in np.ndindex(*[h - l for l, h in zip(lo, hi)]):
+            grid_index = [l + i for l, i in zip(lo, index)]
+            chunk_number = int(np.ravel_multi_index(grid_index, grid)) if len(grid) > 0 else 0
+            region = [slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(grid_index, chunks, shape)]
+            chunk = self._get_chunk_map(manifest['chunk_sha1s'][chunk_number], [r.stop - r.start for r in region], dtype)
+            # the intersection, in chunk coordinates and in slice coordinates
+            src = tuple(slice(max(a, r.start) - r.start, min(b, r.stop) - r.start) for (a, b), r in zip(ranges, region))
+            dst = tuple(slice(max(a, r.start) - a, min(b, r.stop) - a) for (a, b), r in zip(ranges, region))
+            out[dst] = chunk[src]
+        return out
+    def _get_chunk_map(self, chunk_sha1: str, chunk_shape: List[int], dtype: np.dtype) -> np.ndarray:
+        key = (chunk_sha1, tuple(chunk_shape), dtype.str)
+        with self._lock:
+            self._num_chunk_reads += 1
+            m = self._chunk_maps.get(key, None)
+            if m is not None:
+                self._chunk_maps.move_to_end(key)
+                return m
+        path = kp.load_file(f'sha1://{chunk_sha1}', p2p=False)
+        if path is None:
+            raise Exception(f'Unable to load array chunk: {chunk_sha1}')
+        # pages are read on demand, so a chunk of which only a few rows are needed costs only those rows
+        m = np.memmap(path, dtype=dtype, mode='r', shape=tuple(chunk_shape))
+        with self._lock:
+            self._num_chunk_loads += 1
+            self._chunk_maps[key] = m
+            while len(self._chunk_maps) > self._max_open_chunks:
+                self._chunk_maps.popitem(last=False)
+        return m
+
+def parse_slice(slice_str: Union[str, None], shape: List[int]) -> List[Tuple[int, int]]:
+    """
+    Parse a slice like '0:100,2000:4000' into one (start, stop) per axis
+
+    Axes that are left out, or given as ':', are taken whole. A single index i
+    is the same as i:i+1 (the axis is kept). Stops beyond the end are clipped.
+    """
+    parts = slice_str.split(',') if slice_str else []
+    if len(parts) > len(shape):
+        raise InvalidSliceError(f'Too many axes in slice: {slice_str}')
+    ranges = []
+    for axis, n in enumerate(shape):
+        part = parts[axis].strip() if axis < len(parts) else ':'
+        try:
+            if ':' in part:
+                a, b = part.split(':')
+                start = int(a) if a.strip() else 0
+                stop = int(b) if b.strip() else n
+            else:
+                start = int(part)
+                stop = start + 1
+        except ValueError:
+            raise InvalidSliceError(f'Invalid slice: {slice_str}')
+        if start < 0 or stop < start or start > n:
+            raise InvalidSliceError(f'Slice out of range for axis {axis} of length {n}: {part}')
+        ranges.append((start, min(stop, n)))
+    return ranges
+
+def format_slice(ranges: List[Tuple[int, int]]) -> str:
+    return ','.join([f'{a}:{b}' for a, b in ranges])
+
+def create_array_slice_reader_from_env(sha1_cache: Sha1ContentCache) -> ArraySliceReader:
+    return ArraySliceReader(
+        sha1_cache=sha1_cache,
+        max_slice_bytes=int(os.environ.get('LABBOX_ARRAY_MAX_SLICE_BYTES', str(256 * 1024 * 1024))),
+        max_open_chunks=int(os.environ.get('LABBOX_ARRAY_MAX_OPEN_CHUNKS', '256'))
+    )
@@ -0,0 +1,77 @@
+import base64
+from typing import Dict, List, Tuple
+
+from ..serialize import is_binary_encoded
+from ._feedpool import get_feed_handle_pool
+from ._sha1cache import Sha1ContentCache
+
+class InvalidBatchRequestError(Exception):
+    # a batch request that is malformed, e.g. without a feed uri (400 for the batch endpoints)
+    pass
+
+def group_subfeed_requests_by_feed(requests: List[dict]) -> Dict[str, List[Tuple[int, dict]]]:
+    """
+    Group the (feedUri, subfeedName, position) requests of a getMessagesBatch call by feed
+
+    Returns feed_uri -> [(index into requests, request), ...] so that each feed is loaded once
+    """
+    ret: Dict[str, List[Tuple[int, dict]]] = {}
+    for i, r in enumerate(requests):
+        feed_uri = r['feedUri']
+        if not feed_uri:
+            raise InvalidBatchRequestError(f'No feedUri in request {i} of batch')
+        if feed_uri not in ret:
+            ret[feed_uri] = []
+        ret[feed_uri].append((i, r))
+    return ret
+
+def get_messages_for_feed(feed_uri: str, items: List[Tuple[int, dict]]) -> Tuple[str, List[list]]:
+    """
+    Returns the feed id and the new messages for each of the (index, request) items of one feed
+    """
+    feed_pool = get_feed_handle_pool()
+    feed_id = None
+    messages = []
+    for _, r in items:
+        feed_id, msgs = feed_pool.get_messages(feed_uri, r['subfeedName'], r['position'])
+        messages.append(msgs)
+    return feed_id, messages
+
+def get_messages_batch(requests: List[dict]) -> List[list]:
+    """
+    Blocking version of getMessagesBatch (no waiting for new messages), in the order of the requests
+    """
+    ret: List[list] = [[] for _ in requests]
+    for feed_uri, items in group_subfeed_requests_by_feed(requests).items():
+        _, messages = get_messages_for_feed(feed_uri, items)
+        for (i, _), msgs in zip(items, messages):
+            ret[i] = msgs
+    return ret
+
+def load_sha1_content_batch(sha1_cache: Sha1ContentCache, sha1s: List[str]) -> List[dict]:
+    """
+    Content of many sha1s for the /sha1/batch endpoint, in the order of sha1s
+
+    Each item is {'sha1', 'content'} where content is None if not found. Binary
+    content (e.g. from labbox.serialize.write_binary) is base64 encoded, with
+    'contentEncoding': 'base64'.
+    """
+    loaded: Dict[str, dict] = {}
+    ret = []
+    for sha1 in sha1s:
+        if sha1 not in loaded:
+            data = sha1_cache.load(sha1)
+            if data is None:
+                loaded[sha1] = {'sha1': sha1, 'content': None}
+            else:
+                loaded[sha1] = _sha1_content_item(sha1, data)
+        ret.append(loaded[sha1])
+    return ret
+
+def _sha1_content_item(sha1: str, data: bytes) -> dict:
+    if not is_binary_encoded(data):
+        try:
+            return {'sha1': sha1, 'content': data.decode('utf-8')}
+        except UnicodeDecodeError:
+            pass
+    return {'sha1': sha1, 'content': base64.b64encode(data).decode('ascii'), 'contentEncoding': 'base64'}
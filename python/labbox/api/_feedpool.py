@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple, Union
+
+import kachery_p2p as kp
+
+_SubfeedKey = Tuple[str, str]
+
+class FeedHandlePool:
+    """
+    Size-bounded pool of open kachery feed and subfeed handles for the feed endpoints
+
+    Clients poll the same few subfeeds over and over, so rather than loading the
+    feed and the subfeed for every request, idle subfeed handles are kept (LRU,
+    at most max_subfeeds of them, dropped after idle_sec) together with their read
+    position. A request for the position where the previous request on the same
+    subfeed left off gets that handle back without repositioning it.
+
+    Appends to the same subfeed are combined: while one append is in flight, the
+    appends that arrive are collected and written with a single append_messages
+    call once it is done (after waiting append_batch_msec, if set, for more).
+    Messages keep the order of the calls.
+    """
+    def __init__(self, *, max_feeds: int, max_subfeeds: int, idle_sec: float, append_batch_msec: float=0):
+        self._max_feeds = max_feeds
+        self._max_subfeeds = max_subfeeds
+        self._idle_sec = idle_sec
+        self._append_batch_sec = append_batch_msec / 1000
+        # feed_uri -> _FeedHandle
+        self._feeds: OrderedDict = OrderedDict()
+        # (feed_uri, subfeed key) -> idle _SubfeedHandles, least recently used first
+        self._subfeeds: OrderedDict = OrderedDict()
+        self._num_idle_subfeeds = 0
+        # (feed_uri, subfeed key) -> _AppendState
+        self._appends: Dict[_SubfeedKey, _AppendState] = {}
+        self._num_feed_loads = 0
+        self._num_subfeed_loads = 0
+        self._num_get_requests = 0
+        self._num_cursor_hits = 0
+        self._num_evictions = 0
+        self._num_append_requests = 0
+        self._num_append_calls = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+    def get_messages(self, feed_uri: str, subfeed_name: Any, position: int) -> Tuple[str, list]:
+        """
+        Returns the feed id and the messages of the subfeed from position on (without waiting for new ones)
+        """
+        key = _subfeed_key(feed_uri, subfeed_name)
+        feed, handle = self._checkout(key, subfeed_name, position)
+        # if this raises, the handle is not returned to the pool, since its position is unknown
+        if handle.position != position:
+            handle.subfeed.set_position(position)
+            handle.position = position
+        messages = handle.subfeed.get_next_messages(wait_msec=0)
+        handle.position = position + len(messages)
+        self._checkin(key, handle)
+        return feed.feed_id, messages
+    def append_messages(self, feed_uri: str, subfeed_name: Any, messages: list):
+        key = _subfeed_key(feed_uri, subfeed_name)
+        with self._lock:
+            self._num_append_requests += 1
+            state = self._appends.get(key, None)
+            if state is None:
+                state = _AppendState()
+                self._appends[key] = state
+            batch = state.pending
+            is_leader = batch is None
+            if is_leader:
+                batch = _AppendBatch()
+                state.pending = batch
+            batch.messages.extend(messages)
+        if not is_leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return
+        if self._append_batch_sec > 0:
+            time.sleep(self._append_batch_sec)
+        with self._cond:
+            # more messages may join the batch while the previous append is still in flight
+            while state.in_flight:
+                self._cond.wait()
+            state.in_flight = True
+            state.pending = None
+            self._num_append_calls += 1
+        try:
+            _, handle = self._checkout(key, subfeed_name, None)
+            handle.subfeed.append_messages(batch.messages)
+            # the read position is not relied upon after writing
+            handle.position = None
+            self._checkin(key, handle)
+        except Exception as err:
+            batch.error = err
+        finally:
+            with self._cond:
+                state.in_flight = False
+                if state.pending is None:
+                    del self._appends[key]
+                self._cond.notify_all()
+            batch.done.set()
+        if batch.error is not None:
+            raise batch.error
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'numFeeds': len(self._feeds),
+                'numIdleSubfeeds': self._num_idle_subfeeds,
+                'numFeedLoads': self._num_feed_loads,
+                'numSubfeedLoads': self._num_subfeed_loads,
+                'numGetRequests': self._num_get_requests,
+                'numCursorHits': self._num_cursor_hits,
+                'numEvictions': self._num_evictions,
+                'numAppendRequests': self._num_append_requests,
+                'numAppendCalls': self._num_append_calls
+            }
+    def _checkout(self, key: _SubfeedKey, subfeed_name: Any, position: Union[int, None]):
+        # returns (feed handle, subfeed handle), the latter is not in the pool until _checkin
+        feed_uri = key[0]
+        with self._lock:
+            now = time.time()
+            self._evict_idle(now)
+            if position is not None:
+                self._num_get_requests += 1
+            feed = self._feeds.get(feed_uri, None)
+            if feed is not None:
+                feed.last_used = now
+                self._feeds.move_to_end(feed_uri)
+            handle = None
+            handles = self._subfeeds.get(key, None)
+            if handles:
+                # prefer the handle that is already at the requested position
+                i = next((j for j, h in enumerate(handles) if h.position == position), len(handles) - 1)
+                handle = handles.pop(i)
+                self._num_idle_subfeeds -= 1
+                if position is not None and handle.position == position:
+                    self._num_cursor_hits += 1
+                if len(handles) == 0:
+                    del self._subfeeds[key]
+        if feed is None:
+            feed = _FeedHandle(kp.load_feed(feed_uri))
+            with self._lock:
+                self._num_feed_loads += 1
+                self._feeds[feed_uri] = feed
+                while len(self._feeds) > self._max_feeds:
+                    self._feeds.popitem(last=False)
+                    self._num_evictions += 1
+        if handle is None:
+            handle = _SubfeedHandle(feed.feed.get_subfeed(subfeed_name))
+            with self._lock:
+                self._num_subfeed_loads += 1
+        return feed, handle
+    def _checkin(self, key: _SubfeedKey, handle: '_SubfeedHandle'):
+        handle.last_used = time.time()
+        with self._lock:
+            handles = self._subfeeds.get(key, None)
+            if handles is None:
+                handles = []
+                self._subfeeds[key] = handles
+            handles.append(handle)
+            self._subfeeds.move_to_end(key)
+            self._num_idle_subfeeds += 1
+            while self._num_idle_subfeeds > self._max_subfeeds:
+                k, hh = next(iter(self._subfeeds.items()))
+                hh.pop(0)
+                self._num_idle_subfeeds -= 1
+                self._num_evictions += 1
+                if len(hh) == 0:
+                    del self._subfeeds[k]
+    def _evict_idle(self, now: float):
+        # the least recently used entries come first
+        while len(self._subfeeds) > 0:
+            k, hh = next(iter(self._subfeeds.items()))
+            if now - hh[-1].last_used < self._idle_sec:
+                break
+            del self._subfeeds[k]
+            self._num_idle_subfeeds -= len(hh)
+            self._num_evictions += len(hh)
+        while len(self._feeds) > 0:
+            k, f = next(iter(self._feeds.items()))
+            if now - f.last_used < self._idle_sec:
+                break
+            del self._feeds[k]
+            self._num_evictions += 1
+
+class _FeedHandle:
+    def __init__(self, feed):
+        self.feed = feed
+        self.feed_id: str = feed.get_feed_id()
+        self.last_used = time.time()
+
+class _SubfeedHandle:
+    def __init__(self, subfeed):
+        self.subfeed = subfeed
+        # None until the position has been set
+        self.position: Union[int, None] = None
+        self.last_used = time.time()
+
+class _AppendBatch:
+    def __init__(self):
+        self.messages: List[Any] = []
+        self.done = threading.Event()
+        self.error: Union[Exception, None] = None
+
+class _AppendState:
+    def __init__(self):
+        self.in_flight = False
+        # the batch that the next appends join, if any
+        self.pending: Union[_AppendBatch, None] = None
+
+def _subfeed_key(feed_uri: str, subfeed_name: Any) -> _SubfeedKey:
+    # subfeed names can be json objects as well as strings
+    if isinstance(subfeed_name, str):
+        return (feed_uri, subfeed_name)
+    return (feed_uri, json.dumps(subfeed_name, sort_keys=True))
+
+def create_feed_handle_pool_from_env() -> FeedHandlePool:
+    return FeedHandlePool(
+        max_feeds=int(os.environ.get('LABBOX_FEED_POOL_MAX_FEEDS', '100')),
+        max_subfeeds=int(os.environ.get('LABBOX_FEED_POOL_MAX_SUBFEEDS', '1000')),
+        idle_sec=float(os.environ.get('LABBOX_FEED_POOL_IDLE_SEC', '300')),
+        append_batch_msec=float(os.environ.get('LABBOX_FEED_APPEND_BATCH_MSEC', '0'))
+    )
+
+_global = {
+    'feed_handle_pool': None
+}
+def get_feed_handle_pool() -> FeedHandlePool:
+    p = _global['feed_handle_pool']
+    if p is None:
+        p = create_feed_handle_pool_from_env()
+        _global['feed_handle_pool'] = p
+    return p
@@ -0,0 +1,39 @@
+import json
+from typing import List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# websocket subprotocols of the session protocol, in order of preference
+# without a subprotocol, messages are sent as json text frames
+SUBPROTOCOL_MSGPACK = 'labbox.msgpack.v1'
+SUBPROTOCOL_JSON = 'labbox.json.v1'
+
+def get_websocket_subprotocols() -> List[str]:
+    """
+    The subprotocols that the websocket server can offer (msgpack only if the msgpack package is installed)
+    """
+    if msgpack is not None:
+        return [SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON]
+    else:
+        return [SUBPROTOCOL_JSON]
+
+def encode_messages(messages: List[dict], subprotocol: Optional[str]) -> Union[str, bytes]:
+    """
+    One websocket frame carrying a list of outgoing messages
+    """
+    if subprotocol == SUBPROTOCOL_MSGPACK:
+        return msgpack.packb(messages, use_bin_type=True)
+    return json.dumps(messages)
+
+def decode_message(frame: Union[str, bytes]) -> dict:
+    """
+    An incoming message: binary frames are msgpack, text frames are json
+    """
+    if isinstance(frame, bytes):
+        if msgpack is None:
+            raise Exception('Received a binary frame, but msgpack is not installed')
+        return msgpack.unpackb(frame, raw=False)
+    return json.loads(frame)
@@ -0,0 +1,32 @@
+import json
+import hashlib
+from typing import Union
+
+# feed and subfeed ids as the kachery daemon computes them, and sha1s of json objects
+# (no hither or kachery imports, so that the http server can use these without them)
+
+def _feed_id_from_uri(uri: str):
+    a = uri.split('/')
+    return a[2]
+
+def _subfeed_hash_from_uri(uri: str):
+    a = uri.split('/')
+    n = a[3]
+    return _subfeed_hash_from_name(n)
+
+def _subfeed_hash_from_name(subfeed_name: Union[str, dict]):
+    if isinstance(subfeed_name, str):
+        if subfeed_name.startswith('~'):
+            return subfeed_name[1:]
+        return _sha1_of_string(subfeed_name)
+    else:
+        return _sha1_of_object(subfeed_name)
+
+def _sha1_of_string(txt: str) -> str:
+    hh = hashlib.sha1(txt.encode('utf-8'))
+    ret = hh.hexdigest()
+    return ret
+
+def _sha1_of_object(obj: object) -> str:
+    txt = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return _sha1_of_string(txt)
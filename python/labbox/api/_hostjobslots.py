@@ -0,0 +1,77 @@
+import os
+import multiprocessing
+from typing import Any, Dict, List, Union
+
+class HostJobSlots:
+    """
+    Bound on the number of hither jobs running at once in all worker processes of the server
+
+    Without a SessionPool every session has a worker process (and job scheduler)
+    of its own, so the budget of each process does not bound the host. The
+    server process creates one semaphore of LABBOX_MAX_HOST_RUNNING_JOBS slots
+    (default os.cpu_count()) and hands it to each worker process it starts, whose
+    scheduler only starts a job once it holds a slot. The slots held by a worker
+    process are counted in shared memory, so that the server can return them if
+    the process dies without doing so itself.
+    """
+    def __init__(self, semaphore: Any, num_held: Any):
+        self._semaphore = semaphore
+        # multiprocessing.Value, written by the worker process
+        self._num_held = num_held
+    def try_acquire(self) -> bool:
+        if not self._semaphore.acquire(block=False):
+            return False
+        with self._num_held.get_lock():
+            self._num_held.value += 1
+        return True
+    def release(self):
+        with self._num_held.get_lock():
+            if self._num_held.value <= 0:
+                return
+            self._num_held.value -= 1
+        self._semaphore.release()
+    def release_all(self):
+        with self._num_held.get_lock():
+            num_held = self._num_held.value
+            self._num_held.value = 0
+        for _ in range(num_held):
+            self._semaphore.release()
+    def get_num_held(self) -> int:
+        return self._num_held.value
+
+_global: Dict[str, Any] = {
+    # semaphore of the server process, created on first use
+    'semaphore': None,
+    # (process, slots) of worker processes that have been started
+    'worker_processes': [],
+    # slots of this worker process (set in the worker process)
+    'host_job_slots': None
+}
+
+def create_host_job_slots_for_worker_process() -> HostJobSlots:
+    # called in the server process, before starting a worker process
+    _reclaim_host_job_slots()
+    if _global['semaphore'] is None:
+        num_slots = int(os.environ.get('LABBOX_MAX_HOST_RUNNING_JOBS', str(os.cpu_count() or 1)))
+        _global['semaphore'] = multiprocessing.BoundedSemaphore(max(1, num_slots))
+    return HostJobSlots(_global['semaphore'], multiprocessing.Value('i', 0))
+
+def register_worker_process(process: Any, host_job_slots: HostJobSlots):
+    _global['worker_processes'].append((process, host_job_slots))
+
+def _reclaim_host_job_slots():
+    # the slots still held by worker processes that have exited (normally they are released on exit)
+    worker_processes: List[tuple] = []
+    for process, host_job_slots in _global['worker_processes']:
+        if process.is_alive():
+            worker_processes.append((process, host_job_slots))
+        else:
+            host_job_slots.release_all()
+    _global['worker_processes'] = worker_processes
+
+def set_host_job_slots(host_job_slots: HostJobSlots):
+    # called in a worker process, before the job scheduler is created
+    _global['host_job_slots'] = host_job_slots
+
+def get_host_job_slots() -> Union[HostJobSlots, None]:
+    return _global['host_job_slots']
@@ -0,0 +1,109 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Union
+
+class JobCoalescer:
+    """
+    Process-wide sharing of hither jobs between identical hitherCreateJob requests
+
+    Jobs are keyed by a hash of function name, function version and kwargs.
+    While a job is running, further requests with the same key attach to it
+    rather than starting another job, and the job is only cancelled once every
+    attached request has been cancelled. The result fields of recently finished
+    jobs of functions marked with @labbox.memoize_result (result_sha1 and
+    friends) are kept in a bounded in-memory LRU, so that repeated requests are
+    answered without running or storing anything.
+
+    Both are per process: they are shared between the sessions of a
+    SessionPool worker process (LABBOX_SESSION_POOL_SIZE), and between the
+    requests of a single session otherwise, since without a pool every
+    session has its own worker process. Across processes, only the hither
+    job cache (labbox.get_job_cache() in a createjob function) avoids
+    running a job again.
+    """
+    def __init__(self, *, max_results: int):
+        self._max_results = max_results
+        # key -> {'job': ..., 'num_attached': ..., 'progress_watch': ...}
+        self._jobs: Dict[str, dict] = {}
+        # key -> result fields of the hitherJobFinished message
+        self._results: OrderedDict = OrderedDict()
+        self._num_jobs_started = 0
+        self._num_jobs_attached = 0
+        self._num_result_hits = 0
+        self._num_result_evictions = 0
+        self._lock = threading.Lock()
+    def get_result(self, key: str) -> Union[dict, None]:
+        with self._lock:
+            result = self._results.get(key, None)
+            if result is not None:
+                self._results.move_to_end(key)
+                self._num_result_hits += 1
+            return result
+    def set_result(self, key: str, result: dict):
+        if self._max_results <= 0:
+            return
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self._max_results:
+                self._results.popitem(last=False)
+                self._num_result_evictions += 1
+    def attach_job(self, key: str) -> Any:
+        """
+        Returns the running job for this key (now attached once more), or None
+        """
+        with self._lock:
+            a = self._jobs.get(key, None)
+            if a is None:
+                return None
+            a['num_attached'] += 1
+            self._num_jobs_attached += 1
+            return a['job']
+    def add_job(self, key: str, job: Any, *, progress_watch: Union[dict, None]=None):
+        with self._lock:
+            self._jobs[key] = {'job': job, 'num_attached': 1, 'progress_watch': progress_watch}
+            self._num_jobs_started += 1
+    def get_progress_watch(self, key: str) -> Union[dict, None]:
+        """
+        The subfeed watch (from the start of the job) of the progress reported by the running job for this key, if any
+        """
+        with self._lock:
+            a = self._jobs.get(key, None)
+            return a['progress_watch'] if a is not None else None
+    def release_job(self, key: str, job: Any) -> bool:
+        """
+        Detaches one request from the job, returning True if it was the last one attached
+        """
+        with self._lock:
+            a = self._jobs.get(key, None)
+            if a is None or a['job'] is not job:
+                return True
+            a['num_attached'] -= 1
+            if a['num_attached'] > 0:
+                return False
+            del self._jobs[key]
+            return True
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'numRunningJobs': len(self._jobs),
+                'numJobsStarted': self._num_jobs_started,
+                'numJobsAttached': self._num_jobs_attached,
+                'numResults': len(self._results),
+                'maxResults': self._max_results,
+                'numResultHits': self._num_result_hits,
+                'numResultEvictions': self._num_result_evictions
+            }
+
+_global = {
+    'job_coalescer': None
+}
+def get_job_coalescer() -> JobCoalescer:
+    c = _global['job_coalescer']
+    if c is None:
+        c = JobCoalescer(
+            max_results=int(os.environ.get('LABBOX_JOB_RESULT_MEMO_SIZE', '1000'))
+        )
+        _global['job_coalescer'] = c
+    return c
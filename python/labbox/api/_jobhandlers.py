@@ -0,0 +1,83 @@
+import os
+import threading
+from typing import Any, Dict
+
+import hither2 as hi2
+
+class LocalJobHandlers:
+    """
+    Local job handler pools shared by all sessions of a process, created on first use
+
+    The number of workers of each handler comes from its num_workers entry in
+    labbox_config['job_handlers']. Handlers without one split the process-wide
+    budget (see get_max_local_workers) evenly between the local handlers of the
+    config, with at least one worker each.
+    """
+    def __init__(self, labbox_config: dict):
+        self._labbox_config = labbox_config
+        self._job_handlers: Dict[str, Any] = {}
+        self._num_workers: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    def get_job_handler(self, job_handler_name: str) -> hi2.JobHandler:
+        job_handler_configs = self._labbox_config['job_handlers']
+        assert job_handler_name in job_handler_configs, f'Job handler not found in config: {job_handler_name}'
+        a = job_handler_configs[job_handler_name]
+        if a['type'] != 'local':
+            raise Exception(f'Unexpected job handler type: {a["type"]}')
+        with self._lock:
+            jh = self._job_handlers.get(job_handler_name, None)
+            if jh is None:
+                num_workers = a.get('num_workers', None)
+                if num_workers is None:
+                    num_workers = self._get_default_num_workers()
+                print(f'======== Creating local job handler: {job_handler_name} ({num_workers} workers)')
+                jh = hi2.ParallelJobHandler(num_workers)
+                self._job_handlers[job_handler_name] = jh
+                self._num_workers[job_handler_name] = num_workers
+            return jh
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'numWorkers': dict(self._num_workers),
+                'totalNumWorkers': sum(self._num_workers.values())
+            }
+    def _get_default_num_workers(self) -> int:
+        num_local_handlers = len([a for a in self._labbox_config['job_handlers'].values() if a['type'] == 'local'])
+        return max(1, get_max_local_workers(self._labbox_config) // max(1, num_local_handlers))
+
+def get_max_local_workers(labbox_config: dict) -> int:
+    """
+    The budget of local job handler workers of this process
+
+    labbox_config['max_local_workers'] if set (per process). Otherwise, in a
+    worker process of a SessionPool, os.cpu_count() split between the worker
+    processes of the pool, so that the host has about one worker per cpu in
+    all. Without a pool, every session has a worker process of its own, with
+    a budget of os.cpu_count(); the jobs running in all of them together are
+    bounded by LABBOX_MAX_HOST_RUNNING_JOBS (see HostJobSlots).
+    """
+    max_local_workers = labbox_config.get('max_local_workers', None)
+    if max_local_workers is None:
+        num_cpus = os.cpu_count() or 1
+        num_pool_workers = _global['num_pool_workers']
+        if num_pool_workers is not None:
+            max_local_workers = max(1, num_cpus // num_pool_workers)
+        else:
+            max_local_workers = num_cpus
+    return max_local_workers
+
+def set_num_pool_workers(num_pool_workers: int):
+    # called in each worker process of a SessionPool, before the job handlers are created
+    _global['num_pool_workers'] = num_pool_workers
+
+_global: Dict[str, Any] = {
+    'local_job_handlers': None,
+    'num_pool_workers': None
+}
+def get_local_job_handlers(labbox_config: dict) -> LocalJobHandlers:
+    h = _global['local_job_handlers']
+    if h is None:
+        # there is one labbox config per server process
+        h = LocalJobHandlers(labbox_config)
+        _global['local_job_handlers'] = h
+    return h
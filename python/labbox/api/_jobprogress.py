@@ -0,0 +1,73 @@
+import os
+import time
+from typing import Any, Dict, Union
+
+import kachery_p2p as kp
+
+# local feed with one subfeed per job that reports progress
+JOB_PROGRESS_FEED_NAME = 'labbox-job-progress'
+
+_global: Dict[str, Any] = {
+    'job_progress_feed_uri': None
+}
+def create_job_progress_channel(subfeed_name: str) -> dict:
+    """
+    The channel (a json-safe dict, so that it can be passed as a hither kwarg) of the subfeed subfeed_name
+    """
+    uri = _global['job_progress_feed_uri']
+    if uri is None:
+        uri = kp.load_feed(JOB_PROGRESS_FEED_NAME, create=True).get_uri()
+        _global['job_progress_feed_uri'] = uri
+    return {'feed_uri': uri, 'subfeed_name': subfeed_name}
+
+class JobProgress:
+    """
+    Reports the progress, and optionally partial results, of a long-running hither function
+
+    The function that creates the job (the one that gets the labbox context)
+    calls labbox.job_progress_channel() and passes the channel on to the hither
+    function, which reports through JobProgress(channel). The reports go to a
+    subfeed that the worker session watches, and reach the clients of the job
+    as hitherJobProgress messages. Partial results are stored like job results:
+    inline when small, otherwise by sha1.
+
+    Reporting is best effort. Without a channel (None), or where the subfeed
+    cannot be written (e.g. on a remote compute resource), reports are dropped.
+    Progress without a partial result is reported at most every min_interval_sec.
+    """
+    def __init__(self, channel: Union[dict, None], *, min_interval_sec: float=0.2):
+        self._channel = channel
+        self._min_interval_sec = min_interval_sec
+        self._subfeed = None
+        self._disabled = channel is None
+        self._last_report_timestamp = 0.0
+        self._inline_max_bytes = int(os.environ.get('LABBOX_INLINE_RESULT_MAX_BYTES', str(8 * 1024)))
+    def report(self, fraction: Union[float, None]=None, *, message: Union[str, None]=None, partial: Any=None):
+        """
+        Report the fraction done (0 to 1), a status message, and/or a partial result
+
+        A partial result is anything that the hither function could return. The
+        client gets the partial results in order, each one once.
+        """
+        if self._disabled:
+            return
+        now = time.time()
+        if partial is None and now - self._last_report_timestamp < self._min_interval_sec and (fraction is None or fraction < 1):
+            return
+        msg: Dict[str, Any] = {'timestamp': now}
+        if fraction is not None:
+            msg['fraction'] = float(fraction)
+        if message is not None:
+            msg['message'] = message
+        try:
+            if partial is not None:
+                from ._workersession import _store_result
+                msg['partial'] = _store_result(partial, inline_max_bytes=self._inline_max_bytes)
+            if self._subfeed is None:
+                self._subfeed = kp.load_feed(self._channel['feed_uri']).get_subfeed(self._channel['subfeed_name'])
+            self._subfeed.append_messages([msg])
+        except Exception as err:
+            print(f'Unable to report job progress, further reports are dropped: {err}')
+            self._disabled = True
+            return
+        self._last_report_timestamp = now
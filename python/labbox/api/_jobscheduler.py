@@ -0,0 +1,141 @@
+import itertools
+from typing import Any, Callable, Dict, List, Set, Union
+
+from ._jobhandlers import get_max_local_workers
+from ._hostjobslots import HostJobSlots, get_host_job_slots
+
+class JobScheduler:
+    """
+    Fair admission of hither jobs from all sessions of a process to the job handlers
+
+    hitherCreateJob requests are queued per session, and a queued job is only
+    started (its hither function called) while fewer than max_running jobs are
+    queued or running in the job handlers. The next job is taken from the session
+    with the fewest running jobs, ties going to the session that started one the
+    longest time ago, so that one session queueing hundreds of jobs cannot starve
+    the others. Within a session, jobs with a higher priority go first, then in
+    order of arrival, or newest first for requests that ask for it.
+
+    The queue of a paused session (one whose client has disconnected, and may
+    resume) is kept but not served, so that it takes no slots from the others.
+
+    There is one scheduler per process, so jobs are shared fairly between the
+    sessions of a process: with a SessionPool, the sessions of a pool worker
+    process. Without a pool, every session has a process (and scheduler) of its own,
+    and host_job_slots bounds the running jobs of all of them together.
+    """
+    def __init__(self, *, max_running: int, host_job_slots: Union[HostJobSlots, None]=None):
+        self._max_running = max_running
+        self._host_job_slots = host_job_slots
+        # session key -> list of queued jobs
+        self._queues: Dict[Any, List[dict]] = {}
+        # {'session_key': ..., 'job': ...}
+        self._running: List[dict] = []
+        self._last_started: Dict[Any, int] = {}
+        self._paused: Set[Any] = set()
+        self._counter = itertools.count()
+        self._num_started = 0
+        self._num_cancelled = 0
+        self._total_queue_wait_sec = 0.0
+        self._max_queue_wait_sec = 0.0
+        self._num_waits_for_host_slot = 0
+    def submit(self, session_key: Any, job_id: str, *, priority: float, newest_first: bool, timestamp: float, start: Callable[[float], Any]):
+        """
+        Queues a job, where start(queue_wait_sec) starts it and returns the hither job, if any
+
+        start may return None when there was nothing to run (for example if the
+        function returned its result directly); the job then takes no slot.
+        """
+        seq = next(self._counter)
+        self._queues.setdefault(session_key, []).append({
+            'job_id': job_id,
+            'order': (-priority, -seq if newest_first else seq),
+            'timestamp': timestamp,
+            'start': start
+        })
+    def cancel(self, session_key: Any, job_id: str) -> bool:
+        """
+        Removes a queued job, returning False if it is not (or no longer) queued
+        """
+        queue = self._queues.get(session_key, [])
+        for i, a in enumerate(queue):
+            if a['job_id'] == job_id:
+                del queue[i]
+                self._num_cancelled += 1
+                if len(queue) == 0:
+                    del self._queues[session_key]
+                return True
+        return False
+    def remove_session(self, session_key: Any):
+        queue = self._queues.pop(session_key, [])
+        self._num_cancelled += len(queue)
+        if session_key in self._last_started:
+            del self._last_started[session_key]
+        self._paused.discard(session_key)
+    def pause_session(self, session_key: Any):
+        # queued jobs stay queued, running jobs keep running
+        self._paused.add(session_key)
+    def resume_session(self, session_key: Any):
+        self._paused.discard(session_key)
+    def dispatch(self, now: float):
+        running = []
+        for r in self._running:
+            if r['job'].status not in ['finished', 'error']:
+                running.append(r)
+            elif self._host_job_slots is not None:
+                self._host_job_slots.release()
+        self._running = running
+        while len(self._running) < self._max_running:
+            session_keys = [k for k in self._queues.keys() if k not in self._paused]
+            if len(session_keys) == 0:
+                break
+            if self._host_job_slots is not None and not self._host_job_slots.try_acquire():
+                # the other worker processes of the host are running as many jobs as it has slots
+                self._num_waits_for_host_slot += 1
+                break
+            num_running_by_session: Dict[Any, int] = {}
+            for r in self._running:
+                num_running_by_session[r['session_key']] = num_running_by_session.get(r['session_key'], 0) + 1
+            session_key = min(session_keys, key=lambda k: (num_running_by_session.get(k, 0), self._last_started.get(k, -1)))
+            queue = self._queues[session_key]
+            a = min(queue, key=lambda a: a['order'])
+            queue.remove(a)
+            if len(queue) == 0:
+                del self._queues[session_key]
+            self._last_started[session_key] = next(self._counter)
+            queue_wait_sec = max(0.0, now - a['timestamp'])
+            self._num_started += 1
+            self._total_queue_wait_sec += queue_wait_sec
+            self._max_queue_wait_sec = max(self._max_queue_wait_sec, queue_wait_sec)
+            job = a['start'](queue_wait_sec)
+            if job is not None:
+                self._running.append({'session_key': session_key, 'job': job})
+            elif self._host_job_slots is not None:
+                self._host_job_slots.release()
+    def get_stats(self) -> dict:
+        return {
+            'numQueued': sum([len(q) for q in self._queues.values()]),
+            'numRunning': len(self._running),
+            'numPausedSessions': len(self._paused),
+            'maxRunning': self._max_running,
+            'numHostSlotsHeld': self._host_job_slots.get_num_held() if self._host_job_slots is not None else None,
+            'numWaitsForHostSlot': self._num_waits_for_host_slot,
+            'numStarted': self._num_started,
+            'numCancelled': self._num_cancelled,
+            'meanQueueWaitSec': self._total_queue_wait_sec / self._num_started if self._num_started > 0 else 0,
+            'maxQueueWaitSec': self._max_queue_wait_sec
+        }
+
+_global = {
+    'job_scheduler': None
+}
+def get_job_scheduler(labbox_config: dict) -> JobScheduler:
+    s = _global['job_scheduler']
+    if s is None:
+        max_running = labbox_config.get('max_running_jobs', None)
+        if max_running is None:
+            max_running = get_max_local_workers(labbox_config)
+        # set in the worker processes of a server without a session pool
+        s = JobScheduler(max_running=max_running, host_job_slots=get_host_job_slots())
+        _global['job_scheduler'] = s
+    return s
@@ -0,0 +1,103 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+class ServerBusyError(Exception):
+    def __init__(self, endpoint: str, retry_after_sec: int):
+        super().__init__(f'Server busy: {endpoint}')
+        self.retry_after_sec = retry_after_sec
+
+class RequestTimeoutError(Exception):
+    pass
+
+class KacheryExecutor:
+    """
+    Runs blocking kachery calls in a bounded thread pool on behalf of async request handlers
+
+    Each endpoint has its own concurrency limit. Requests waiting for a slot count
+    toward the endpoint's queue depth; beyond max_queue_depth (or if no slot frees up
+    within timeout_sec) a ServerBusyError is raised, which the server turns into a
+    503 with Retry-After. A call that is running longer than timeout_sec raises
+    RequestTimeoutError, but keeps its slot until the thread is actually done.
+    """
+    def __init__(self, *, max_threads: int, endpoint_concurrency: Dict[str, int], max_queue_depth: int, timeout_sec: float, retry_after_sec: int=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='kachery')
+        self._max_threads = max_threads
+        self._endpoint_concurrency = endpoint_concurrency
+        self._max_queue_depth = max_queue_depth
+        self._timeout_sec = timeout_sec
+        self._retry_after_sec = retry_after_sec
+        self._endpoints: Dict[str, _Endpoint] = {}
+    async def run(self, endpoint: str, fn: Callable, *args, **kwargs):
+        e = self._get_endpoint(endpoint)
+        if e.num_queued >= self._max_queue_depth:
+            e.num_rejected += 1
+            raise ServerBusyError(endpoint, self._retry_after_sec)
+        e.num_queued += 1
+        try:
+            await asyncio.wait_for(e.semaphore.acquire(), timeout=self._timeout_sec)
+        except asyncio.TimeoutError:
+            e.num_rejected += 1
+            raise ServerBusyError(endpoint, self._retry_after_sec)
+        finally:
+            e.num_queued -= 1
+        e.num_running += 1
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        def on_done(f):
+            e.num_running -= 1
+            e.semaphore.release()
+            if not f.cancelled():
+                # so that an exception after a timeout is not reported as never retrieved
+                f.exception()
+        future.add_done_callback(on_done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self._timeout_sec)
+        except asyncio.TimeoutError:
+            e.num_timeouts += 1
+            raise RequestTimeoutError(f'Timeout in {endpoint}')
+    def get_stats(self) -> dict:
+        return {
+            'maxThreads': self._max_threads,
+            'endpoints': {
+                name: {
+                    'concurrency': e.concurrency,
+                    'numRunning': e.num_running,
+                    'numQueued': e.num_queued,
+                    'numRejected': e.num_rejected,
+                    'numTimeouts': e.num_timeouts
+                }
+                for name, e in self._endpoints.items()
+            }
+        }
+    def _get_endpoint(self, endpoint: str) -> '_Endpoint':
+        e = self._endpoints.get(endpoint, None)
+        if e is None:
+            e = _Endpoint(concurrency=self._endpoint_concurrency.get(endpoint, self._max_threads))
+            self._endpoints[endpoint] = e
+        return e
+
+class _Endpoint:
+    def __init__(self, *, concurrency: int):
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.num_running = 0
+        self.num_queued = 0
+        self.num_rejected = 0
+        self.num_timeouts = 0
+
+def create_kachery_executor_from_env() -> KacheryExecutor:
+    # LABBOX_KACHERY_ENDPOINT_CONCURRENCY is a comma-separated list, e.g. sha1=16,feedGetMessages=16
+    endpoint_concurrency: Dict[str, int] = {}
+    for a in os.environ.get('LABBOX_KACHERY_ENDPOINT_CONCURRENCY', '').split(','):
+        if a.strip():
+            name, val = a.split('=')
+            endpoint_concurrency[name.strip()] = int(val)
+    return KacheryExecutor(
+        max_threads=int(os.environ.get('LABBOX_KACHERY_MAX_THREADS', '32')),
+        endpoint_concurrency=endpoint_concurrency,
+        max_queue_depth=int(os.environ.get('LABBOX_KACHERY_MAX_QUEUE_DEPTH', '256')),
+        timeout_sec=float(os.environ.get('LABBOX_KACHERY_TIMEOUT_SEC', '30'))
+    )
@@ -0,0 +1,186 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds in seconds, from sub-millisecond message handling up to long-running jobs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_METRIC_HELP = {
+    'labbox_message_handling_seconds': 'Time to handle an incoming session message in the worker process',
+    'labbox_job_queue_wait_seconds': 'Time a hither job waited in the job scheduler',
+    'labbox_job_run_seconds': 'Time from starting a hither job to it finishing',
+    'labbox_result_encode_seconds': 'Time to encode a job result',
+    'labbox_result_store_seconds': 'Time to store an encoded job result in kachery',
+    'labbox_results_total': 'Job results sent, by how they were delivered',
+    'labbox_sessions': 'Live sessions',
+    'labbox_active_jobs': 'Queued and running hither jobs of live sessions',
+    'labbox_pending_subfeed_requests': 'Pending subfeed message requests of live sessions',
+    'labbox_pipe_messages_total': 'Objects sent over the pipes between sessions and worker processes',
+    'labbox_pipe_shm_messages_total': 'Objects sent through shared memory in place of the pipes between sessions and worker processes',
+    'labbox_pipe_shm_bytes_total': 'Bytes of the shared memory segments of those messages',
+    'labbox_session_messages_total': 'Session protocol messages passed between sessions and worker processes',
+    'labbox_session_failures_total': 'Sessions of a session pool worker process ended by an error in the session',
+    'labbox_pool_worker_restarts_total': 'Session pool worker processes that had died and were replaced',
+    'labbox_websocket_connections': 'Open websocket connections',
+    'labbox_http_request_seconds': 'Time to answer an http request',
+    'labbox_http_responses_total': 'Http responses by status code',
+    'labbox_feed_pool_idle_subfeeds': 'Idle subfeed handles kept by the feed handle pool',
+    'labbox_feed_pool_cursor_hits_total': 'Feed message requests answered by a subfeed handle already at the requested position',
+    'labbox_feed_pool_loads_total': 'Feeds and subfeeds loaded by the feed handle pool',
+    'labbox_feed_append_calls_total': 'Calls to append messages to subfeeds, after combining concurrent appends',
+    'labbox_array_chunk_reads_total': 'Chunks read to answer /array slice requests',
+    'labbox_array_bytes_served_total': 'Bytes of array slices served by /array',
+    'labbox_detached_sessions': 'Sessions whose connection dropped, kept for the client to resume',
+    'labbox_job_progress_messages_total': 'hitherJobProgress messages sent for progress reported by running jobs',
+    'labbox_session_resumes_total': 'Attempts to resume a session, by result (resumed, incomplete, unknown) and detached sessions that expired'
+}
+
+_LabelsKey = Tuple[Tuple[str, str], ...]
+_MetricKey = Tuple[str, _LabelsKey]
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of one process
+
+    Metrics are created on first use and identified by name and labels. Worker
+    processes send snapshot() to the server process, which exports the combination
+    of all snapshots with format_prometheus_text. Histograms use fixed buckets, so
+    memory stays bounded however long the server runs.
+    """
+    def __init__(self):
+        self._counters: Dict[_MetricKey, float] = {}
+        self._gauges: Dict[_MetricKey, float] = {}
+        # key -> [bucket counts..., sum, count]
+        self._histograms: Dict[_MetricKey, List[float]] = {}
+        self._lock = threading.Lock()
+    def inc(self, name: str, value: float=1, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    def set_counter(self, name: str, value: float, **labels):
+        # for totals that are counted elsewhere
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = value
+    def set_gauge(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+    def observe(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            h = self._histograms.get(key, None)
+            if h is None:
+                h = [0] * (len(LATENCY_BUCKETS) + 2)
+                self._histograms[key] = h
+            for i, le in enumerate(LATENCY_BUCKETS):
+                if value <= le:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+    @contextmanager
+    def time(self, name: str, **labels):
+        timer = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - timer, **labels)
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {k: list(h) for k, h in self._histograms.items()}
+            }
+    def merge(self, snapshot: dict):
+        """
+        Adds the counters and histograms of a snapshot, e.g. the last one of a worker process that has exited
+        """
+        with self._lock:
+            _add_snapshot(self._counters, self._histograms, snapshot)
+
+def format_prometheus_text(snapshots: List[dict]) -> str:
+    """
+    Prometheus text exposition of the combined snapshots (values of the same metric add up)
+    """
+    counters: Dict[_MetricKey, float] = {}
+    gauges: Dict[_MetricKey, float] = {}
+    histograms: Dict[_MetricKey, List[float]] = {}
+    for snapshot in snapshots:
+        _add_snapshot(counters, histograms, snapshot)
+        for key, value in snapshot['gauges'].items():
+            gauges[key] = gauges.get(key, 0) + value
+    lines: List[str] = []
+    for metric_type, values in [('counter', counters), ('gauge', gauges)]:
+        for name, items in _group_by_name(values).items():
+            _append_header(lines, name, metric_type)
+            for labels, value in items:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    for name, items in _group_by_name(histograms).items():
+        _append_header(lines, name, 'histogram')
+        for labels, h in items:
+            cumulative = 0
+            for i, le in enumerate(LATENCY_BUCKETS):
+                cumulative += h[i]
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(le)),))} {_format_value(cumulative)}')
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {_format_value(h[-1])}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(h[-2])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {_format_value(h[-1])}')
+    return '\n'.join(lines) + '\n'
+
+def _metric_key(name: str, labels: dict) -> _MetricKey:
+    return (name, tuple(sorted([(k, str(v)) for k, v in labels.items()])))
+
+def _add_snapshot(counters: dict, histograms: dict, snapshot: dict):
+    for key, value in snapshot['counters'].items():
+        counters[key] = counters.get(key, 0) + value
+    for key, h in snapshot['histograms'].items():
+        h0 = histograms.get(key, None)
+        if h0 is None:
+            histograms[key] = list(h)
+        else:
+            for i in range(len(h)):
+                h0[i] += h[i]
+
+def _group_by_name(values: dict) -> Dict[str, list]:
+    ret: Dict[str, list] = {}
+    for (name, labels), value in sorted(values.items()):
+        ret.setdefault(name, []).append((labels, value))
+    return ret
+
+def _append_header(lines: List[str], name: str, metric_type: str):
+    if name in _METRIC_HELP:
+        lines.append(f'# HELP {name} {_METRIC_HELP[name]}')
+    lines.append(f'# TYPE {name} {metric_type}')
+
+def _format_labels(labels: _LabelsKey) -> str:
+    if len(labels) == 0:
+        return ''
+    a = ','.join([f'{k}="{_escape_label_value(v)}"' for k, v in labels])
+    return '{' + a + '}'
+
+def _escape_label_value(v: str) -> str:
+    return v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(v: float) -> str:
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+_global = {
+    'metrics': None,
+    'pid': None
+}
+def get_metrics() -> Metrics:
+    m = _global['metrics']
+    # a forked worker process starts from zero rather than from a copy of the metrics of its parent
+    if m is None or _global['pid'] != os.getpid():
+        m = Metrics()
+        _global['metrics'] = m
+        _global['pid'] = os.getpid()
+    return m
@@ -1,27 +1,82 @@
+import json
 import time
+import atexit
+import asyncio
 import multiprocessing
+import multiprocessing.connection
+from typing import Any, Dict, Tuple, Union
+
+from ._metrics import get_metrics
+from ._shmpipe import create_shared_memory_pipe_from_env
+from ._hostjobslots import create_host_job_slots_for_worker_process, register_worker_process
+
+_global: Dict[str, Any] = {
+    # (config, default feed name, event driven) -> (process, pipe) of a spare worker process
+    'spare_workers': {}
+}
+
+def prewarm_worker_session(*, labbox_config, default_feed_name: str, event_driven: bool=False):
+    """
+    Starts a spare worker process for the next Session created with the same arguments
+
+    The spare does its imports and creates its WorkerSession ahead of time, and then
+    waits; a new Session takes it over and only has to send it 'start'. Each takeover
+    starts the next spare, so that there is always one ready.
+    """
+    key = _spare_worker_key(labbox_config, default_feed_name, event_driven)
+    spare = _global['spare_workers'].get(key, None)
+    if spare is not None and spare[0].is_alive():
+        return
+    if len(_global['spare_workers']) == 0:
+        # runs before multiprocessing joins its child processes at exit, which would wait for the spares forever
+        atexit.register(_stop_spare_workers)
+    _global['spare_workers'][key] = _start_worker_process(labbox_config, default_feed_name, event_driven, wait_for_start=True)
 
 class Session:
-    def __init__(self, *, labbox_config, default_feed_name: str):
+    def __init__(self, *, labbox_config, default_feed_name: str, event_driven: bool=False):
         self._labbox_config = labbox_config
 
-        pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
-        self._worker_process =  multiprocessing.Process(target=_run_worker_session, args=(pipe_to_parent, labbox_config, default_feed_name))
-        self._worker_process.start()
-        self._pipe_to_worker_process = pipe_to_child
+        key = _spare_worker_key(labbox_config, default_feed_name, event_driven)
+        spare = _global['spare_workers'].pop(key, None)
+        if spare is not None and spare[0].is_alive():
+            self._worker_process, self._pipe_to_worker_process = spare
+            self._pipe_to_worker_process.send('start')
+            prewarm_worker_session(labbox_config=labbox_config, default_feed_name=default_feed_name, event_driven=event_driven)
+        else:
+            self._worker_process, self._pipe_to_worker_process = _start_worker_process(labbox_config, default_feed_name, event_driven, wait_for_start=False)
+            if spare is not None:
+                # the spare died (e.g. the daemon was not reachable), so try again for the next session
+                prewarm_worker_session(labbox_config=labbox_config, default_feed_name=default_feed_name, event_driven=event_driven)
         self._incoming_keepalive_timestamp = time.time()
+        # latest metrics snapshot reported by the worker process
+        self._worker_metrics: Union[dict, None] = None
     def elapsed_sec_since_incoming_keepalive(self):
         return time.time() - self._incoming_keepalive_timestamp
     def cleanup(self):
-        self._pipe_to_worker_process.send('exit')
-        pass
+        try:
+            self._pipe_to_worker_process.send('exit')
+        except (BrokenPipeError, OSError):
+            # the worker process has died already
+            pass
+        self._pipe_to_worker_process.release_shared_memory()
+        if self._worker_metrics is not None:
+            # keep the totals of the worker process, which is about to exit
+            get_metrics().merge(self._worker_metrics)
+            self._worker_metrics = None
+    def get_metrics_snapshot(self) -> Union[dict, None]:
+        return self._worker_metrics
     def check_for_outgoing_messages(self):
         ret = []
+        metrics = get_metrics()
         while self._pipe_to_worker_process.poll():
             msg = self._pipe_to_worker_process.recv()
+            metrics.inc('labbox_pipe_messages_total', direction='from_worker')
             if isinstance(msg, dict):
                 if msg['type'] == 'outgoing_messages':
                     ret.extend(msg['messages'])
+                    metrics.inc('labbox_session_messages_total', len(msg['messages']), direction='outgoing')
+                elif msg['type'] == 'metrics':
+                    self._worker_metrics = msg['metrics']
                 else:
                     print(msg)
                     raise Exception('Unexpected message from worker session')
@@ -29,6 +84,11 @@ class Session:
                 print(msg)
                 raise Exception('Unexpected message from worker session')
         return ret
+    async def wait_for_outgoing_messages(self, *, timeout_sec: float):
+        # returns as soon as the worker process has sent something (or on timeout)
+        if self._pipe_to_worker_process.poll():
+            return
+        await _wait_for_readable(self._pipe_to_worker_process.fileno(), timeout_sec=timeout_sec)
     def handle_message(self, msg):
         if msg['type'] == 'keepAlive':
             self._handle_keepalive()
@@ -37,12 +97,69 @@ class Session:
                 type='incoming_message',
                 message=msg
             ))
+            metrics = get_metrics()
+            metrics.inc('labbox_pipe_messages_total', direction='to_worker')
+            metrics.inc('labbox_session_messages_total', direction='incoming')
     def _handle_keepalive(self):
         self._incoming_keepalive_timestamp = time.time()
 
-def _run_worker_session(pipe_to_parent, labbox_config, default_feed_name: str):
-    from ._workersession import WorkerSession
+async def _wait_for_readable(fd: int, *, timeout_sec: float):
+    loop = asyncio.get_event_loop()
+    readable = loop.create_future()
+    def on_readable():
+        if not readable.done():
+            readable.set_result(True)
+    loop.add_reader(fd, on_readable)
+    try:
+        await asyncio.wait_for(readable, timeout=timeout_sec)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fd)
+
+def _stop_spare_workers():
+    for _, pipe in _global['spare_workers'].values():
+        try:
+            pipe.send('exit')
+        except (BrokenPipeError, OSError):
+            pass
+    _global['spare_workers'] = {}
+
+def _spare_worker_key(labbox_config, default_feed_name: str, event_driven: bool) -> Tuple[str, str, bool]:
+    return (json.dumps(labbox_config, sort_keys=True), default_feed_name, event_driven)
+
+def _start_worker_process(labbox_config, default_feed_name: str, event_driven: bool, *, wait_for_start: bool):
+    # large messages (e.g. the kwargs of a job, or a batch of outgoing messages) go through shared memory
+    pipe_to_parent, pipe_to_child = create_shared_memory_pipe_from_env()
+    # the jobs of all sessions share the cpus of the host
+    host_job_slots = create_host_job_slots_for_worker_process()
+    # not daemonic, since the job handlers of the worker session start processes of their own
+    worker_process = multiprocessing.Process(target=_run_worker_session, args=(pipe_to_parent, labbox_config, default_feed_name, event_driven, wait_for_start, host_job_slots))
+    worker_process.start()
+    register_worker_process(worker_process, host_job_slots)
+    return worker_process, pipe_to_child
+
+def _run_worker_session(pipe_to_parent, labbox_config, default_feed_name: str, event_driven: bool, wait_for_start: bool=False, host_job_slots=None):
+    from ._hostjobslots import set_host_job_slots
+    if host_job_slots is not None:
+        set_host_job_slots(host_job_slots)
+    try:
+        _run_worker_session_loop(pipe_to_parent, labbox_config, default_feed_name, event_driven, wait_for_start)
+    finally:
+        if host_job_slots is not None:
+            host_job_slots.release_all()
+
+def _run_worker_session_loop(pipe_to_parent, labbox_config, default_feed_name: str, event_driven: bool, wait_for_start: bool):
+    from ._workersession import WorkerSession, update_worker_metrics
+    from ._workerwakeup import WorkerWakeup
     WS = WorkerSession(labbox_config=labbox_config, default_feed_name=default_feed_name)
+    if wait_for_start:
+        # a spare worker process, until a Session takes it over (or the server exits)
+        parent = multiprocessing.parent_process()
+        ready = multiprocessing.connection.wait([pipe_to_parent] + ([parent.sentinel] if parent is not None else []))
+        if pipe_to_parent not in ready or pipe_to_parent.recv() != 'start':
+            return
+    wakeup = WorkerWakeup(get_worker_sessions=lambda: [WS]) if event_driven else None
     def handle_messages(msgs):
         pipe_to_parent.send(dict(
             type='outgoing_messages',
@@ -50,12 +167,14 @@ def _run_worker_session(pipe_to_parent, labbox_config, default_feed_name: str):
         ))
     WS.on_messages(handle_messages)
     WS.initialize()
+    last_metrics_report_timestamp = 0
     while True:
         while pipe_to_parent.poll():
             x = pipe_to_parent.recv()
             if isinstance(x, str):
                 if x == 'exit':
                     WS.cleanup()
+                    pipe_to_parent.close()
                     return
                 else:
                     print(x)
@@ -69,5 +188,19 @@ def _run_worker_session(pipe_to_parent, labbox_config, default_feed_name: str):
             else:
                 print(x)
                 raise Exception('Unexpected message in _run_worker_session')
-        WS.iterate()
-        time.sleep(0.05)
+        if wakeup is None:
+            WS.iterate()
+        else:
+            wakeup.notify_subfeed_message_requests_changed()
+            WS.iterate(subfeed_wait_msec=0)
+        if time.time() - last_metrics_report_timestamp > 2:
+            update_worker_metrics([WS])
+            pipe_to_parent.send(dict(
+                type='metrics',
+                metrics=get_metrics().snapshot()
+            ))
+            last_metrics_report_timestamp = time.time()
+        if wakeup is not None:
+            wakeup.wait(pipe_to_parent)
+        else:
+            time.sleep(0.05)
@@ -0,0 +1,331 @@
+import time
+import random
+import traceback
+import asyncio
+import multiprocessing
+from typing import Any, Dict, List
+
+from ._metrics import get_metrics
+from ._shmpipe import create_shared_memory_pipe_from_env
+
+class SessionPool:
+    """
+    A fixed pool of worker processes shared by many sessions
+
+    Instead of starting one worker process per websocket connection (see Session),
+    each session is assigned to the least loaded worker process when it is created,
+    and all of its messages are routed to that worker by session id.
+
+    An error in one session ends only that session. A worker process that has
+    died (and with it its sessions) is replaced before the next session is assigned.
+    """
+    def __init__(self, *, labbox_config, default_feed_name: str, num_workers: int, event_driven: bool=False):
+        assert num_workers >= 1, 'Session pool must have at least one worker'
+        self._labbox_config = labbox_config
+        self._default_feed_name = default_feed_name
+        self._event_driven = event_driven
+        self._workers: List[_PoolWorker] = [
+            _PoolWorker(worker_index=i, num_workers=num_workers, labbox_config=labbox_config, default_feed_name=default_feed_name, event_driven=event_driven)
+            for i in range(num_workers)
+        ]
+    def create_session(self):
+        self._replace_dead_workers()
+        session_id = _random_string(10)
+        worker = min(self._workers, key=lambda w: w.num_sessions)
+        worker.create_session(session_id)
+        return PooledSession(session_id=session_id, worker=worker)
+    def get_load(self) -> List[dict]:
+        return [w.get_load() for w in self._workers]
+    def get_metrics_snapshots(self) -> List[dict]:
+        # as last reported by each worker process
+        return [w.get_metrics_snapshot() for w in self._workers if w.get_metrics_snapshot() is not None]
+    def cleanup(self):
+        for w in self._workers:
+            w.cleanup()
+    def _replace_dead_workers(self):
+        for i, w in enumerate(self._workers):
+            if not w.is_alive():
+                print(f'Session pool worker {i} has died. Starting a new one.')
+                w.cleanup()
+                if w.get_metrics_snapshot() is not None:
+                    # keep the totals last reported by the dead worker process
+                    get_metrics().merge(w.get_metrics_snapshot())
+                self._workers[i] = _PoolWorker(worker_index=i, num_workers=len(self._workers), labbox_config=self._labbox_config, default_feed_name=self._default_feed_name, event_driven=self._event_driven)
+                get_metrics().inc('labbox_pool_worker_restarts_total')
+
+class PooledSession:
+    """
+    Same interface as Session, but backed by a worker process of a SessionPool
+    """
+    def __init__(self, *, session_id: str, worker: '_PoolWorker'):
+        self._session_id = session_id
+        self._worker = worker
+        self._incoming_keepalive_timestamp = time.time()
+    @property
+    def session_id(self):
+        return self._session_id
+    def elapsed_sec_since_incoming_keepalive(self):
+        return time.time() - self._incoming_keepalive_timestamp
+    def cleanup(self):
+        self._worker.cleanup_session(self._session_id)
+    def check_for_outgoing_messages(self):
+        return self._worker.check_for_outgoing_messages(self._session_id)
+    async def wait_for_outgoing_messages(self, *, timeout_sec: float):
+        await self._worker.wait_for_outgoing_messages(self._session_id, timeout_sec=timeout_sec)
+    def handle_message(self, msg):
+        if msg['type'] == 'keepAlive':
+            self._handle_keepalive()
+        else:
+            self._worker.send_incoming_message(self._session_id, msg)
+    def _handle_keepalive(self):
+        self._incoming_keepalive_timestamp = time.time()
+
+class _PoolWorker:
+    def __init__(self, *, worker_index: int, num_workers: int, labbox_config, default_feed_name: str, event_driven: bool):
+        self._worker_index = worker_index
+        pipe_to_parent, pipe_to_child = create_shared_memory_pipe_from_env()
+        self._worker_process = multiprocessing.Process(target=_run_pool_worker, args=(pipe_to_parent, labbox_config, default_feed_name, event_driven, num_workers))
+        self._worker_process.start()
+        self._pipe_to_worker_process = pipe_to_child
+        self._outgoing_messages_by_session_id: Dict[str, List[dict]] = {}
+        # for event-driven mode: one reader on the pipe shared by all sessions of this worker
+        self._outgoing_message_events_by_session_id: Dict[str, asyncio.Event] = {}
+        self._reader_loop = None
+        self._reported_load: Dict[str, Any] = {'num_jobs': 0, 'num_subfeed_message_requests': 0}
+        # set when the pipe to the worker process is broken
+        self._dead = False
+    @property
+    def num_sessions(self):
+        return len(self._outgoing_messages_by_session_id)
+    def is_alive(self) -> bool:
+        return (not self._dead) and self._worker_process.is_alive()
+    def create_session(self, session_id: str):
+        self._outgoing_messages_by_session_id[session_id] = []
+        self._send(dict(
+            type='create_session',
+            session_id=session_id
+        ))
+    def cleanup_session(self, session_id: str):
+        if session_id not in self._outgoing_messages_by_session_id:
+            return
+        del self._outgoing_messages_by_session_id[session_id]
+        if session_id in self._outgoing_message_events_by_session_id:
+            del self._outgoing_message_events_by_session_id[session_id]
+        self._send(dict(
+            type='cleanup_session',
+            session_id=session_id
+        ))
+    def send_incoming_message(self, session_id: str, msg: dict):
+        self._send(dict(
+            type='incoming_message',
+            session_id=session_id,
+            message=msg
+        ))
+        get_metrics().inc('labbox_session_messages_total', direction='incoming')
+    def check_for_outgoing_messages(self, session_id: str):
+        self._receive_from_worker_process()
+        if session_id not in self._outgoing_messages_by_session_id:
+            return []
+        ret = self._outgoing_messages_by_session_id[session_id]
+        self._outgoing_messages_by_session_id[session_id] = []
+        return ret
+    async def wait_for_outgoing_messages(self, session_id: str, *, timeout_sec: float):
+        self._ensure_reader()
+        if len(self._outgoing_messages_by_session_id.get(session_id, [])) > 0:
+            return
+        if session_id not in self._outgoing_message_events_by_session_id:
+            self._outgoing_message_events_by_session_id[session_id] = asyncio.Event()
+        event = self._outgoing_message_events_by_session_id[session_id]
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout_sec)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+    def _ensure_reader(self):
+        if self._reader_loop is not None:
+            return
+        self._reader_loop = asyncio.get_event_loop()
+        self._reader_loop.add_reader(self._pipe_to_worker_process.fileno(), self._on_pipe_readable)
+    def _on_pipe_readable(self):
+        self._receive_from_worker_process()
+        for session_id, event in self._outgoing_message_events_by_session_id.items():
+            if len(self._outgoing_messages_by_session_id.get(session_id, [])) > 0:
+                event.set()
+    def get_load(self):
+        return {
+            'worker_index': self._worker_index,
+            'pid': self._worker_process.pid,
+            'alive': self.is_alive(),
+            'num_sessions': self.num_sessions,
+            'num_jobs': self._reported_load['num_jobs'],
+            'num_subfeed_message_requests': self._reported_load['num_subfeed_message_requests'],
+            'subfeed_watches': self._reported_load.get('subfeed_watches', None),
+            'jobs': self._reported_load.get('jobs', None),
+            'job_handlers': self._reported_load.get('job_handlers', None),
+            'job_scheduler': self._reported_load.get('job_scheduler', None)
+        }
+    def get_metrics_snapshot(self) -> Any:
+        return self._reported_load.get('metrics', None)
+    def cleanup(self):
+        self._remove_reader()
+        if not self._dead:
+            self._send('exit')
+        self._pipe_to_worker_process.release_shared_memory()
+    def _send(self, x: Any):
+        if self._dead:
+            # the sessions of a dead worker process get no more messages, as when the worker process of a Session dies
+            return
+        try:
+            self._pipe_to_worker_process.send(x)
+        except (BrokenPipeError, OSError):
+            self._on_worker_process_died()
+            return
+        get_metrics().inc('labbox_pipe_messages_total', direction='to_worker')
+    def _remove_reader(self):
+        if self._reader_loop is not None:
+            self._reader_loop.remove_reader(self._pipe_to_worker_process.fileno())
+            self._reader_loop = None
+    def _on_worker_process_died(self):
+        if self._dead:
+            return
+        self._dead = True
+        print(f'Session pool worker {self._worker_index} has died.')
+        # otherwise the closed pipe stays readable, and the reader is called over and over
+        self._remove_reader()
+        for event in self._outgoing_message_events_by_session_id.values():
+            event.set()
+    def _receive_from_worker_process(self):
+        metrics = get_metrics()
+        while not self._dead:
+            try:
+                if not self._pipe_to_worker_process.poll():
+                    break
+                msg = self._pipe_to_worker_process.recv()
+            except (EOFError, OSError):
+                self._on_worker_process_died()
+                break
+            metrics.inc('labbox_pipe_messages_total', direction='from_worker')
+            if isinstance(msg, dict):
+                if msg['type'] == 'outgoing_messages':
+                    metrics.inc('labbox_session_messages_total', len(msg['messages']), direction='outgoing')
+                    session_id = msg['session_id']
+                    if session_id in self._outgoing_messages_by_session_id:
+                        self._outgoing_messages_by_session_id[session_id].extend(msg['messages'])
+                elif msg['type'] == 'session_failed':
+                    # the worker process has ended the session after an error; it gets no more messages
+                    print(f'Session {msg["session_id"]} ended after an error in session pool worker {self._worker_index}.')
+                elif msg['type'] == 'worker_load':
+                    self._reported_load = msg['load']
+                else:
+                    print(msg)
+                    raise Exception('Unexpected message from pool worker')
+            else:
+                print(msg)
+                raise Exception('Unexpected message from pool worker')
+
+def _run_pool_worker(pipe_to_parent, labbox_config, default_feed_name: str, event_driven: bool, num_workers: int):
+    from ._workersession import WorkerSession, update_worker_metrics
+    from ._workerwakeup import WorkerWakeup
+    from ._subfeedwatchregistry import get_subfeed_watch_registry
+    from ._jobcoalescer import get_job_coalescer
+    from ._jobhandlers import get_local_job_handlers, set_num_pool_workers
+    from ._jobscheduler import get_job_scheduler
+    # the local job handlers of the pool's worker processes share the cpus of the host
+    set_num_pool_workers(num_workers)
+    worker_sessions: Dict[str, WorkerSession] = {}
+    wakeup = WorkerWakeup(get_worker_sessions=lambda: list(worker_sessions.values())) if event_driven else None
+    def end_failed_session(session_id: str):
+        # an error in one session must not take down the other sessions of this process
+        traceback.print_exc()
+        WS = worker_sessions.pop(session_id, None)
+        if WS is not None:
+            try:
+                WS.cleanup()
+            except Exception:
+                traceback.print_exc()
+        get_metrics().inc('labbox_session_failures_total')
+        pipe_to_parent.send(dict(
+            type='session_failed',
+            session_id=session_id
+        ))
+    def create_handle_messages(session_id: str):
+        def handle_messages(msgs):
+            pipe_to_parent.send(dict(
+                type='outgoing_messages',
+                session_id=session_id,
+                messages=msgs
+            ))
+        return handle_messages
+    last_load_report_timestamp = 0
+    while True:
+        while pipe_to_parent.poll():
+            x = pipe_to_parent.recv()
+            if isinstance(x, str):
+                if x == 'exit':
+                    for WS in worker_sessions.values():
+                        WS.cleanup()
+                    pipe_to_parent.close()
+                    return
+                else:
+                    print(x)
+                    raise Exception('Unexpected message in _run_pool_worker')
+            elif isinstance(x, dict):
+                session_id = x['session_id']
+                if x['type'] == 'create_session':
+                    try:
+                        WS = WorkerSession(labbox_config=labbox_config, default_feed_name=default_feed_name)
+                        WS.on_messages(create_handle_messages(session_id))
+                        worker_sessions[session_id] = WS
+                        WS.initialize()
+                    except Exception:
+                        end_failed_session(session_id)
+                elif x['type'] == 'incoming_message':
+                    if session_id in worker_sessions:
+                        try:
+                            worker_sessions[session_id].handle_message(x['message'])
+                        except Exception:
+                            end_failed_session(session_id)
+                elif x['type'] == 'cleanup_session':
+                    if session_id in worker_sessions:
+                        WS = worker_sessions.pop(session_id)
+                        try:
+                            WS.cleanup()
+                        except Exception:
+                            traceback.print_exc()
+                else:
+                    print(x)
+                    raise Exception('Unexpected message in _run_pool_worker')
+            else:
+                print(x)
+                raise Exception('Unexpected message in _run_pool_worker')
+        for session_id, WS in list(worker_sessions.items()):
+            # don't block in the subfeed watch, because the sessions in this process take turns
+            try:
+                WS.iterate(subfeed_wait_msec=0)
+            except Exception:
+                end_failed_session(session_id)
+        elapsed_since_load_report = time.time() - last_load_report_timestamp
+        if elapsed_since_load_report > 2:
+            update_worker_metrics(list(worker_sessions.values()))
+            pipe_to_parent.send(dict(
+                type='worker_load',
+                load={
+                    'num_jobs': sum([WS.get_num_jobs() for WS in worker_sessions.values()]),
+                    'num_subfeed_message_requests': sum([WS.get_num_subfeed_message_requests() for WS in worker_sessions.values()]),
+                    'subfeed_watches': get_subfeed_watch_registry().get_stats(),
+                    'jobs': get_job_coalescer().get_stats(),
+                    'job_handlers': get_local_job_handlers(labbox_config).get_stats(),
+                    'job_scheduler': get_job_scheduler(labbox_config).get_stats(),
+                    'metrics': get_metrics().snapshot()
+                }
+            ))
+            last_load_report_timestamp = time.time()
+        if wakeup is not None:
+            wakeup.notify_subfeed_message_requests_changed()
+            wakeup.wait(pipe_to_parent)
+        else:
+            time.sleep(0.05)
+
+def _random_string(num_chars: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(random.choice(chars) for _ in range(num_chars))
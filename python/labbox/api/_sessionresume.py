@@ -0,0 +1,196 @@
+import os
+import time
+import asyncio
+import secrets
+from collections import deque
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from ._metrics import get_metrics
+
+class ResumableSession:
+    """
+    A Session (or PooledSession) that outlives its websocket connection
+
+    Outgoing messages are numbered, and kept until the client acknowledges
+    them (keepAlive messages carry the number of messages received), so that
+    a client that reconnects gets the ones it missed, including those that
+    were sent into a connection that was already dead. At most
+    max_retained_messages are kept.
+    """
+    def __init__(self, *, session, token: str, max_retained_messages: int):
+        self._session = session
+        self._token = token
+        self._max_retained_messages = max_retained_messages
+        # retained[i] has number first_seq + i
+        self._retained: deque = deque()
+        self._first_seq = 0
+        # number of the next message to send on the connection
+        self._next_send_seq = 0
+        # set when messages were dropped before they were sent, after which the session cannot be resumed
+        self._lost_messages = False
+        self._new_messages = asyncio.Event()
+        self._connection_id: Union[int, None] = None
+        self._detached_timestamp: Union[float, None] = None
+        self._pump_task: Union[asyncio.Task, None] = None
+    @property
+    def token(self):
+        return self._token
+    @property
+    def session(self):
+        return self._session
+    def elapsed_sec_since_incoming_keepalive(self):
+        return self._session.elapsed_sec_since_incoming_keepalive()
+    def check_for_outgoing_messages(self) -> List[dict]:
+        """
+        The messages not yet sent on the current connection
+        """
+        next_seq = self._first_seq + len(self._retained)
+        ret = [self._retained[i] for i in range(self._next_send_seq - self._first_seq, len(self._retained))]
+        self._next_send_seq = next_seq
+        self._new_messages.clear()
+        return ret
+    async def wait_for_outgoing_messages(self, *, timeout_sec: float):
+        if self._next_send_seq < self._first_seq + len(self._retained):
+            return
+        try:
+            await asyncio.wait_for(self._new_messages.wait(), timeout=timeout_sec)
+        except asyncio.TimeoutError:
+            pass
+    def handle_message(self, msg):
+        if msg['type'] == 'keepAlive' and 'received' in msg:
+            num_received = parse_num_received(msg['received'])
+            if num_received is not None:
+                self._acknowledge(num_received)
+        self._session.handle_message(msg)
+    def _can_resume(self, num_received: int) -> bool:
+        return (not self._lost_messages) and (self._first_seq <= num_received <= self._first_seq + len(self._retained))
+    def _acknowledge(self, num_received: int):
+        while self._first_seq < num_received and len(self._retained) > 0:
+            self._retained.popleft()
+            self._first_seq += 1
+    def _receive(self, messages: List[dict]):
+        if len(messages) == 0:
+            return
+        self._retained.extend(messages)
+        while len(self._retained) > self._max_retained_messages:
+            # when connected, the client has most likely received these and just not acknowledged them yet
+            self._retained.popleft()
+            self._first_seq += 1
+        if self._next_send_seq < self._first_seq:
+            self._next_send_seq = self._first_seq
+            self._lost_messages = True
+        self._new_messages.set()
+
+class SessionRegistry:
+    """
+    Keeps the sessions of dropped websocket connections for grace_sec, so that reconnecting clients can resume them
+
+    A connection attaches to a new session, or, given the token of a session
+    and the number of messages the client has received from it, to that
+    session, whose jobs have kept running in the meantime. The messages the
+    client missed are then sent first. Messages of a session are moved from its
+    worker by a single task, whether or not a connection is attached, so that
+    the worker never blocks on a full pipe.
+
+    With grace_sec=0, a session ends with its connection.
+    """
+    def __init__(self, *, create_session: Callable[[], Any], grace_sec: float, max_retained_messages: int):
+        self._create_session = create_session
+        self._grace_sec = grace_sec
+        self._max_retained_messages = max_retained_messages
+        self._sessions: Dict[str, ResumableSession] = {}
+        self._last_connection_id = 0
+    @property
+    def grace_sec(self):
+        return self._grace_sec
+    def attach(self, token: Union[str, None], num_received: int) -> Tuple[ResumableSession, int, bool]:
+        """
+        Returns (session, connection id, whether the session was resumed)
+
+        If the session is still attached to another connection (which has not
+        noticed yet that it is dead), it is taken over.
+        """
+        metrics = get_metrics()
+        self._last_connection_id += 1
+        connection_id = self._last_connection_id
+        rs = self._sessions.get(token, None) if token is not None else None
+        if rs is not None:
+            if rs._can_resume(num_received):
+                rs._acknowledge(num_received)
+                rs._next_send_seq = num_received
+                rs._connection_id = connection_id
+                if rs._detached_timestamp is not None:
+                    rs.session.handle_message({'type': 'sessionAttached'})
+                rs._detached_timestamp = None
+                # the time spent disconnected does not count against the keepalive
+                rs.session.handle_message({'type': 'keepAlive'})
+                metrics.inc('labbox_session_resumes_total', result='resumed')
+                return rs, connection_id, True
+            # some of the messages that the client missed are gone
+            metrics.inc('labbox_session_resumes_total', result='incomplete')
+            self._expire(rs)
+        elif token is not None:
+            metrics.inc('labbox_session_resumes_total', result='unknown')
+        rs = ResumableSession(session=self._create_session(), token=secrets.token_urlsafe(24), max_retained_messages=self._max_retained_messages)
+        rs._connection_id = connection_id
+        rs._pump_task = asyncio.ensure_future(self._pump(rs))
+        self._sessions[rs.token] = rs
+        return rs, connection_id, False
+    def is_attached(self, rs: ResumableSession, connection_id: int) -> bool:
+        return rs._connection_id == connection_id
+    def detach(self, rs: ResumableSession, connection_id: int):
+        if rs._connection_id != connection_id:
+            # another connection has taken over the session
+            return
+        rs._connection_id = None
+        rs._detached_timestamp = time.time()
+        if self._grace_sec <= 0:
+            self._expire(rs)
+        else:
+            # queued jobs wait for the client to come back, rather than taking slots from other sessions
+            rs.session.handle_message({'type': 'sessionDetached'})
+    def get_sessions(self) -> list:
+        return [rs.session for rs in self._sessions.values()]
+    def get_num_detached_sessions(self) -> int:
+        return len([rs for rs in self._sessions.values() if rs._connection_id is None])
+    def cleanup(self):
+        # at server shutdown, when the event loop is no longer running
+        sessions = list(self._sessions.values())
+        self._sessions = {}
+        for rs in sessions:
+            rs._connection_id = None
+            rs.session.cleanup()
+    async def _pump(self, rs: ResumableSession):
+        while rs.token in self._sessions:
+            await rs.session.wait_for_outgoing_messages(timeout_sec=1)
+            rs._receive(rs.session.check_for_outgoing_messages())
+            if rs._detached_timestamp is not None:
+                if rs._lost_messages or (time.time() - rs._detached_timestamp > self._grace_sec):
+                    get_metrics().inc('labbox_session_resumes_total', result='expired')
+                    self._expire(rs)
+    def _expire(self, rs: ResumableSession):
+        if self._sessions.pop(rs.token, None) is None:
+            return
+        rs._connection_id = None
+        rs.session.cleanup()
+        if rs._pump_task is not None and rs._pump_task is not asyncio.current_task():
+            rs._pump_task.cancel()
+
+def parse_num_received(x: Any) -> Union[int, None]:
+    """
+    The number of session messages that a client says it has received, or None if it is not a valid count
+    """
+    try:
+        n = int(x)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if n < 0:
+        return None
+    return n
+
+def create_session_registry_from_env(create_session: Callable[[], Any]) -> SessionRegistry:
+    return SessionRegistry(
+        create_session=create_session,
+        grace_sec=float(os.environ.get('LABBOX_SESSION_RESUME_GRACE_SEC', '120')),
+        max_retained_messages=int(os.environ.get('LABBOX_SESSION_RESUME_MAX_MESSAGES', '2000'))
+    )
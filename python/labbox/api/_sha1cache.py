@@ -0,0 +1,174 @@
+import os
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple, Union
+
+import kachery_p2p as kp
+
+from ..serialize import is_binary_encoded
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content addressed by sha1 never changes, so clients may cache it forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class Sha1File:
+    """
+    Content too large for the cache, to be streamed from the kachery storage (e.g. with web.FileResponse)
+    """
+    def __init__(self, *, path: str, size: int):
+        self.path = path
+        self.size = size
+
+class Sha1ContentCache:
+    """
+    Size-bounded in-memory LRU cache for content served by the /sha1 endpoints
+
+    Eviction is by total number of bytes, including the compressed variants
+    that are cached alongside the original content. Files larger than the
+    whole cache are not read by create_response, which returns a Sha1File
+    for the server to stream instead.
+    """
+    def __init__(self, *, max_bytes: int, compress_min_bytes: int):
+        self._max_bytes = max_bytes
+        self._compress_min_bytes = compress_min_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._num_bytes = 0
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_evictions = 0
+        self._num_not_modified = 0
+        self._num_streamed = 0
+        self._lock = threading.Lock()
+    def load(self, sha1: str, *, cached_only: bool=False) -> Union[bytes, None]:
+        data = self._load(sha1, cached_only=cached_only, allow_file=False)
+        assert not isinstance(data, Sha1File)
+        return data
+    def _load(self, sha1: str, *, cached_only: bool, allow_file: bool) -> Union[bytes, Sha1File, None]:
+        with self._lock:
+            entry = self._entries.get(sha1, None)
+            if entry is not None:
+                self._entries.move_to_end(sha1)
+                self._num_hits += 1
+                return entry['']
+            if cached_only:
+                return None
+            self._num_misses += 1
+        path = kp.load_file(f'sha1://{sha1}', p2p=False)
+        if path is None:
+            return None
+        size = os.stat(path).st_size
+        if size > self._max_bytes and allow_file:
+            # it would not be cached anyway
+            with self._lock:
+                self._num_streamed += 1
+            return Sha1File(path=path, size=size)
+        with open(path, 'rb') as f:
+            data = f.read()
+        self._put(sha1, '', data)
+        return data
+    def create_response(self, sha1: str, *, accept_encoding: Union[str, None], if_none_match: Union[str, None], cached_only: bool=False) -> Union[Tuple[int, Dict[str, str], Union[bytes, Sha1File, None]], None]:
+        """
+        Returns (status, headers, body) for a /sha1 request, or (404, {}, None) if not found
+
+        With cached_only=True, returns None instead of doing any blocking work
+        (loading from kachery or compressing), so that async servers can answer
+        cache hits directly on the event loop. The body is a Sha1File, sent
+        uncompressed, for content larger than the cache.
+        """
+        etag = f'"{sha1}"'
+        headers = {
+            'ETag': etag,
+            'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+            'Vary': 'Accept-Encoding'
+        }
+        if if_none_match is not None and (if_none_match.strip() == '*' or etag in [a.strip() for a in if_none_match.split(',')]):
+            # the client already has this content, and it cannot have changed
+            with self._lock:
+                self._num_not_modified += 1
+            return 304, headers, None
+        data = self._load(sha1, cached_only=cached_only, allow_file=True)
+        if data is None:
+            return None if cached_only else (404, {}, None)
+        if isinstance(data, Sha1File):
+            with open(data.path, 'rb') as f:
+                head = f.read(4)
+            headers['Content-Type'] = 'application/octet-stream' if is_binary_encoded(head) else 'text/plain; charset=utf-8'
+            return 200, headers, data
+        if is_binary_encoded(data):
+            # raw numeric buffers do not compress well enough to be worth the cpu
+            headers['Content-Type'] = 'application/octet-stream'
+            return 200, headers, data
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        content_encoding = self._choose_content_encoding(data, accept_encoding)
+        if content_encoding is not None:
+            compressed = self._get_compressed(sha1, data, content_encoding, cached_only=cached_only)
+            if compressed is None:
+                return None
+            headers['Content-Encoding'] = content_encoding
+            return 200, headers, compressed
+        return 200, headers, data
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'numEntries': len(self._entries),
+                'numBytes': self._num_bytes,
+                'maxBytes': self._max_bytes,
+                'numHits': self._num_hits,
+                'numMisses': self._num_misses,
+                'numEvictions': self._num_evictions,
+                'numNotModified': self._num_not_modified,
+                'numStreamed': self._num_streamed
+            }
+    def _choose_content_encoding(self, data: bytes, accept_encoding: Union[str, None]) -> Union[str, None]:
+        if accept_encoding is None or len(data) < self._compress_min_bytes:
+            return None
+        accepted = [a.split(';')[0].strip() for a in accept_encoding.split(',')]
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+    def _get_compressed(self, sha1: str, data: bytes, content_encoding: str, *, cached_only: bool=False) -> Union[bytes, None]:
+        with self._lock:
+            entry = self._entries.get(sha1, None)
+            if entry is not None and content_encoding in entry:
+                return entry[content_encoding]
+        if cached_only:
+            return None
+        if content_encoding == 'br':
+            compressed = brotli.compress(data, quality=5)
+        else:
+            compressed = gzip.compress(data, compresslevel=6)
+        self._put(sha1, content_encoding, compressed)
+        return compressed
+    def _put(self, sha1: str, variant: str, data: bytes):
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            entry = self._entries.get(sha1, None)
+            if entry is None:
+                if variant != '':
+                    # the original was evicted in the meantime
+                    return
+                entry = {}
+                self._entries[sha1] = entry
+            if variant in entry:
+                return
+            entry[variant] = data
+            self._num_bytes += len(data)
+            self._entries.move_to_end(sha1)
+            while self._num_bytes > self._max_bytes and len(self._entries) > 0:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= sum([len(v) for v in evicted.values()])
+                self._num_evictions += 1
+
+def create_sha1_content_cache_from_env() -> Sha1ContentCache:
+    return Sha1ContentCache(
+        max_bytes=int(os.environ.get('LABBOX_SHA1_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+        compress_min_bytes=int(os.environ.get('LABBOX_SHA1_COMPRESS_MIN_BYTES', str(16 * 1024)))
+    )
@@ -0,0 +1,317 @@
+import os
+import pickle
+import select
+import multiprocessing
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Tuple
+
+from ._metrics import get_metrics
+
+# segments are reused; their sizes are powers of two from this on, so that they fit many messages
+_MIN_SEGMENT_BYTES = 1024 * 1024
+# free segments beyond this are unlinked
+_MAX_FREE_SEGMENT_BYTES = 256 * 1024 * 1024
+
+class _SharedMemoryMessage:
+    # sent on the pipe in place of a message that is in a shared memory segment
+    def __init__(self, *, name: str, data_nbytes: int, buffers: List[Tuple[int, int]], dropped: List[str]):
+        self.name = name
+        self.data_nbytes = data_nbytes
+        # (offset, nbytes) of the out-of-band buffers of the pickle
+        self.buffers = buffers
+        # segments that the sender has unlinked since its last message, for the receiver to unmap
+        self.dropped = dropped
+
+class _InlineBuffersMessage:
+    # header of a small message with out-of-band buffers, which follow it in the same frame: the pickle, then the buffers
+    def __init__(self, *, payload_nbytes: int, data_nbytes: int, buffers: List[Tuple[int, bool]]):
+        self.payload_nbytes = payload_nbytes
+        self.data_nbytes = data_nbytes
+        # (nbytes, readonly) of the out-of-band buffers of the pickle
+        self.buffers = buffers
+
+class _SharedMemoryAck:
+    # the receiver is done with the released segments, and objects it received refer to the retained ones
+    def __init__(self, *, released: List[str], retained: List[str]):
+        self.released = released
+        self.retained = retained
+
+class _ChunkWriter:
+    # file for a pickler, which passes large bytes objects to write() as they are, so keeping the chunks costs no copy
+    def __init__(self):
+        self.chunks: List[memoryview] = []
+        self.nbytes = 0
+    def write(self, b) -> int:
+        v = memoryview(b).cast('B')
+        self.chunks.append(v)
+        self.nbytes += v.nbytes
+        return v.nbytes
+
+class SharedMemoryPipe:
+    """
+    One end of a duplex pipe between processes, on which large messages go through shared memory
+
+    Same interface as the multiprocessing Connection it wraps (send, recv, poll,
+    fileno, close). A message whose pickle is at least shm_min_bytes is written
+    to a shared memory segment, and only a small descriptor goes through the
+    pipe, instead of the whole message going through the 64 KiB pipe buffer with
+    the sender blocked until the receiver has read it. The receiver unpickles
+    straight from the segment. Out-of-band buffers (pickle protocol 5, e.g.
+    numpy arrays) are copied once into the segment and received as views of it.
+    A smaller message with out-of-band buffers is sent as a single frame of
+    the pickle followed by its buffers, so that it is pickled only once.
+
+    The receiver acknowledges each segment once it has unpickled the message.
+    A segment without out-of-band buffers is then reused by the sender for
+    later messages, and both ends keep it mapped, so that a reused segment
+    costs neither a new mapping nor page faults. A segment with out-of-band
+    buffers is left to the receiver, whose objects refer to it: the sender
+    unlinks it, and the receiver unmaps it once the last reference to its
+    memory is gone (mappings are reference counted). Free segments beyond a
+    limit, and all segments of the sender when it closes, are unlinked.
+    Acknowledgements are queued, and only written while the pipe has room
+    (or together with the next message sent), so that receiving never blocks
+    on a sender that is itself blocked sending.
+
+    Use create_shared_memory_pipe_from_env() to create both ends before
+    starting the other process. With shm_min_bytes <= 0 all messages go
+    through the pipe.
+    """
+    def __init__(self, conn: Any, *, shm_min_bytes: int, direction: str):
+        self._conn = conn
+        self._shm_min_bytes = shm_min_bytes
+        # label of the messages sent from this end, for the metrics
+        self._direction = direction
+        # messages read from the pipe by poll(), not yet returned by recv()
+        self._received: deque = deque()
+        # sending: name -> segment, for segments sent and not yet acknowledged, and free segments
+        self._segments_in_use: Dict[str, shared_memory.SharedMemory] = {}
+        self._free_segments: List[shared_memory.SharedMemory] = []
+        self._dropped_segment_names: List[str] = []
+        # receiving: name -> mapped segment, and the segments that received objects still refer to
+        self._mapped_segments: Dict[str, shared_memory.SharedMemory] = {}
+        self._retained_segments: List[shared_memory.SharedMemory] = []
+        # names of received segments not yet acknowledged
+        self._pending_ack_released: List[str] = []
+        self._pending_ack_retained: List[str] = []
+        self._num_shm_messages_sent = 0
+        self._num_shm_bytes_sent = 0
+        self._num_shm_messages_received = 0
+        self._num_segments_created = 0
+    def fileno(self) -> int:
+        return self._conn.fileno()
+    def send(self, obj: Any):
+        if self._shm_min_bytes <= 0:
+            self._conn.send_bytes(pickle.dumps(obj, protocol=5))
+            return
+        # this blocks until the message is written anyway
+        self._flush_acks(block=True)
+        writer = _ChunkWriter()
+        buffers: List[pickle.PickleBuffer] = []
+        pickle.Pickler(writer, protocol=5, buffer_callback=buffers.append).dump(obj)
+        raw_buffers = [b.raw() for b in buffers]
+        nbytes = writer.nbytes + sum([b.nbytes for b in raw_buffers])
+        if nbytes < self._shm_min_bytes:
+            if len(raw_buffers) == 0:
+                self._conn.send_bytes(b''.join(writer.chunks))
+            else:
+                header = _InlineBuffersMessage(payload_nbytes=nbytes, data_nbytes=writer.nbytes, buffers=[(b.nbytes, b.readonly) for b in raw_buffers])
+                self._conn.send_bytes(b''.join([pickle.dumps(header)] + writer.chunks + raw_buffers))
+            return
+        self._send_shared_memory(writer, raw_buffers)
+    def poll(self) -> bool:
+        # acknowledgements are handled here, so that poll() is True only when recv() has a message
+        if len(self._retained_segments) > 0:
+            self._unmap_retained_segments()
+        while len(self._received) == 0 and self._conn.poll():
+            self._read_frame()
+        self._flush_acks(block=False)
+        return len(self._received) > 0
+    def recv(self) -> Any:
+        while len(self._received) == 0:
+            self._flush_acks(block=False)
+            self._read_frame()
+        self._flush_acks(block=False)
+        return self._received.popleft()
+    def close(self):
+        self.release_shared_memory()
+        self._conn.close()
+    def release_shared_memory(self):
+        """
+        Unlinks the segments of this end, and unmaps those of the other end
+
+        The connection stays open. Large messages sent and not yet received are lost.
+        """
+        for shm in list(self._segments_in_use.values()) + self._free_segments:
+            _unlink_segment(shm)
+        self._segments_in_use = {}
+        self._free_segments = []
+        for shm in self._mapped_segments.values():
+            shm.close()
+        self._mapped_segments = {}
+        self._unmap_retained_segments()
+    def get_stats(self) -> dict:
+        return {
+            'numShmMessagesSent': self._num_shm_messages_sent,
+            'numShmBytesSent': self._num_shm_bytes_sent,
+            'numShmMessagesReceived': self._num_shm_messages_received,
+            'numSegmentsCreated': self._num_segments_created,
+            'numSegmentsInUse': len(self._segments_in_use),
+            'numFreeSegments': len(self._free_segments),
+            'numMappedSegments': len(self._mapped_segments),
+            'numRetainedSegments': len(self._retained_segments)
+        }
+    def _send_shared_memory(self, writer: _ChunkWriter, buffers: List[memoryview]):
+        offsets: List[Tuple[int, int]] = []
+        size = writer.nbytes
+        for b in buffers:
+            size = _align8(size)
+            offsets.append((size, b.nbytes))
+            size += b.nbytes
+        shm = self._get_free_segment(size)
+        offset = 0
+        for chunk in writer.chunks:
+            shm.buf[offset:offset + chunk.nbytes] = chunk
+            offset += chunk.nbytes
+        for (offset, nbytes), b in zip(offsets, buffers):
+            shm.buf[offset:offset + nbytes] = b
+        self._segments_in_use[shm.name] = shm
+        m = _SharedMemoryMessage(name=shm.name, data_nbytes=writer.nbytes, buffers=offsets, dropped=self._dropped_segment_names)
+        self._dropped_segment_names = []
+        self._conn.send_bytes(pickle.dumps(m))
+        self._num_shm_messages_sent += 1
+        self._num_shm_bytes_sent += size
+        metrics = get_metrics()
+        metrics.inc('labbox_pipe_shm_messages_total', direction=self._direction)
+        metrics.inc('labbox_pipe_shm_bytes_total', size, direction=self._direction)
+    def _get_free_segment(self, size: int) -> shared_memory.SharedMemory:
+        # the smallest free segment that fits
+        candidates = [shm for shm in self._free_segments if shm.size >= size]
+        if len(candidates) > 0:
+            shm = min(candidates, key=lambda s: s.size)
+            self._free_segments.remove(shm)
+            return shm
+        segment_size = _MIN_SEGMENT_BYTES
+        while segment_size < size:
+            segment_size *= 2
+        self._num_segments_created += 1
+        return shared_memory.SharedMemory(create=True, size=segment_size)
+    def _handle_ack(self, ack: _SharedMemoryAck):
+        for name in ack.released:
+            shm = self._segments_in_use.pop(name, None)
+            if shm is not None:
+                self._free_segments.append(shm)
+        for name in ack.retained:
+            shm = self._segments_in_use.pop(name, None)
+            if shm is not None:
+                _unlink_segment(shm)
+        while sum([shm.size for shm in self._free_segments]) > _MAX_FREE_SEGMENT_BYTES:
+            # the oldest first
+            shm = self._free_segments.pop(0)
+            _unlink_segment(shm)
+            self._dropped_segment_names.append(shm.name)
+    def _read_frame(self):
+        frame = self._conn.recv_bytes()
+        x = pickle.loads(frame)
+        if isinstance(x, _SharedMemoryMessage):
+            self._receive_shared_memory(x)
+        elif isinstance(x, _SharedMemoryAck):
+            self._handle_ack(x)
+        elif isinstance(x, _InlineBuffersMessage):
+            self._received.append(_load_inline_buffers_message(frame, x))
+        else:
+            self._received.append(x)
+    def _receive_shared_memory(self, m: _SharedMemoryMessage):
+        for name in m.dropped:
+            shm = self._mapped_segments.pop(name, None)
+            if shm is not None:
+                shm.close()
+        shm = self._mapped_segments.get(m.name, None)
+        if shm is None:
+            try:
+                shm = shared_memory.SharedMemory(name=m.name)
+            except FileNotFoundError:
+                # the sender has closed
+                print(f'Warning: shared memory message is gone: {m.name}')
+                return
+            self._mapped_segments[m.name] = shm
+        data = shm.buf[:m.data_nbytes]
+        try:
+            # out-of-band buffers become part of the received objects (e.g. as the memory of numpy arrays)
+            x = pickle.loads(data, buffers=[shm.buf[offset:offset + nbytes] for offset, nbytes in m.buffers])
+        finally:
+            data.release()
+            if len(m.buffers) == 0:
+                self._pending_ack_released.append(m.name)
+            else:
+                self._pending_ack_retained.append(m.name)
+                self._retained_segments.append(self._mapped_segments.pop(m.name))
+        self._num_shm_messages_received += 1
+        self._received.append(x)
+    def _flush_acks(self, *, block: bool):
+        if len(self._pending_ack_released) == 0 and len(self._pending_ack_retained) == 0:
+            return
+        if not block and not _is_writable(self._conn):
+            # the other end is not reading (e.g. it is blocked sending to us), so try again later
+            return
+        ack = _SharedMemoryAck(released=self._pending_ack_released, retained=self._pending_ack_retained)
+        self._pending_ack_released = []
+        self._pending_ack_retained = []
+        try:
+            self._conn.send_bytes(pickle.dumps(ack))
+        except (BrokenPipeError, OSError):
+            pass
+    def _unmap_retained_segments(self):
+        still_retained = []
+        for shm in self._retained_segments:
+            try:
+                shm.close()
+            except BufferError:
+                # received objects still refer to it
+                still_retained.append(shm)
+        self._retained_segments = still_retained
+
+def create_shared_memory_pipe_from_env() -> Tuple[SharedMemoryPipe, SharedMemoryPipe]:
+    """
+    Returns (end for the worker process, end for the parent), like pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
+    """
+    shm_min_bytes = int(os.environ.get('LABBOX_PIPE_SHM_MIN_BYTES', str(256 * 1024)))
+    if shm_min_bytes > 0:
+        # the worker process has to register the segments it maps with the same
+        # resource tracker, so that the segments unlinked by the parent are not reported as leaked
+        resource_tracker.ensure_running()
+    pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
+    return (
+        SharedMemoryPipe(pipe_to_parent, shm_min_bytes=shm_min_bytes, direction='from_worker'),
+        SharedMemoryPipe(pipe_to_child, shm_min_bytes=shm_min_bytes, direction='to_worker')
+    )
+
+def _load_inline_buffers_message(frame: bytes, m: _InlineBuffersMessage) -> Any:
+    payload = memoryview(frame)[len(frame) - m.payload_nbytes:]
+    buffers = []
+    offset = m.data_nbytes
+    for nbytes, readonly in m.buffers:
+        b = payload[offset:offset + nbytes]
+        # the frame is immutable, so writable buffers (e.g. of numpy arrays) are copied, as by an in-band pickle
+        buffers.append(b if readonly else bytearray(b))
+        offset += nbytes
+    return pickle.loads(payload[:m.data_nbytes], buffers=buffers)
+
+def _is_writable(conn: Any) -> bool:
+    try:
+        _, writable, _ = select.select([], [conn.fileno()], [], 0)
+    except (OSError, ValueError):
+        # closed; sending fails right away rather than blocking
+        return True
+    return len(writable) > 0
+
+def _unlink_segment(shm: shared_memory.SharedMemory):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+def _align8(n: int) -> int:
+    return (n + 7) // 8 * 8
@@ -0,0 +1,106 @@
+import os
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Union
+
+import kachery_p2p as kp
+
+from ._kacheryexecutor import ServerBusyError
+from ._hashing import _subfeed_hash_from_name
+
+class SubfeedWatchHub:
+    """
+    Resolves many long-polling /feed/getMessages requests from a single daemon watch
+
+    Waiting requests register a (feed, subfeed, position) watch with the hub.
+    A single background task repeatedly calls kp.watch_for_new_messages (in one
+    dedicated thread) with the union of all registered watches, and hands the new
+    messages to every request waiting on that watch. Requests waiting on the same
+    subfeed position share a watch, so an idle long-poll costs a future, not a thread.
+    """
+    def __init__(self, *, watch_wait_msec: int, max_waiters: int, retry_after_sec: int=1):
+        self._watch_wait_msec = watch_wait_msec
+        self._max_waiters = max_waiters
+        self._retry_after_sec = retry_after_sec
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='subfeed-watch-hub')
+        # watch key -> {'watch': ..., 'futures': set of futures}
+        self._watches: Dict[str, dict] = {}
+        self._num_waiters = 0
+        self._num_watch_calls = 0
+        self._num_resolved = 0
+        self._num_timeouts = 0
+        self._task: Union[asyncio.Task, None] = None
+    async def wait_for_messages(self, *, feed_id: str, subfeed_name, position: int, wait_msec: float) -> list:
+        """
+        Wait up to wait_msec for messages beyond position, returning [] on timeout
+        """
+        if self._num_waiters >= self._max_waiters:
+            raise ServerBusyError('feedLongPoll', self._retry_after_sec)
+        subfeed_hash = _subfeed_hash_from_name(subfeed_name)
+        key = f'{feed_id}:{subfeed_hash}:{position}'
+        w = self._watches.get(key, None)
+        if w is None:
+            w = {
+                'watch': {'feedId': feed_id, 'subfeedHash': subfeed_hash, 'position': position},
+                'futures': set()
+            }
+            self._watches[key] = w
+        future = asyncio.get_event_loop().create_future()
+        w['futures'].add(future)
+        self._num_waiters += 1
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        try:
+            return await asyncio.wait_for(future, timeout=wait_msec / 1000)
+        except asyncio.TimeoutError:
+            self._num_timeouts += 1
+            return []
+        finally:
+            # also reached when the client disconnects and the handler is cancelled
+            self._num_waiters -= 1
+            w['futures'].discard(future)
+            if len(w['futures']) == 0 and self._watches.get(key, None) is w:
+                del self._watches[key]
+    def get_stats(self) -> dict:
+        return {
+            'numWaiters': self._num_waiters,
+            'numWatches': len(self._watches),
+            'maxWaiters': self._max_waiters,
+            'numWatchCalls': self._num_watch_calls,
+            'numResolved': self._num_resolved,
+            'numTimeouts': self._num_timeouts
+        }
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while len(self._watches) > 0:
+                subfeed_watches = {key: w['watch'] for key, w in self._watches.items()}
+                self._num_watch_calls += 1
+                try:
+                    messages = await loop.run_in_executor(self._executor, self._watch, subfeed_watches)
+                except:
+                    traceback.print_exc()
+                    await asyncio.sleep(1)
+                    continue
+                for key, msgs in messages.items():
+                    if len(msgs) == 0:
+                        continue
+                    w = self._watches.pop(key, None)
+                    if w is None:
+                        # all requests for this watch have gone away in the meantime
+                        continue
+                    for future in w['futures']:
+                        if not future.done():
+                            future.set_result(msgs)
+                            self._num_resolved += 1
+        finally:
+            self._task = None
+    def _watch(self, subfeed_watches: dict) -> dict:
+        return kp.watch_for_new_messages(subfeed_watches=subfeed_watches, wait_msec=self._watch_wait_msec)
+
+def create_subfeed_watch_hub_from_env() -> SubfeedWatchHub:
+    return SubfeedWatchHub(
+        watch_wait_msec=int(os.environ.get('LABBOX_SUBFEED_WATCH_WAIT_MSEC', '250')),
+        max_waiters=int(os.environ.get('LABBOX_FEED_MAX_LONG_POLLS', '10000'))
+    )
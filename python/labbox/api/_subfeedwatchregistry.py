@@ -0,0 +1,92 @@
+import time
+import threading
+from typing import Dict, Tuple, Union
+
+import kachery_p2p as kp
+
+# a daemon result is reused by other watchers of the same (feed, subfeed, position) for this long
+RECENT_WATCH_RESULT_SEC = 0.02
+
+class SubfeedWatchRegistry:
+    """
+    Process-wide deduplication of kp.watch_for_new_messages calls
+
+    Watches are keyed by (feedId, subfeedHash, position). A single call covers each
+    distinct key once, however many subfeed message requests (of however many
+    sessions) are waiting on it, and the result is fanned back out to all of them.
+    Results are remembered for a short time, so that the sessions of a pool worker
+    iterating one after the other share one daemon call per cycle.
+    """
+    def __init__(self):
+        # key -> (timestamp, messages)
+        self._recent_results: Dict[Tuple[str, str, int], Tuple[float, list]] = {}
+        self._num_watch_calls = 0
+        self._num_watch_calls_saved = 0
+        self._num_watches_requested = 0
+        self._num_watches_deduplicated = 0
+        self._lock = threading.Lock()
+    def watch_for_new_messages(self, subfeed_watches: Dict[str, dict], *, wait_msec: float) -> Dict[str, list]:
+        """
+        Same as kp.watch_for_new_messages, but deduplicated across all callers in this process
+        """
+        keys = {name: _watch_key(w) for name, w in subfeed_watches.items()}
+        distinct_keys = set(keys.values())
+        with self._lock:
+            self._num_watches_requested += len(keys)
+            results = self._get_recent_results(distinct_keys)
+            if results is not None and (wait_msec == 0 or any([len(msgs) > 0 for msgs in results.values()])):
+                # somebody else just asked the daemon about exactly these watches
+                self._num_watch_calls_saved += 1
+                self._num_watches_deduplicated += len(keys)
+                return {name: results[key] for name, key in keys.items() if len(results[key]) > 0}
+            self._num_watch_calls += 1
+            self._num_watches_deduplicated += len(keys) - len(distinct_keys)
+        watches_by_key = {
+            f'{key[0]}:{key[1]}:{key[2]}': {'feedId': key[0], 'subfeedHash': key[1], 'position': key[2]}
+            for key in distinct_keys
+        }
+        messages = kp.watch_for_new_messages(subfeed_watches=watches_by_key, wait_msec=wait_msec)
+        timestamp = time.time()
+        results = {}
+        for key in distinct_keys:
+            results[key] = messages.get(f'{key[0]}:{key[1]}:{key[2]}', [])
+        with self._lock:
+            for key, msgs in results.items():
+                self._recent_results[key] = (timestamp, msgs)
+            self._prune_recent_results(timestamp)
+        return {name: results[key] for name, key in keys.items() if len(results[key]) > 0}
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'numWatchCalls': self._num_watch_calls,
+                'numWatchCallsSaved': self._num_watch_calls_saved,
+                'numWatchesRequested': self._num_watches_requested,
+                'numWatchesDeduplicated': self._num_watches_deduplicated
+            }
+    def _get_recent_results(self, keys) -> Union[Dict[Tuple[str, str, int], list], None]:
+        if len(keys) == 0:
+            return None
+        now = time.time()
+        ret = {}
+        for key in keys:
+            a = self._recent_results.get(key, None)
+            if a is None or now - a[0] > RECENT_WATCH_RESULT_SEC:
+                return None
+            ret[key] = a[1]
+        return ret
+    def _prune_recent_results(self, now: float):
+        for key in [k for k, a in self._recent_results.items() if now - a[0] > RECENT_WATCH_RESULT_SEC]:
+            del self._recent_results[key]
+
+_global = {
+    'subfeed_watch_registry': None
+}
+def get_subfeed_watch_registry() -> SubfeedWatchRegistry:
+    r = _global['subfeed_watch_registry']
+    if r is None:
+        r = SubfeedWatchRegistry()
+        _global['subfeed_watch_registry'] = r
+    return r
+
+def _watch_key(w: dict) -> Tuple[str, str, int]:
+    return (w['feedId'], w['subfeedHash'], w['position'])
@@ -1,12 +1,26 @@
 import os
 import json
 import time
-import hashlib
+import secrets
+import tempfile
+from collections import deque
 from typing import Any, Callable, Dict, List, Set, Tuple, Union
 
 import hither2 as hi2
 import kachery_p2p as kp
-import numpy as np
+
+from ..serialize import ContainsNdarrayError, _serialize, encode_json, write_binary
+from ..memoize import is_memoized
+from ._subfeedwatchregistry import get_subfeed_watch_registry
+from ._jobcoalescer import get_job_coalescer
+from ._jobhandlers import get_local_job_handlers
+from ._jobscheduler import get_job_scheduler
+from ._jobprogress import create_job_progress_channel
+from ._metrics import get_metrics
+from ._hashing import _feed_id_from_uri, _sha1_of_object, _subfeed_hash_from_name
+
+# message types used as a metrics label, anything else is counted as 'other'
+_MESSAGE_TYPES = ['hitherCreateJob', 'hitherCancelJob', 'subfeedMessageRequest']
 
 _global: Dict[str, Any] = {
     'job_cache': None
@@ -26,6 +40,14 @@ class LabboxContext:
         return _global_job_cache()
     def get_job_handler(self, job_handler_name) -> hi2.JobHandler:
         return self._worker_session._get_job_handler_from_name(job_handler_name)
+    def job_progress_channel(self) -> dict:
+        """
+        Progress channel of the job being created, to pass on to the hither function (see labbox.JobProgress)
+
+        Identical requests get the same channel, so that the kwargs (and the job
+        cache key) of the hither job do not depend on the request.
+        """
+        return self._worker_session._get_job_progress_channel()
 
 class LogEvent:
     def __init__(self, label: str, data: dict):
@@ -44,25 +66,32 @@ class LogEvent:
 
 class WorkerSession:
     def __init__(self, *, labbox_config, default_feed_name: str):
-        self._log_events: List[LogEvent] = []
+        # ring buffer, so that a long debugging session does not grow without bound
+        self._log_events: deque = deque(maxlen=int(os.environ.get('LABBOX_DEBUG_MAX_EVENTS', '10000')))
         self._labbox_config = labbox_config
-        self._local_job_handlers = dict(
-            default=hi2.ParallelJobHandler(4),
-            partition1=hi2.ParallelJobHandler(4),
-            partition2=hi2.ParallelJobHandler(4),
-            partition3=hi2.ParallelJobHandler(4),
-            timeseries=hi2.ParallelJobHandler(4)
-        )
+        # shared with the other sessions in this process, created on first use
+        self._local_job_handlers = get_local_job_handlers(labbox_config)
+        self._job_scheduler = get_job_scheduler(labbox_config)
         self._labbox_context = LabboxContext(worker_session=self)
 
         default_feed_id = kp.get_feed_id(default_feed_name, create=True)
         assert default_feed_id is not None
         self._default_feed_id = default_feed_id
         self._readonly = False
+        # jobs that have been started (the job may be shared with other sessions)
         self._jobs_by_id: Dict[str, hi2.Job] = {}
+        # job_id -> {'client_job_id': ..., 'job_key': ..., ...} for queued and started jobs
+        self._job_infos: Dict[str, dict] = {}
         self._on_messages_callbacks: List[Callable] = []
         self._subfeed_message_requests = {}
         self._hither_log = hi2.Log()
+        # results whose json is smaller than this are sent in the hitherJobFinished message itself
+        self._inline_result_max_bytes = int(os.environ.get('LABBOX_INLINE_RESULT_MAX_BYTES', str(8 * 1024)))
+        # progress of running jobs is checked at most this often
+        self._job_progress_interval_sec = float(os.environ.get('LABBOX_JOB_PROGRESS_INTERVAL_MSEC', '250')) / 1000
+        self._last_job_progress_check_timestamp = 0.0
+        # {'subfeed_name': ..., 'channel': ...} while the function of a job is creating the job
+        self._creating_job: Union[dict, None] = None
 
     def initialize(self):
         node_id = kp.get_node_id()
@@ -79,67 +108,119 @@ class WorkerSession:
         self._log(f'initialize node_id={node_id}', msg)
         self._send_message(msg)
     def cleanup(self):
-        # todo
-        pass
+        # the client is gone (disconnect or keepalive timeout), so its jobs are of no use to anyone else
+        self._job_scheduler.remove_session(self)
+        for job_id, job in self._jobs_by_id.items():
+            if self._release_job(job_id):
+                job.cancel()
+        self._jobs_by_id = {}
+        self._job_infos = {}
     def _log(self, label: str, data: dict={}):
         if os.getenv('LABBOX_DEBUG', None) == '1':
             self._log_events.append(LogEvent(label=label, data=data))
     @property
-    def log_events(self):
-        return self._log_events
+    def log_events(self) -> List[LogEvent]:
+        return list(self._log_events)
+    def get_num_jobs(self):
+        # includes the queued jobs
+        return len(self._job_infos)
+    def get_num_subfeed_message_requests(self):
+        return len(self._subfeed_message_requests)
+    def get_subfeed_watches(self):
+        # take a snapshot first so that this can be called from a watcher thread
+        subfeed_message_requests = dict(self._subfeed_message_requests)
+        subfeed_watches = {}
+        for smr_id, smr in subfeed_message_requests.items():
+            subfeed_watches[smr_id] = {
+                'position': smr['position'],
+                'feedId': _feed_id_from_uri(smr['feed_uri']),
+                'subfeedHash': _subfeed_hash_from_name(smr['subfeed_name'])
+            }
+        return subfeed_watches
+    def get_subfeed_message_request_deadline(self) -> Union[float, None]:
+        # timestamp at which the earliest pending subfeed message request times out
+        subfeed_message_requests = dict(self._subfeed_message_requests)
+        deadlines = [smr['timestamp'] + smr['wait_msec'] / 1000 for smr in subfeed_message_requests.values()]
+        return min(deadlines) if len(deadlines) > 0 else None
     def handle_message(self, msg):
+        type0 = msg.get('type')
+        with get_metrics().time('labbox_message_handling_seconds', type=type0 if type0 in _MESSAGE_TYPES else 'other'):
+            self._handle_message(msg)
+    def _handle_message(self, msg):
         type0 = msg.get('type')
         if type0 == 'hitherCreateJob':
             functionName = msg['functionName']
             kwargs = msg['kwargs']
             client_job_id = msg['clientJobId']
             self._log(f'hitherCreateJob-1 {functionName} {client_job_id}')
-            try:
-                f = hi2.get_function(functionName)
-                if f is not None:
-                    with hi2.Config(log=self._hither_log):
-                        job_or_result = f(**kwargs, labbox=self._labbox_context)
-                else:
-                    raise Exception(f'Hither function not registered: {functionName}')
-            except Exception as err:
+            f = hi2.get_function(functionName)
+            if f is None:
                 self._send_message({
                     'type': 'hitherJobError',
                     'job_id': client_job_id,
                     'client_job_id': client_job_id,
-                    'error_message': f'Error creating outer job: {str(err)}',
+                    'error_message': f'Error creating outer job: Hither function not registered: {functionName}',
                     'runtime_info': None
                 })
                 return
-            if isinstance(job_or_result, hi2.Job):
-                job: hi2.Job = job_or_result
-                setattr(job, '_client_job_id', client_job_id)
-                job_id = job.job_id
-                self._jobs_by_id[job_id] = job
-                print(f'======== Created hither job (2): {job_id} {functionName}')
-                self._log(f'hitherCreateJob-2 {functionName} {client_job_id} {job_id}')
-                self._send_message({
-                    'type': 'hitherJobCreated',
-                    'job_id': job_id,
-                    'client_job_id': client_job_id
-                })
-            else:
-                self._log(f'hitherCreateJob-3 {functionName} {client_job_id}')
-                result = job_or_result
-                msg = {
-                    'type': 'hitherJobFinished',
-                    'client_job_id': client_job_id,
-                    'job_id': client_job_id,
-                    # 'result': _make_json_safe(result),
-                    'result_sha1': _get_sha1_from_uri(kp.store_json(_make_json_safe(result))),
-                    'runtime_info': {}
-                }
+            job_key = _job_key(functionName, getattr(f, '_hither_function_version', None), kwargs)
+            # only the results of functions marked with @labbox.memoize_result are answered from memory
+            memoize = is_memoized(f)
+            if job_key is not None and memoize and self._answer_from_result_memo(job_key, job_id=client_job_id, client_job_id=client_job_id):
+                return
+            # the job id is known to the client from now on, so that it can cancel the job while it is queued
+            # (generated here, since client job ids are only unique within a tab)
+            job_id = f'job-{secrets.token_hex(10)}'
+            self._job_infos[job_id] = {
+                'client_job_id': client_job_id,
+                'function_name': functionName,
+                'kwargs': kwargs,
+                'job_key': job_key,
+                'memoize': memoize,
+                'queue_wait_sec': None,
+                'start_timestamp': None
+            }
+            self._send_message({
+                'type': 'hitherJobCreated',
+                'job_id': job_id,
+                'client_job_id': client_job_id
+            })
+            if job_key is not None and self._attach_job(job_id, job_key):
+                return
+            self._log(f'hitherCreateJob-2 {functionName} {client_job_id} {job_id}')
+            self._job_scheduler.submit(
+                self,
+                job_id,
+                priority=msg.get('priority', 0),
+                newest_first=msg.get('newestFirst', False),
+                timestamp=time.time(),
+                start=lambda queue_wait_sec: self._start_job(job_id, queue_wait_sec)
+            )
+            self._job_scheduler.dispatch(time.time())
+        elif type0 == 'sessionDetached':
+            # sent by the server when the connection drops; the jobs are cancelled if the session is not resumed
+            self._job_scheduler.pause_session(self)
+        elif type0 == 'sessionAttached':
+            self._job_scheduler.resume_session(self)
+            self._job_scheduler.dispatch(time.time())
         elif type0 == 'hitherCancelJob':
             job_id = msg['job_id']
             self._log(f'hitherCancelJob-1 {job_id}')
             assert job_id, 'Missing job_id'
-            assert job_id in self._jobs_by_id, f'No job with id: {job_id}'
+            assert job_id in self._job_infos, f'No job with id: {job_id}'
+            if job_id not in self._jobs_by_id:
+                # still queued
+                self._job_scheduler.cancel(self, job_id)
+                self._send_job_cancelled(job_id)
+                return
             job = self._jobs_by_id[job_id]
-            job.cancel()
+            if self._release_job(job_id):
+                # reported as an error by iterate once the job is actually cancelled
+                job.cancel()
+            else:
+                # other requests are still attached to this job, so leave it running
+                del self._jobs_by_id[job_id]
+                self._send_job_cancelled(job_id)
         elif type0 == 'subfeedMessageRequest':
             request_id = msg['requestId']
             feed_uri = msg['feedUri']
@@ -156,22 +237,17 @@ class WorkerSession:
                 'timestamp': time.time()
             }
 
-    def iterate(self):
+    def iterate(self, *, subfeed_wait_msec: int=100):
         self._log('iterate')
+        self._job_scheduler.dispatch(time.time())
         while True:
             found_something = False
             subfeed_message_request_ids = list(self._subfeed_message_requests.keys())
             if len(subfeed_message_request_ids) > 0:
                 msgs_for_client = []
-                subfeed_watches = {}
-                for smr_id in subfeed_message_request_ids:
-                    smr = self._subfeed_message_requests[smr_id]
-                    subfeed_watches[smr_id] = {
-                        'position': smr['position'],
-                        'feedId': _feed_id_from_uri(smr['feed_uri']),
-                        'subfeedHash': _subfeed_hash_from_name(smr['subfeed_name'])
-                    }
-                messages = kp.watch_for_new_messages(subfeed_watches=subfeed_watches, wait_msec=100)
+                subfeed_watches = self.get_subfeed_watches()
+                # deduplicated with the other sessions in this process watching the same subfeeds
+                messages = get_subfeed_watch_registry().watch_for_new_messages(subfeed_watches, wait_msec=subfeed_wait_msec)
                 resolved_subfeed_message_requests: Set[str] = set()
                 for watch_name in messages.keys():
                     num_new_messages = len(messages[watch_name])
@@ -204,6 +280,7 @@ class WorkerSession:
                 break
         
         hi2.wait(0)
+        self._check_job_progress()
         job_ids = list(self._jobs_by_id.keys())
         for job_id in job_ids:
             job = self._jobs_by_id[job_id]
@@ -212,34 +289,187 @@ class WorkerSession:
                 print(f'======== Finished hither job: {job_id} {job.function_name} ({job.function_version})')
                 result = job.result
                 assert result is not None, 'Result of finished job is None'
+                # the last reports come before the result
+                self._check_job_progress(job_ids=[job_id])
                 # runtime_info = job.runtime_info
+                job_key = self._job_infos[job_id]['job_key'] if self._job_infos[job_id]['memoize'] else None
+                self._release_job(job_id)
                 del self._jobs_by_id[job_id]
-                client_job_id = getattr(job, '_client_job_id')
+                info = self._job_infos.pop(job_id)
+                _observe_job_run_time(info, 'finished')
+                client_job_id = info['client_job_id']
                 self._log(f'hitherJobFinished-1 {client_job_id} {job_id}')
                 msg = {
                     'type': 'hitherJobFinished',
                     'client_job_id': client_job_id,
                     'job_id': job_id,
                     # 'result': _make_json_safe(result),
-                    'result_sha1': _get_sha1_from_uri(kp.store_json(_make_json_safe(result.return_value))),
-                    'runtime_info': {}
+                    **_store_result_memoized(result.return_value, job_key, inline_max_bytes=self._inline_result_max_bytes),
+                    'runtime_info': _runtime_info(info)
                 }
                 self._send_message(msg)
             elif status0 == 'error':
                 result= job.result
                 assert result is not None, 'Result of errored job is None'
                 # runtime_info = job.get_runtime_info()
+                self._release_job(job_id)
                 del self._jobs_by_id[job_id]
-                client_job_id = getattr(job, '_client_job_id')
+                info = self._job_infos.pop(job_id)
+                _observe_job_run_time(info, 'error')
+                client_job_id = info['client_job_id']
                 self._log(f'hitherJobError-1 {client_job_id} {job_id}')
                 msg = {
                     'type': 'hitherJobError',
                     'job_id': job_id,
                     'client_job_id': client_job_id,
                     'error_message': str(result.error),
-                    'runtime_info': {}
+                    'runtime_info': _runtime_info(info)
                 }
                 self._send_message(msg)
+    def _start_job(self, job_id: str, queue_wait_sec: float) -> Union[hi2.Job, None]:
+        # called by the job scheduler, returns the job if one was started
+        info = self._job_infos[job_id]
+        info['queue_wait_sec'] = queue_wait_sec
+        get_metrics().observe('labbox_job_queue_wait_seconds', queue_wait_sec)
+        client_job_id = info['client_job_id']
+        job_key = info['job_key']
+        if job_key is not None:
+            # an identical job may have been started or finished while this one was queued
+            if info['memoize'] and self._answer_from_result_memo(job_key, job_id=job_id, client_job_id=client_job_id):
+                del self._job_infos[job_id]
+                return None
+            if self._attach_job(job_id, job_key):
+                return None
+        # deterministic, so that the hither job is the same for identical requests
+        self._creating_job = {'subfeed_name': job_key if job_key is not None else f'{job_id}-{time.time()}', 'channel': None, 'progress_watch': None}
+        try:
+            f = hi2.get_function(info['function_name'])
+            with hi2.Config(log=self._hither_log):
+                job_or_result = f(**info['kwargs'], labbox=self._labbox_context)
+        except Exception as err:
+            del self._job_infos[job_id]
+            self._send_message({
+                'type': 'hitherJobError',
+                'job_id': job_id,
+                'client_job_id': client_job_id,
+                'error_message': f'Error creating outer job: {str(err)}',
+                'runtime_info': _runtime_info(info)
+            })
+            return None
+        finally:
+            creating_job = self._creating_job
+            self._creating_job = None
+        if isinstance(job_or_result, hi2.Job):
+            job: hi2.Job = job_or_result
+            self._jobs_by_id[job_id] = job
+            info['start_timestamp'] = time.time()
+            if creating_job['progress_watch'] is not None:
+                info['progress_watch'] = creating_job['progress_watch']
+            if job_key is not None:
+                # the watch from the start of the job, for the sessions that attach to it
+                progress_watch = info.get('progress_watch', None)
+                get_job_coalescer().add_job(job_key, job, progress_watch=dict(progress_watch) if progress_watch is not None else None)
+            print(f'======== Created hither job (2): {job.job_id} {info["function_name"]}')
+            self._log(f'hitherCreateJob-3 {client_job_id} {job_id} {job.job_id}')
+            return job
+        else:
+            self._log(f'hitherCreateJob-4 {client_job_id} {job_id}')
+            del self._job_infos[job_id]
+            self._send_message({
+                'type': 'hitherJobFinished',
+                'client_job_id': client_job_id,
+                'job_id': job_id,
+                # 'result': _make_json_safe(result),
+                **_store_result_memoized(job_or_result, job_key if info['memoize'] else None, inline_max_bytes=self._inline_result_max_bytes),
+                'runtime_info': _runtime_info(info)
+            })
+            return None
+    def _answer_from_result_memo(self, job_key: str, *, job_id: str, client_job_id: str) -> bool:
+        result_fields = get_job_coalescer().get_result(job_key)
+        if result_fields is None:
+            return False
+        self._log(f'hitherCreateJob-5 {client_job_id} {job_id}')
+        self._send_message({
+            'type': 'hitherJobFinished',
+            'client_job_id': client_job_id,
+            'job_id': job_id,
+            **result_fields,
+            'runtime_info': {}
+        })
+        return True
+    def _attach_job(self, job_id: str, job_key: str) -> bool:
+        job = get_job_coalescer().attach_job(job_key)
+        if job is None:
+            return False
+        self._jobs_by_id[job_id] = job
+        self._job_infos[job_id]['start_timestamp'] = time.time()
+        progress_watch = get_job_coalescer().get_progress_watch(job_key)
+        if progress_watch is not None:
+            # from the start of the job, so that all partial results are received
+            self._job_infos[job_id]['progress_watch'] = dict(progress_watch)
+        print(f'======== Attached to hither job: {job.job_id} {job.function_name}')
+        self._log(f'hitherCreateJob-6 {job_id} {job.job_id}')
+        return True
+    def _get_job_progress_channel(self) -> dict:
+        if self._creating_job is None:
+            raise Exception('job_progress_channel() can only be called while creating a job')
+        if self._creating_job['channel'] is None:
+            self._creating_job['channel'] = create_job_progress_channel(self._creating_job['subfeed_name'])
+            # before the job exists, so that none of its reports are missed
+            self._creating_job['progress_watch'] = _create_job_progress_watch(self._creating_job['channel'])
+        return self._creating_job['channel']
+    def _check_job_progress(self, *, job_ids: Union[List[str], None]=None):
+        # sends hitherJobProgress messages for the progress reported by running jobs
+        # shared with the other sessions of the job (in a pool worker), except for the last check of a
+        # finished job, which must not get a recent result from before the last report
+        watch_for_new_messages = kp.watch_for_new_messages
+        if job_ids is None:
+            if time.time() - self._last_job_progress_check_timestamp < self._job_progress_interval_sec:
+                return
+            self._last_job_progress_check_timestamp = time.time()
+            job_ids = list(self._jobs_by_id.keys())
+            watch_for_new_messages = get_subfeed_watch_registry().watch_for_new_messages
+        progress_watches = {
+            job_id: self._job_infos[job_id]['progress_watch']
+            for job_id in job_ids
+            if self._job_infos.get(job_id, {}).get('progress_watch', None) is not None
+        }
+        if len(progress_watches) == 0:
+            return
+        messages = watch_for_new_messages(subfeed_watches=progress_watches, wait_msec=0)
+        msgs_for_client = []
+        for job_id, msgs in messages.items():
+            info = self._job_infos[job_id]
+            info['progress_watch']['position'] += len(msgs)
+            for i, m in enumerate(msgs):
+                # progress without a partial result is superseded by the next report
+                if 'partial' in m or i == len(msgs) - 1:
+                    msgs_for_client.append({
+                        'type': 'hitherJobProgress',
+                        'job_id': job_id,
+                        'client_job_id': info['client_job_id'],
+                        **{k: m[k] for k in ['fraction', 'message', 'partial'] if k in m}
+                    })
+        if len(msgs_for_client) > 0:
+            get_metrics().inc('labbox_job_progress_messages_total', len(msgs_for_client))
+            self._send_messages(msgs_for_client)
+    def _send_job_cancelled(self, job_id: str):
+        info = self._job_infos.pop(job_id)
+        self._send_message({
+            'type': 'hitherJobError',
+            'job_id': job_id,
+            'client_job_id': info['client_job_id'],
+            'error_message': 'Job cancelled',
+            'runtime_info': _runtime_info(info)
+        })
+    def _release_job(self, job_id: str) -> bool:
+        # returns True if no other request is still attached to the job
+        info = self._job_infos[job_id]
+        job_key = info['job_key']
+        if job_key is None:
+            return True
+        info['job_key'] = None
+        return get_job_coalescer().release_job(job_key, self._jobs_by_id[job_id])
     def on_messages(self, callback):
         self._on_messages_callbacks.append(callback)
     def _send_message(self, msg):
@@ -249,67 +479,103 @@ class WorkerSession:
         for cb in self._on_messages_callbacks:
             cb(msgs)
     def _get_job_handler_from_name(self, job_handler_name):
-        assert job_handler_name in self._labbox_config['job_handlers'], f'Job handler not found in config: {job_handler_name}'
-        a = self._labbox_config['job_handlers'][job_handler_name]
-        if a['type'] == 'local':
-            jh = self._local_job_handlers[job_handler_name]
+        return self._local_job_handlers.get_job_handler(job_handler_name)
+
+def _store_result(return_value: Any, *, inline_max_bytes: int=0) -> dict:
+    # returns the result fields of the hitherJobFinished message
+    metrics = get_metrics()
+    try:
+        # single pass from the result to the stored text
+        with metrics.time('labbox_result_encode_seconds', encoding='json'):
+            txt = encode_json(return_value)
+    except ContainsNdarrayError:
+        # results of functions decorated with @serialize(encoding='binary')
+        metrics.inc('labbox_results_total', mode='binary')
+        return {
+            'result_sha1': _store_binary(return_value),
+            'result_encoding': 'binary'
+        }
+    # the text is ascii (json.dumps escapes everything else), so its length is the number of bytes
+    if len(txt) < inline_max_bytes:
+        try:
+            # NaN and Infinity are not valid JSON, and would make the client drop the whole websocket frame
+            result = json.loads(txt, parse_constant=_reject_json_constant)
+        except ValueError:
+            pass
         else:
-            raise Exception(f'Unexpected job handler type: {a["type"]}')
-        return jh
+            # saves storing the result and the http round trip of the client to fetch it
+            metrics.inc('labbox_results_total', mode='inline')
+            return {
+                'result': result
+            }
+    metrics.inc('labbox_results_total', mode='sha1')
+    with metrics.time('labbox_result_store_seconds', encoding='json'):
+        uri = kp.store_text(txt)
+    return {
+        'result_sha1': _get_sha1_from_uri(uri)
+    }
 
-def _make_json_safe(x: Any):
-    if isinstance(x, np.integer):
-        return int(x)
-    elif isinstance(x, np.floating):
-        return float(x)
-    elif type(x) == dict:
-        ret = dict()
-        for key, val in x.items():
-            ret[key] = _make_json_safe(val)
-        return ret
-    elif (type(x) == list) or (type(x) == tuple):
-        return [_make_json_safe(val) for val in x]
-    elif isinstance(x, np.ndarray):
-        raise Exception('Cannot make ndarray json safe')
-    else:
-        if _is_jsonable(x):
-            # this will capture int, float, str, bool
-            return x
-    raise Exception(f'Item is not json safe: {type(x)}')
+def _reject_json_constant(name: str):
+    raise ValueError(f'Not valid JSON: {name}')
 
-def _is_jsonable(x) -> bool:
-    import json
-    try:
-        json.dumps(x)
-        return True
-    except:
-        return False
+def update_worker_metrics(worker_sessions: List[WorkerSession]):
+    # gauges of a worker process, set before its metrics are sent to the server process
+    metrics = get_metrics()
+    metrics.set_gauge('labbox_sessions', len(worker_sessions))
+    metrics.set_gauge('labbox_active_jobs', sum([WS.get_num_jobs() for WS in worker_sessions]))
+    metrics.set_gauge('labbox_pending_subfeed_requests', sum([WS.get_num_subfeed_message_requests() for WS in worker_sessions]))
 
-def _feed_id_from_uri(uri: str):
-    a = uri.split('/')
-    return a[2]
+def _observe_job_run_time(job_info: dict, status: str):
+    if job_info['start_timestamp'] is not None:
+        get_metrics().observe('labbox_job_run_seconds', time.time() - job_info['start_timestamp'], status=status)
 
-def _subfeed_hash_from_uri(uri: str):
-    a = uri.split('/')
-    n = a[3]
-    return _subfeed_hash_from_name(n)
+def _runtime_info(job_info: dict) -> dict:
+    if job_info['queue_wait_sec'] is None:
+        return {}
+    return {'queue_wait_sec': job_info['queue_wait_sec']}
 
-def _subfeed_hash_from_name(subfeed_name: Union[str, dict]):
-    if isinstance(subfeed_name, str):
-        if subfeed_name.startswith('~'):
-            return subfeed_name[1:]
-        return _sha1_of_string(subfeed_name)
-    else:
-        return _sha1_of_object(subfeed_name)
+def _store_result_memoized(return_value: Any, job_key: Union[str, None], *, inline_max_bytes: int=0) -> dict:
+    if job_key is None:
+        return _store_result(return_value, inline_max_bytes=inline_max_bytes)
+    coalescer = get_job_coalescer()
+    # a request attached to the same job may have stored the result already
+    result_fields = coalescer.get_result(job_key)
+    if result_fields is None:
+        result_fields = _store_result(return_value, inline_max_bytes=inline_max_bytes)
+        coalescer.set_result(job_key, result_fields)
+    return result_fields
+
+def _store_binary(x: Any) -> str:
+    metrics = get_metrics()
+    with tempfile.TemporaryDirectory(prefix='labbox_result_') as tmpdir:
+        path = f'{tmpdir}/result.lbxb'
+        with metrics.time('labbox_result_encode_seconds', encoding='binary'):
+            with open(path, 'wb') as f:
+                write_binary(x, f)
+        with metrics.time('labbox_result_store_seconds', encoding='binary'):
+            uri = kp.store_file(path)
+        return _get_sha1_from_uri(uri)
 
-def _sha1_of_string(txt: str) -> str:
-    hh = hashlib.sha1(txt.encode('utf-8'))
-    ret = hh.hexdigest()
-    return ret
+def _create_job_progress_watch(channel: dict) -> dict:
+    # reports of earlier runs of the same job are skipped
+    watch = {
+        'feedId': _feed_id_from_uri(channel['feed_uri']),
+        'subfeedHash': _subfeed_hash_from_name(channel['subfeed_name']),
+        'position': 0
+    }
+    messages = kp.watch_for_new_messages(subfeed_watches={'w': watch}, wait_msec=0)
+    watch['position'] = len(messages.get('w', []))
+    return watch
 
-def _sha1_of_object(obj: object) -> str:
-    txt = json.dumps(obj, sort_keys=True, separators=(',', ':'))
-    return _sha1_of_string(txt)
+def _make_json_safe(x: Any):
+    return _serialize(x, ndarray_encoding='error')
+
+def _job_key(function_name: str, function_version: Union[str, None], kwargs: dict) -> Union[str, None]:
+    try:
+        return _sha1_of_object({'functionName': function_name, 'functionVersion': function_version, 'kwargs': kwargs})
+    except TypeError:
+        # kwargs that are not json serializable are never coalesced
+        return None
 
 def _get_sha1_from_uri(uri: str) -> str:
     protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
@@ -0,0 +1,92 @@
+import time
+import socket
+import threading
+import traceback
+import multiprocessing.connection
+from typing import Callable, Union
+
+# hither does not signal job completion (its job handlers only make progress when hi2.wait is called),
+# so while jobs are active we still need to check on them periodically: at first at a short interval, then
+# less often the longer the jobs have not changed, which adds at most a fraction of their run time to their latency
+JOB_CHECK_INTERVAL_SEC = 0.02
+JOB_CHECK_MAX_INTERVAL_SEC = 0.25
+JOB_CHECK_BACKOFF_FRACTION = 0.1
+# how long each call to the daemon blocks while watching for new subfeed messages in the background
+SUBFEED_WATCH_WAIT_MSEC = 250
+
+class WorkerWakeup:
+    """
+    Lets a worker process sleep until there is something to do (event-driven mode)
+
+    The worker loop blocks on the pipe from the parent together with a wakeup socket.
+    A background thread watches the subfeeds of all pending subfeed message requests
+    and writes to the wakeup socket as soon as new messages arrive. The loop also
+    wakes up when a subfeed message request times out, and polls while hither jobs
+    are active (see JOB_CHECK_INTERVAL_SEC).
+    """
+    def __init__(self, *, get_worker_sessions: Callable[[], list]):
+        self._get_worker_sessions = get_worker_sessions
+        self._wakeup_receive_socket, self._wakeup_send_socket = socket.socketpair()
+        self._wakeup_receive_socket.setblocking(False)
+        self._subfeed_watches_changed = threading.Event()
+        self._woken_for_subfeeds = threading.Event()
+        # number of queued and running jobs, and since when
+        self._num_jobs = 0
+        self._num_jobs_timestamp = time.time()
+        self._subfeed_watcher_thread = threading.Thread(target=self._run_subfeed_watcher, daemon=True)
+        self._subfeed_watcher_thread.start()
+    def notify_subfeed_message_requests_changed(self):
+        self._subfeed_watches_changed.set()
+    def wait(self, pipe_to_parent):
+        # the worker loop has just iterated, so anything the subfeed watcher found has been handled
+        self._woken_for_subfeeds.clear()
+        timeout = self._get_timeout()
+        if timeout is None or timeout > 0:
+            multiprocessing.connection.wait([pipe_to_parent, self._wakeup_receive_socket], timeout=timeout)
+        self._drain_wakeup_socket()
+    def _get_timeout(self) -> Union[float, None]:
+        worker_sessions = self._get_worker_sessions()
+        num_jobs = sum([WS.get_num_jobs() for WS in worker_sessions])
+        if num_jobs != self._num_jobs:
+            self._num_jobs = num_jobs
+            self._num_jobs_timestamp = time.time()
+        if num_jobs > 0:
+            elapsed = time.time() - self._num_jobs_timestamp
+            return min(JOB_CHECK_MAX_INTERVAL_SEC, max(JOB_CHECK_INTERVAL_SEC, elapsed * JOB_CHECK_BACKOFF_FRACTION))
+        deadlines = [WS.get_subfeed_message_request_deadline() for WS in worker_sessions]
+        deadlines = [d for d in deadlines if d is not None]
+        if len(deadlines) > 0:
+            return max(0, min(deadlines) - time.time())
+        # nothing is pending: sleep until the parent sends something
+        return None
+    def _drain_wakeup_socket(self):
+        try:
+            while self._wakeup_receive_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+    def _run_subfeed_watcher(self):
+        from ._subfeedwatchregistry import get_subfeed_watch_registry
+        while True:
+            if self._woken_for_subfeeds.is_set():
+                # wait for the worker loop to handle the messages we already found
+                time.sleep(0.005)
+                continue
+            subfeed_watches = {}
+            for i, WS in enumerate(self._get_worker_sessions()):
+                for smr_id, watch in WS.get_subfeed_watches().items():
+                    subfeed_watches[f'{i}:{smr_id}'] = watch
+            if len(subfeed_watches) == 0:
+                self._subfeed_watches_changed.wait()
+                self._subfeed_watches_changed.clear()
+                continue
+            self._subfeed_watches_changed.clear()
+            try:
+                messages = get_subfeed_watch_registry().watch_for_new_messages(subfeed_watches, wait_msec=SUBFEED_WATCH_WAIT_MSEC)
+            except:
+                traceback.print_exc()
+                time.sleep(1)
+                continue
+            if any([len(msgs) > 0 for msgs in messages.values()]):
+                self._woken_for_subfeeds.set()
+                self._wakeup_send_socket.send(b'x')
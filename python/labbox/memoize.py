@@ -0,0 +1,24 @@
+def memoize_result(f):
+    """
+    Decorator that marks a hither function as deterministic, so that its results may be answered from memory
+
+    A hitherCreateJob that repeats the function name, version and kwargs of a
+    recently finished job of a marked function gets that job's result, without
+    the function being called (see LABBOX_JOB_RESULT_MEMO_SIZE). Functions that
+    are not marked, e.g. ones that read a feed or the clock, are called for
+    every request; leaving out the decorator is how to opt out. Identical
+    requests that arrive while a job is running share that job either way.
+    The memo is kept by each worker process, so it is shared between sessions
+    only when they are served by a session pool (LABBOX_SESSION_POOL_SIZE).
+
+    Apply it directly to the function, below @hi2.function and @serialize:
+
+        @hi2.function('createjob_x', '0.1.0')
+        @labbox.memoize_result
+        def createjob_x(labbox, ...):
+    """
+    setattr(f, '_labbox_memoize_result', True)
+    return f
+
+def is_memoized(f) -> bool:
+    return getattr(f, '_labbox_memoize_result', False)
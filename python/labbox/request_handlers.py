@@ -1,16 +1,83 @@
 import os
 import json
+import tornado.web
 from notebook.base.handlers import IPythonHandler
 from notebook.utils import url_path_join
-import kachery_p2p as kp
+from .api import create_sha1_content_cache_from_env, get_messages_batch, load_sha1_content_batch, get_feed_handle_pool
+from .api import create_array_slice_reader_from_env, InvalidSliceError, InvalidBatchRequestError, Sha1File
+
+_STREAM_CHUNK_BYTES = 1024 * 1024
+
+_global = {
+    'sha1_cache': None,
+    'array_slice_reader': None
+}
+def _global_sha1_cache():
+    c = _global['sha1_cache']
+    if c is None:
+        c = create_sha1_content_cache_from_env()
+        _global['sha1_cache'] = c
+    return c
+
+def _global_array_slice_reader():
+    r = _global['array_slice_reader']
+    if r is None:
+        r = create_array_slice_reader_from_env(_global_sha1_cache())
+        _global['array_slice_reader'] = r
+    return r
 
 class Sha1Handler(IPythonHandler):
-    def get(self):
+    async def get(self):
         sha1 = self.request.path.split('/')[-1]
-        txt = kp.load_text(f'sha1://{sha1}', p2p=False)
-        if txt is None:
-            raise Exception('Unable to load file.')
-        self.finish(txt)
+        status, headers, body = _global_sha1_cache().create_response(
+            sha1,
+            accept_encoding=self.request.headers.get('Accept-Encoding', None),
+            if_none_match=self.request.headers.get('If-None-Match', None)
+        )
+        if status == 404:
+            raise tornado.web.HTTPError(404, reason='Unable to load file.')
+        self.set_status(status)
+        for k, v in headers.items():
+            self.set_header(k, v)
+        if isinstance(body, Sha1File):
+            # too large for the cache, so it is streamed from the kachery storage rather than read into memory
+            self.set_header('Content-Length', str(body.size))
+            with open(body.path, 'rb') as f:
+                while True:
+                    chunk = f.read(_STREAM_CHUNK_BYTES)
+                    if len(chunk) == 0:
+                        break
+                    self.write(chunk)
+                    await self.flush()
+            self.finish()
+            return
+        self.finish(body)
+
+class ArrayHandler(IPythonHandler):
+    def get(self):
+        manifest_sha1 = self.request.path.split('/')[-1]
+        try:
+            status, headers, body = _global_array_slice_reader().create_response(manifest_sha1, self.get_argument('slice', None))
+        except InvalidSliceError as err:
+            raise tornado.web.HTTPError(400, reason=str(err))
+        if status == 404:
+            raise tornado.web.HTTPError(404, reason='Unable to load array manifest.')
+        self.set_status(status)
+        for k, v in headers.items():
+            self.set_header(k, v)
+        self.finish(body)
+
+class Sha1BatchHandler(IPythonHandler):
+    def post(self):
+        x = json.loads(self.request.body)
+        sha1s = x['sha1s']
+        results = load_sha1_content_batch(_global_sha1_cache(), sha1s)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({'results': results}))
+
+class Sha1CacheStatsHandler(IPythonHandler):
+    def get(self):
+        self.finish(json.dumps(_global_sha1_cache().get_stats()))
 
 class FeedGetMessagesHandler(IPythonHandler):
     def post(self):
@@ -18,28 +85,32 @@ class FeedGetMessagesHandler(IPythonHandler):
         feed_uri = x['feedUri']
         subfeed_name = x['subfeedName']
         position = x['position']
-        if feed_uri:
-            feed = kp.load_feed(feed_uri)
-        else:
-            raise Exception('No feed_uri')
-        subfeed = feed.get_subfeed(subfeed_name)
-        subfeed.set_position(position)
-        messages = subfeed.get_next_messages()
+        if not feed_uri:
+            raise tornado.web.HTTPError(400, reason='No feedUri')
+        _, messages = get_feed_handle_pool().get_messages(feed_uri, subfeed_name, position)
         txt = json.dumps(messages)
         self.finish(txt)
 
+class FeedGetMessagesBatchHandler(IPythonHandler):
+    def post(self):
+        x = json.loads(self.request.body)
+        requests = x['requests']
+        # does not wait for new messages (no X-Labbox-Long-Poll header), the client falls back to the websocket
+        try:
+            messages = get_messages_batch(requests)
+        except InvalidBatchRequestError as err:
+            raise tornado.web.HTTPError(400, reason=str(err))
+        self.finish(json.dumps({'messages': messages}))
+
 class FeedAppendMessagesHandler(IPythonHandler):
     def post(self):
         x = json.loads(self.request.body)
         feed_uri = x['feedUri']
         subfeed_name = x['subfeedName']
         messages = x['messages']
-        if feed_uri:
-            feed = kp.load_feed(feed_uri)
-        else:
-            raise Exception('No feed_uri')
-        subfeed = feed.get_subfeed(subfeed_name)
-        subfeed.append_messages(messages)
+        if not feed_uri:
+            raise tornado.web.HTTPError(400, reason='No feedUri')
+        get_feed_handle_pool().append_messages(feed_uri, subfeed_name, messages)
         txt = json.dumps({'success': True})
         self.finish(txt)
 
@@ -51,14 +122,31 @@ def load_jupyter_server_extension(nb_server_app):
         nb_server_app (NotebookWebApplication): handle to the Notebook webserver instance.
     """
     web_app = nb_server_app.web_app
+    # must come before /sha1/.*
+    host_pattern = '.*$'
+    route_pattern = url_path_join(web_app.settings['base_url'], '/sha1/batch')
+    web_app.add_handlers(host_pattern, [(route_pattern, Sha1BatchHandler)])
+
     host_pattern = '.*$'
     route_pattern = url_path_join(web_app.settings['base_url'], '/sha1/.*')
     web_app.add_handlers(host_pattern, [(route_pattern, Sha1Handler)])
 
+    host_pattern = '.*$'
+    route_pattern = url_path_join(web_app.settings['base_url'], '/array/.*')
+    web_app.add_handlers(host_pattern, [(route_pattern, ArrayHandler)])
+
+    host_pattern = '.*$'
+    route_pattern = url_path_join(web_app.settings['base_url'], '/stats/sha1Cache')
+    web_app.add_handlers(host_pattern, [(route_pattern, Sha1CacheStatsHandler)])
+
     host_pattern = '.*$'
     route_pattern = url_path_join(web_app.settings['base_url'], '/feed/getMessages')
     web_app.add_handlers(host_pattern, [(route_pattern, FeedGetMessagesHandler)])
 
+    host_pattern = '.*$'
+    route_pattern = url_path_join(web_app.settings['base_url'], '/feed/getMessagesBatch')
+    web_app.add_handlers(host_pattern, [(route_pattern, FeedGetMessagesBatchHandler)])
+
     host_pattern = '.*$'
     route_pattern = url_path_join(web_app.settings['base_url'], '/feed/appendMessages')
     web_app.add_handlers(host_pattern, [(route_pattern, FeedAppendMessagesHandler)])
\ No newline at end of file
@@ -1,44 +1,404 @@
-from functools import wraps 
+from functools import wraps
+import os
+import sys
+import json
 import base64
-import numpy as np
+import tempfile
+from typing import TYPE_CHECKING, Any, List, Tuple, Union
 
-def serialize(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        output = f(*args, **kwargs)
-        return _serialize(output)
-    return wrapper
+# numpy is imported by the functions that use it, so that importing labbox (and the serialize decorator) stays cheap
+if TYPE_CHECKING:
+    import numpy as np
 
-def _serialize(x):
+def serialize(f=None, *, encoding: str='json'):
+    """
+    Decorator that makes the output of a (hither) function serializable
+
+    With encoding='json' (the default), ndarrays are base64-encoded into the JSON result.
+    With encoding='binary', ndarrays are passed through as they are, and are
+    written as raw little-endian buffers when the result is stored (see write_binary).
+    With encoding='chunked', each ndarray is stored in kachery as a grid of chunks
+    (see store_chunked_ndarray) and only a reference to it is returned, so that
+    clients can fetch the slices they need from the /array endpoint.
+
+    Can be used as @serialize or @serialize(encoding='binary')
+    """
+    assert encoding in ['json', 'binary', 'chunked'], f'Unexpected encoding: {encoding}'
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            output = f(*args, **kwargs)
+            return _serialize(output, ndarray_encoding=encoding)
+        return wrapper
+    if f is not None:
+        return decorator(f)
+    return decorator
+
+# leaf types that are already JSON-safe (checked by exact type, which is much cheaper than json.dumps)
+_JSON_SAFE_LEAF_TYPES = {str, int, float, bool, type(None)}
+# exact-type lookup for the common numpy scalars (isinstance checks are the fallback)
+# filled in by the fallback, the first time it sees a numpy object
+_NUMPY_SCALAR_CONVERTERS: dict = {}
+
+def _add_numpy_scalar_converters():
+    import numpy as np
+    _NUMPY_SCALAR_CONVERTERS.update({
+        **{t: int for t in [np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64]},
+        **{t: float for t in [np.float16, np.float32, np.float64]},
+        np.bool_: bool
+    })
+
+def _serialize(x, *, ndarray_encoding: str='json'):
+    """
+    Convert x to a JSON-safe tree in a single pass
+
+    Containers whose contents are already JSON-safe are returned as they are
+    (not rebuilt), so this is cheap for results that need no conversion.
+    """
+    t = type(x)
+    if t in _JSON_SAFE_LEAF_TYPES:
+        return x
+    converter = _NUMPY_SCALAR_CONVERTERS.get(t, None)
+    if converter is not None:
+        return converter(x)
+    elif t == dict:
+        ret = None
+        for key, val in x.items():
+            val2 = _serialize(val, ndarray_encoding=ndarray_encoding)
+            if ret is not None:
+                ret[key] = val2
+            elif val2 is not val:
+                # first item that changed: copy what we have so far
+                ret = dict()
+                for key0, val0 in x.items():
+                    if key0 == key:
+                        break
+                    ret[key0] = val0
+                ret[key] = val2
+        return ret if ret is not None else x
+    elif t == list:
+        ret_list = None
+        for i, val in enumerate(x):
+            val2 = _serialize(val, ndarray_encoding=ndarray_encoding)
+            if ret_list is not None:
+                ret_list.append(val2)
+            elif val2 is not val:
+                ret_list = x[:i]
+                ret_list.append(val2)
+        return ret_list if ret_list is not None else x
+    elif t == tuple:
+        return [_serialize(val, ndarray_encoding=ndarray_encoding) for val in x]
+    import numpy as np
+    if len(_NUMPY_SCALAR_CONVERTERS) == 0:
+        _add_numpy_scalar_converters()
     if isinstance(x, np.integer):
         return int(x)
     elif isinstance(x, np.floating):
         return float(x)
-    elif type(x) == dict:
-        ret = dict()
-        for key, val in x.items():
-            ret[key] = _serialize(val)
-        return ret
-    elif (type(x) == list) or (type(x) == tuple):
-        return [_serialize(val) for val in x]
+    elif isinstance(x, np.bool_):
+        return bool(x)
     elif isinstance(x, np.ndarray):
-        # todo: worry about byte order and data type here
-        return {
-            '_type': 'ndarray',
-            'shape': _serialize(x.shape),
-            'dtype': str(x.dtype),
-            'data_b64': base64.b64encode(x.ravel()).decode()
-        }
+        if ndarray_encoding == 'binary':
+            return x
+        elif ndarray_encoding == 'json':
+            return _ndarray_to_json(x)
+        elif ndarray_encoding == 'chunked':
+            return store_chunked_ndarray(x)
+        raise Exception('Cannot make ndarray json safe')
     else:
         if _is_jsonable(x):
-            # this will capture int, float, str, bool
+            # this will capture int, float, str, bool subclasses
             return x
     raise Exception(f'Item is not json safe: {type(x)}')
 
+def _ndarray_to_json(x: 'np.ndarray') -> dict:
+    import numpy as np
+    x = np.ascontiguousarray(_little_endian(x))
+    return {
+        '_type': 'ndarray',
+        'shape': [int(s) for s in x.shape],
+        'dtype': str(x.dtype),
+        'data_b64': base64.b64encode(x.ravel()).decode()
+    }
+
 def _is_jsonable(x) -> bool:
     import json
     try:
         json.dumps(x)
         return True
     except:
-        return False
\ No newline at end of file
+        return False
+
+class ContainsNdarrayError(Exception):
+    pass
+
+def encode_json(x: Any, *, ndarray_encoding: str='error') -> str:
+    """
+    Encode x as JSON text in a single pass
+
+    The C JSON encoder walks the tree directly. Only items it cannot handle
+    (numpy scalars and ndarrays) are converted along the way, so the tree is
+    never rebuilt. With ndarray_encoding='json', ndarrays are base64-encoded
+    as in @serialize. Otherwise, a ContainsNdarrayError is raised when an
+    ndarray is found, so that the caller can switch to the binary encoding.
+    """
+    def default(y):
+        converter = _NUMPY_SCALAR_CONVERTERS.get(type(y), None)
+        if converter is not None:
+            return converter(y)
+        import numpy as np
+        if len(_NUMPY_SCALAR_CONVERTERS) == 0:
+            _add_numpy_scalar_converters()
+        if isinstance(y, np.integer):
+            return int(y)
+        elif isinstance(y, np.floating):
+            return float(y)
+        elif isinstance(y, np.bool_):
+            return bool(y)
+        elif isinstance(y, np.ndarray):
+            if ndarray_encoding == 'json':
+                return _ndarray_to_json(y)
+            raise ContainsNdarrayError()
+        raise Exception(f'Item is not json safe: {type(y)}')
+    return json.dumps(x, default=default, separators=(',', ':'))
+
+########################################################################
+# Binary encoding
+#
+# Layout:
+#   4 bytes   magic: b'LBXB'
+#   4 bytes   header length N (uint32, little-endian)
+#   N bytes   header: utf-8 JSON, padded with spaces so that the first buffer is 8-byte aligned
+#   buffers   raw little-endian, C-order array data, each starting at an 8-byte aligned offset
+#
+# The header is {"version": 1, "root": ..., "buffers": [{"offset": ..., "nbytes": ...}, ...]}
+# where root is the JSON-safe result, with each ndarray replaced by
+# {"_type": "ndarray", "shape": [...], "dtype": "float32", "byteorder": "little", "buffer": <index>}
+# The data of datetime64 and timedelta64 arrays is their int64 representation, with a dtype such as "datetime64[ns]"
+
+BINARY_MAGIC = b'LBXB'
+_ALIGNMENT = 8
+# non-contiguous arrays are written piece by piece; pieces that need a copy are at most this size
+_MAX_COPY_CHUNK_BYTES = 4 * 1024 * 1024
+
+def is_binary_encoded(buf: Union[bytes, memoryview]) -> bool:
+    return bytes(buf[:4]) == BINARY_MAGIC
+
+def write_binary(x: Any, f) -> int:
+    """
+    Write x (a JSON-safe tree that may contain ndarrays) to the binary file-like object f
+
+    Array data is written directly from the arrays (no full copy, even for
+    non-contiguous views). Returns the number of bytes written.
+    """
+    header_bytes, arrays = _create_binary_header(x)
+    num_bytes_written = 0
+    for chunk in _iter_binary_chunks(header_bytes, arrays):
+        f.write(chunk)
+        num_bytes_written += len(chunk)
+    return num_bytes_written
+
+def encode_binary(x: Any) -> bytes:
+    header_bytes, arrays = _create_binary_header(x)
+    return b''.join(_iter_binary_chunks(header_bytes, arrays))
+
+def decode_binary(buf: Union[bytes, memoryview]) -> Any:
+    """
+    Decode the output of encode_binary / write_binary
+
+    The returned ndarrays are read-only views into buf (no copy).
+    """
+    import numpy as np
+    buf = memoryview(buf)
+    if not is_binary_encoded(buf):
+        raise Exception('Not a binary-encoded labbox result')
+    header_length = int(np.frombuffer(buf, dtype='<u4', count=1, offset=4)[0])
+    header = json.loads(bytes(buf[8:8 + header_length]).decode('utf-8'))
+    if header['version'] != 1:
+        raise Exception(f'Unexpected binary encoding version: {header["version"]}')
+    buffers = header['buffers']
+    def restore(y):
+        if type(y) == dict:
+            if y.get('_type', None) == 'ndarray' and 'buffer' in y:
+                b = buffers[y['buffer']]
+                dtype = np.dtype(y['dtype']).newbyteorder('<')
+                shape = tuple(y['shape'])
+                count = b['nbytes'] // dtype.itemsize if dtype.itemsize > 0 else 0
+                return np.frombuffer(buf, dtype=dtype, count=count, offset=b['offset']).reshape(shape)
+            return {k: restore(v) for k, v in y.items()}
+        elif type(y) == list:
+            return [restore(v) for v in y]
+        else:
+            return y
+    return restore(header['root'])
+
+def _create_binary_header(x: Any) -> Tuple[bytes, List['np.ndarray']]:
+    import numpy as np
+    arrays: List['np.ndarray'] = []
+    def convert(y):
+        if isinstance(y, np.ndarray):
+            if y.dtype.hasobject or y.dtype.fields is not None:
+                raise Exception(f'Cannot binary-encode ndarray with dtype: {y.dtype}')
+            y = _little_endian(y)
+            arrays.append(y)
+            return {
+                '_type': 'ndarray',
+                'shape': [int(s) for s in y.shape],
+                'dtype': str(y.dtype),
+                'byteorder': 'little',
+                'buffer': len(arrays) - 1
+            }
+        elif isinstance(y, np.integer):
+            return int(y)
+        elif isinstance(y, np.floating):
+            return float(y)
+        elif isinstance(y, np.bool_):
+            return bool(y)
+        elif type(y) == dict:
+            return {k: convert(v) for k, v in y.items()}
+        elif (type(y) == list) or (type(y) == tuple):
+            return [convert(v) for v in y]
+        else:
+            return y
+    root = convert(x)
+    # the header length affects the buffer offsets and vice versa, so iterate until it is stable
+    header_length = 0
+    while True:
+        offset = _aligned(8 + header_length)
+        buffers = []
+        for a in arrays:
+            buffers.append({'offset': offset, 'nbytes': int(a.nbytes)})
+            offset = _aligned(offset + a.nbytes)
+        header_json = json.dumps({'version': 1, 'root': root, 'buffers': buffers}).encode('utf-8')
+        if 8 + len(header_json) <= _aligned(8 + header_length):
+            break
+        header_length = len(header_json)
+    header_length = _aligned(8 + header_length) - 8
+    header_bytes = BINARY_MAGIC + np.array([header_length], dtype='<u4').tobytes() + header_json + b' ' * (header_length - len(header_json))
+    return header_bytes, arrays
+
+def _iter_binary_chunks(header_bytes: bytes, arrays: List['np.ndarray']):
+    yield header_bytes
+    for a in arrays:
+        for chunk in _iter_contiguous_chunks(a):
+            yield chunk
+        padding = _aligned(a.nbytes) - a.nbytes
+        if padding > 0:
+            yield b'\0' * padding
+
+def _iter_contiguous_chunks(x: 'np.ndarray'):
+    # yields the bytes of x in C order, without copying the parts that are already contiguous
+    import numpy as np
+    if x.nbytes == 0:
+        return
+    if x.dtype.kind in 'mM':
+        # datetime64 and timedelta64 do not support the buffer protocol; their data is int64 (little-endian here)
+        x = x.view('<i8')
+    if x.flags.c_contiguous:
+        yield memoryview(x.reshape(-1)).cast('B')
+        return
+    row_nbytes = x.nbytes // x.shape[0]
+    if x.ndim == 1 or row_nbytes < _MAX_COPY_CHUNK_BYTES // 16:
+        # small (or strided) rows: copy blocks of rows
+        num_rows_per_chunk = max(1, _MAX_COPY_CHUNK_BYTES // max(row_nbytes, 1))
+        for i in range(0, x.shape[0], num_rows_per_chunk):
+            yield memoryview(np.ascontiguousarray(x[i:i + num_rows_per_chunk]).reshape(-1)).cast('B')
+        return
+    for i in range(x.shape[0]):
+        for chunk in _iter_contiguous_chunks(x[i]):
+            yield chunk
+
+def _little_endian(x: 'np.ndarray') -> 'np.ndarray':
+    if x.dtype.byteorder == '>' or (x.dtype.byteorder == '=' and sys.byteorder == 'big'):
+        return x.astype(x.dtype.newbyteorder('<'))
+    return x
+
+def _aligned(n: int) -> int:
+    return ((n + _ALIGNMENT - 1) // _ALIGNMENT) * _ALIGNMENT
+
+########################################################################
+# Chunked encoding
+#
+# An ndarray is split into a regular grid of chunks (the last chunk along
+# each axis may be smaller), and each chunk is stored in kachery as raw
+# little-endian, C-order data, without a header. The manifest, stored as
+# JSON text, is
+#   {"_type": "ndarray_chunk_manifest", "version": 1, "shape": [...], "dtype": "float32",
+#    "byteorder": "little", "chunks": [...], "chunk_sha1s": [...]}
+# where chunks is the chunk shape and chunk_sha1s lists the chunks of the grid in C order.
+# In the result, the array is replaced by
+#   {"_type": "ndarray_chunked", "shape": [...], "dtype": "float32", "chunks": [...], "manifest_sha1": ...}
+
+def get_chunk_target_bytes() -> int:
+    return int(os.environ.get('LABBOX_ARRAY_CHUNK_BYTES', str(1024 * 1024)))
+
+def choose_chunk_shape(shape: Tuple[int, ...], itemsize: int, target_bytes: int) -> List[int]:
+    """
+    Chunk shape of at most target_bytes (or a single element), obtained by repeatedly halving the longest axis
+
+    For a timeseries (in either orientation) this gives chunks that span all
+    channels and a range of timepoints.
+    """
+    chunks = [max(int(s), 1) for s in shape]
+    while _product(chunks) * itemsize > target_bytes and max(chunks) > 1:
+        i = chunks.index(max(chunks))
+        chunks[i] = (chunks[i] + 1) // 2
+    return chunks
+
+def chunk_grid_shape(shape: List[int], chunks: List[int]) -> List[int]:
+    return [(s + c - 1) // c for s, c in zip(shape, chunks)]
+
+def iter_chunk_regions(shape: List[int], chunks: List[int]):
+    """
+    Yields the region (a tuple of slices) of each chunk of the grid, in C order
+    """
+    import numpy as np
+    grid = chunk_grid_shape(shape, chunks)
+    for index in (np.ndindex(*grid) if len(grid) > 0 else [()]):
+        yield tuple(slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(index, chunks, shape))
+
+def store_chunked_ndarray(x: 'np.ndarray', *, target_bytes: Union[int, None]=None) -> dict:
+    """
+    Store x in kachery as a chunk grid plus a manifest, and return the reference that goes in the result
+    """
+    import kachery_p2p as kp
+    if x.dtype.hasobject or x.dtype.fields is not None:
+        raise Exception(f'Cannot chunk ndarray with dtype: {x.dtype}')
+    x = _little_endian(x)
+    shape = [int(s) for s in x.shape]
+    chunks = choose_chunk_shape(x.shape, x.dtype.itemsize, target_bytes if target_bytes is not None else get_chunk_target_bytes())
+    chunk_sha1s = []
+    with tempfile.TemporaryDirectory(prefix='labbox_chunks_') as tmpdir:
+        path = f'{tmpdir}/chunk.dat'
+        for region in iter_chunk_regions(shape, chunks):
+            with open(path, 'wb') as f:
+                for piece in _iter_contiguous_chunks(x[region]):
+                    f.write(piece)
+            chunk_sha1s.append(_sha1_from_uri(kp.store_file(path)))
+    manifest = {
+        '_type': 'ndarray_chunk_manifest',
+        'version': 1,
+        'shape': shape,
+        'dtype': str(x.dtype),
+        'byteorder': 'little',
+        'chunks': chunks,
+        'chunk_sha1s': chunk_sha1s
+    }
+    manifest_uri = kp.store_text(json.dumps(manifest, separators=(',', ':')))
+    return {
+        '_type': 'ndarray_chunked',
+        'shape': shape,
+        'dtype': manifest['dtype'],
+        'chunks': chunks,
+        'manifest_sha1': _sha1_from_uri(manifest_uri)
+    }
+
+def _product(x: List[int]) -> int:
+    ret = 1
+    for a in x:
+        ret *= a
+    return ret
+
+def _sha1_from_uri(uri: str) -> str:
+    # sha1://<sha1>/<basename>
+    return uri.split('/')[2]
@@ -18,5 +18,9 @@ setuptools.setup(
         'pyyaml',
         'aiohttp',
         'aiohttp_cors'
-    ]
+    ],
+    extras_require={
+        # binary websocket framing of the session protocol
+        'msgpack': ['msgpack']
+    }
 )
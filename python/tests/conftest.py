@@ -0,0 +1,15 @@
+"""
+The tests run against the in-process stand-ins for kachery_p2p and hither2 of the benchmark suite
+"""
+
+import os
+import sys
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, f'{thisdir}/..')
+sys.path.insert(0, f'{thisdir}/../benchmarks')
+
+from _fakes import install_fakes
+
+# before anything imports labbox.api
+install_fakes()
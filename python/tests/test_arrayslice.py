@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from labbox.api._arrayslice import ArraySliceReader, InvalidSliceError, format_slice, parse_slice
+from labbox.api._sha1cache import Sha1ContentCache
+from labbox.serialize import decode_binary, store_chunked_ndarray
+
+@pytest.mark.parametrize('slice_str,shape,expected', [
+    (None, [10, 3], [(0, 10), (0, 3)]),
+    ('', [10], [(0, 10)]),
+    ('2:5', [10, 3], [(2, 5), (0, 3)]),
+    (':,1', [10, 3], [(0, 10), (1, 2)]),
+    ('4:', [10], [(4, 10)]),
+    (':7', [10], [(0, 7)]),
+    # stops beyond the end are clipped
+    ('8:100', [10], [(8, 10)]),
+    (' 1 : 3 , 0:2 ', [10, 3], [(1, 3), (0, 2)]),
+    ('10:10', [10], [(10, 10)])
+])
+def test_parse_slice(slice_str, shape, expected):
+    ranges = parse_slice(slice_str, shape)
+    assert ranges == expected
+    assert parse_slice(format_slice(ranges), shape) == ranges
+
+@pytest.mark.parametrize('slice_str,shape', [
+    ('1:2,3:4', [10]),
+    ('a:b', [10]),
+    ('1:2:3', [10]),
+    ('x', [10]),
+    ('-1:3', [10]),
+    ('5:2', [10]),
+    ('11:12', [10])
+])
+def test_parse_slice_rejects_invalid_slices(slice_str, shape):
+    with pytest.raises(InvalidSliceError):
+        parse_slice(slice_str, shape)
+
+def test_slices_of_a_chunked_array():
+    x = np.random.RandomState(0).randn(1000, 4).astype(np.float32)
+    ref = store_chunked_ndarray(x, target_bytes=4096)
+    reader = ArraySliceReader(sha1_cache=Sha1ContentCache(max_bytes=10 * 1024 * 1024, compress_min_bytes=1024 * 1024), max_slice_bytes=1024 * 1024, max_open_chunks=4)
+    for slice_str, expected in [('95:605', x[95:605]), ('0:1000,2', x[:, 2:3]), (None, x)]:
+        status, headers, body = reader.create_response(ref['manifest_sha1'], slice_str)
+        assert status == 200
+        assert np.array_equal(decode_binary(body), expected)
+    with pytest.raises(InvalidSliceError):
+        reader.create_response(ref['manifest_sha1'], '0:10,0:1,0:1')
+    status, _, _ = reader.create_response('0' * 40, None)
+    assert status == 404
+
+def test_slices_larger_than_the_limit_are_rejected():
+    x = np.zeros((1000, 10), dtype=np.float64)
+    ref = store_chunked_ndarray(x, target_bytes=8192)
+    reader = ArraySliceReader(sha1_cache=Sha1ContentCache(max_bytes=1024 * 1024, compress_min_bytes=1024 * 1024), max_slice_bytes=8000, max_open_chunks=4)
+    status, _, _ = reader.create_response(ref['manifest_sha1'], '0:100')
+    assert status == 200
+    with pytest.raises(InvalidSliceError):
+        reader.create_response(ref['manifest_sha1'], '0:101')
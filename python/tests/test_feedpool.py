@@ -0,0 +1,57 @@
+import threading
+
+import kachery_p2p as kp
+from labbox.api._feedpool import FeedHandlePool
+
+def _create_pool(**kwargs) -> FeedHandlePool:
+    return FeedHandlePool(max_feeds=10, max_subfeeds=10, idle_sec=300, **kwargs)
+
+def test_get_messages_reuses_the_subfeed_handle():
+    feed = kp.load_feed('test-feedpool-get', create=True)
+    feed.get_subfeed('main').append_messages([{'index': i} for i in range(3)])
+    pool = _create_pool()
+    feed_id, messages = pool.get_messages(feed.get_uri(), 'main', 0)
+    assert feed_id == feed.get_feed_id()
+    assert messages == [{'index': i} for i in range(3)]
+    feed.get_subfeed('main').append_messages([{'index': 3}])
+    # where the previous request left off
+    _, messages = pool.get_messages(feed.get_uri(), 'main', 3)
+    assert messages == [{'index': 3}]
+    _, messages = pool.get_messages(feed.get_uri(), 'main', 1)
+    assert len(messages) == 3
+    stats = pool.get_stats()
+    assert stats['numFeedLoads'] == 1
+    assert stats['numSubfeedLoads'] == 1
+    assert stats['numCursorHits'] == 1
+
+def test_appends_are_combined_in_order():
+    feed = kp.load_feed('test-feedpool-append', create=True)
+    # appends that arrive while the batch of the first one waits are written with it
+    pool = _create_pool(append_batch_msec=200)
+    num_threads = 8
+    started = threading.Barrier(num_threads)
+    def append(i: int):
+        started.wait()
+        pool.append_messages(feed.get_uri(), 'main', [{'thread': i, 'index': j} for j in range(3)])
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(num_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    _, messages = pool.get_messages(feed.get_uri(), 'main', 0)
+    assert len(messages) == 3 * num_threads
+    # the messages of each call stay together and in order
+    for k in range(0, len(messages), 3):
+        assert [m['index'] for m in messages[k:k + 3]] == [0, 1, 2]
+        assert len(set([m['thread'] for m in messages[k:k + 3]])) == 1
+    stats = pool.get_stats()
+    assert stats['numAppendRequests'] == num_threads
+    assert stats['numAppendCalls'] < num_threads
+
+def test_sequential_appends_keep_their_order():
+    feed = kp.load_feed('test-feedpool-append-sequential', create=True)
+    pool = _create_pool()
+    for i in range(5):
+        pool.append_messages(feed.get_uri(), {'name': 'json-subfeed'}, [{'index': i}])
+    _, messages = pool.get_messages(feed.get_uri(), {'name': 'json-subfeed'}, 0)
+    assert [m['index'] for m in messages] == list(range(5))
@@ -0,0 +1,80 @@
+import hither2 as hi2
+import labbox
+from labbox.api._jobcoalescer import JobCoalescer, get_job_coalescer
+from labbox.api._workersession import WorkerSession
+
+_num_calls = {'labbox_tests_clock': 0, 'labbox_tests_clock_memoized': 0}
+
+@hi2.function('labbox_tests_clock', '0.1.0')
+def clock(labbox):
+    _num_calls['labbox_tests_clock'] += 1
+    return _num_calls['labbox_tests_clock']
+
+@hi2.function('labbox_tests_clock_memoized', '0.1.0')
+@labbox.serialize
+@labbox.memoize_result
+def clock_memoized(labbox):
+    _num_calls['labbox_tests_clock_memoized'] += 1
+    return _num_calls['labbox_tests_clock_memoized']
+
+def _run_jobs(function_names):
+    ws = WorkerSession(labbox_config={'job_handlers': {}}, default_feed_name='test')
+    messages = []
+    ws.on_messages(lambda msgs: messages.extend(msgs))
+    ws.initialize()
+    for i, function_name in enumerate(function_names):
+        ws.handle_message({'type': 'hitherCreateJob', 'functionName': function_name, 'kwargs': {}, 'clientJobId': f'c{i}'})
+        ws.iterate(subfeed_wait_msec=0)
+    ws.cleanup()
+    return [m for m in messages if m['type'] == 'hitherJobFinished']
+
+def test_repeated_memoized_job_is_answered_without_running():
+    num_hits = get_job_coalescer().get_stats()['numResultHits']
+    finished = _run_jobs(['labbox_tests_clock_memoized', 'labbox_tests_clock_memoized'])
+    assert [m['client_job_id'] for m in finished] == ['c0', 'c1']
+    assert finished[0]['result'] == finished[1]['result']
+    assert _num_calls['labbox_tests_clock_memoized'] == 1
+    assert get_job_coalescer().get_stats()['numResultHits'] == num_hits + 1
+
+def test_unmarked_job_runs_every_time():
+    finished = _run_jobs(['labbox_tests_clock', 'labbox_tests_clock'])
+    assert [m['result'] for m in finished] == [1, 2]
+    assert _num_calls['labbox_tests_clock'] == 2
+
+def test_attach_and_release():
+    c = JobCoalescer(max_results=10)
+    job = object()
+    assert c.attach_job('k') is None
+    c.add_job('k', job, progress_watch={'position': 3})
+    assert c.attach_job('k') is job
+    assert c.get_progress_watch('k') == {'position': 3}
+    # released by one of the two requests
+    assert c.release_job('k', job) is False
+    assert c.release_job('k', job) is True
+    assert c.attach_job('k') is None
+    # a job that has been replaced under the same key
+    assert c.release_job('k', object()) is True
+    stats = c.get_stats()
+    assert stats['numJobsStarted'] == 1
+    assert stats['numJobsAttached'] == 1
+    assert stats['numRunningJobs'] == 0
+
+def test_result_memo_is_lru():
+    c = JobCoalescer(max_results=2)
+    c.set_result('a', {'result_sha1': 'a'})
+    c.set_result('b', {'result_sha1': 'b'})
+    # makes 'b' the least recently used
+    assert c.get_result('a') == {'result_sha1': 'a'}
+    c.set_result('c', {'result_sha1': 'c'})
+    assert c.get_result('b') is None
+    assert c.get_result('a') is not None
+    assert c.get_result('c') is not None
+    stats = c.get_stats()
+    assert stats['numResults'] == 2
+    assert stats['numResultEvictions'] == 1
+    assert stats['numResultHits'] == 3
+
+def test_result_memo_disabled():
+    c = JobCoalescer(max_results=0)
+    c.set_result('a', {'result_sha1': 'a'})
+    assert c.get_result('a') is None
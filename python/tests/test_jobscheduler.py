@@ -0,0 +1,124 @@
+import multiprocessing
+
+from labbox.api._hostjobslots import HostJobSlots
+from labbox.api._jobscheduler import JobScheduler
+
+class _Job:
+    def __init__(self):
+        self.status = 'running'
+
+class _Submitter:
+    # submits jobs to the scheduler and records the order in which they are started
+    def __init__(self, scheduler: JobScheduler):
+        self._scheduler = scheduler
+        self.started = []
+        self.jobs = {}
+    def submit(self, session_key, job_id, *, priority=0, newest_first=False):
+        def start(queue_wait_sec):
+            self.started.append(job_id)
+            job = _Job()
+            self.jobs[job_id] = job
+            return job
+        self._scheduler.submit(session_key, job_id, priority=priority, newest_first=newest_first, timestamp=0, start=start)
+    def finish(self, job_id):
+        self.jobs[job_id].status = 'finished'
+
+def test_sessions_take_turns():
+    s = JobScheduler(max_running=2)
+    x = _Submitter(s)
+    for i in range(5):
+        x.submit('a', f'a{i}')
+    x.submit('b', 'b0')
+    x.submit('b', 'b1')
+    s.dispatch(0)
+    # b is not starved by the jobs that a queued first
+    assert x.started == ['a0', 'b0']
+    x.finish('a0')
+    s.dispatch(0)
+    # a has no job running now, b has one
+    assert x.started == ['a0', 'b0', 'a1']
+    x.finish('b0')
+    x.finish('a1')
+    s.dispatch(0)
+    # ties go to the session that started a job the longest time ago
+    assert x.started == ['a0', 'b0', 'a1', 'b1', 'a2']
+    stats = s.get_stats()
+    assert stats['numRunning'] == 2
+    assert stats['numQueued'] == 2
+    assert stats['numStarted'] == 5
+
+def test_priority_and_newest_first():
+    s = JobScheduler(max_running=1)
+    x = _Submitter(s)
+    x.submit('a', 'low')
+    x.submit('a', 'high', priority=1)
+    x.submit('a', 'low2')
+    s.dispatch(0)
+    assert x.started == ['high']
+    x.finish('high')
+    s.dispatch(0)
+    x.finish('low')
+    s.dispatch(0)
+    assert x.started == ['high', 'low', 'low2']
+
+    s = JobScheduler(max_running=1)
+    x = _Submitter(s)
+    for i in range(3):
+        x.submit('a', f'j{i}', newest_first=True)
+    for _ in range(3):
+        s.dispatch(0)
+        x.finish(x.started[-1])
+    assert x.started == ['j2', 'j1', 'j0']
+
+def test_cancel_and_remove_session():
+    s = JobScheduler(max_running=1)
+    x = _Submitter(s)
+    x.submit('a', 'a0')
+    x.submit('a', 'a1')
+    x.submit('a', 'a2')
+    assert s.cancel('a', 'a1') is True
+    assert s.cancel('a', 'a1') is False
+    s.dispatch(0)
+    s.remove_session('a')
+    x.finish('a0')
+    s.dispatch(0)
+    assert x.started == ['a0']
+    assert s.get_stats()['numCancelled'] == 2
+
+def test_paused_session_keeps_its_queue_and_takes_no_slots():
+    s = JobScheduler(max_running=1)
+    x = _Submitter(s)
+    x.submit('a', 'a0')
+    x.submit('b', 'b0')
+    s.pause_session('a')
+    s.dispatch(0)
+    assert x.started == ['b0']
+    x.finish('b0')
+    s.dispatch(0)
+    assert x.started == ['b0']
+    assert s.get_stats()['numQueued'] == 1
+    s.resume_session('a')
+    s.dispatch(0)
+    assert x.started == ['b0', 'a0']
+
+def test_host_job_slots_bound_the_running_jobs():
+    slots = HostJobSlots(multiprocessing.BoundedSemaphore(1), multiprocessing.Value('i', 0))
+    # as for the scheduler of another worker process of the host
+    other = HostJobSlots(slots._semaphore, multiprocessing.Value('i', 0))
+    s = JobScheduler(max_running=4, host_job_slots=slots)
+    x = _Submitter(s)
+    x.submit('a', 'a0')
+    x.submit('a', 'a1')
+    s.dispatch(0)
+    assert x.started == ['a0']
+    assert slots.get_num_held() == 1
+    assert other.try_acquire() is False
+    x.finish('a0')
+    s.dispatch(0)
+    assert x.started == ['a0', 'a1']
+    x.finish('a1')
+    s.dispatch(0)
+    assert slots.get_num_held() == 0
+    assert other.try_acquire() is True
+    other.release_all()
+    assert slots.try_acquire() is True
@@ -0,0 +1,80 @@
+import io
+import json
+
+import numpy as np
+import pytest
+from labbox.serialize import ContainsNdarrayError, _serialize, decode_binary, encode_binary, encode_json, is_binary_encoded, serialize, write_binary
+
+def _decode_json_ndarray(x: dict) -> np.ndarray:
+    import base64
+    return np.frombuffer(base64.b64decode(x['data_b64']), dtype=x['dtype']).reshape(x['shape'])
+
+def test_json_safe_values_are_returned_as_they_are():
+    x = {'a': [1, 2.5, 'x', None, True], 'b': {'c': []}}
+    assert _serialize(x) is x
+
+def test_numpy_values_are_converted():
+    x = {'a': [1, np.int32(2)], 'b': np.float32(0.5), 'c': (np.bool_(True), np.uint8(3))}
+    y = _serialize(x)
+    assert y == {'a': [1, 2], 'b': 0.5, 'c': [True, 3]}
+    assert type(y['a'][1]) == int
+    assert json.loads(json.dumps(y)) == y
+
+def test_serialize_decorator():
+    @serialize
+    def f(n):
+        return {'values': np.arange(n, dtype=np.int16)[::-1]}
+    y = f(4)
+    assert y['values']['_type'] == 'ndarray'
+    assert np.array_equal(_decode_json_ndarray(y['values']), [3, 2, 1, 0])
+    @serialize(encoding='binary')
+    def g():
+        return {'values': np.arange(3)}
+    assert isinstance(g()['values'], np.ndarray)
+
+def test_encode_json():
+    x = {'a': np.float64(1.5), 'b': [np.int64(2)]}
+    assert json.loads(encode_json(x)) == {'a': 1.5, 'b': [2]}
+    with pytest.raises(ContainsNdarrayError):
+        encode_json({'a': np.arange(3)})
+    y = json.loads(encode_json({'a': np.arange(3)}, ndarray_encoding='json'))
+    assert np.array_equal(_decode_json_ndarray(y['a']), [0, 1, 2])
+
+@pytest.mark.parametrize('x', [
+    np.arange(12, dtype=np.float32).reshape(3, 4),
+    np.arange(24, dtype=np.int64).reshape(2, 3, 4)[:, ::2, 1:],
+    np.arange(10, dtype='>i4'),
+    np.array([True, False]),
+    np.zeros((0, 3), dtype=np.uint16),
+    np.array(['2020-01-01', '2021-06-30'], dtype='datetime64[ns]'),
+    np.arange(6).astype('timedelta64[s]')[::2]
+])
+def test_binary_round_trip(x):
+    y = decode_binary(encode_binary({'x': x, 'meta': {'n': np.int32(3), 'name': 'a'}}))
+    assert y['meta'] == {'n': 3, 'name': 'a'}
+    assert y['x'].shape == x.shape
+    assert y['x'].dtype == x.dtype.newbyteorder('<')
+    assert np.array_equal(y['x'], x)
+
+def test_write_binary_matches_encode_binary():
+    x = {'a': np.random.RandomState(0).randn(1000, 7)[:, 1:5], 'b': [np.arange(5), 'text']}
+    f = io.BytesIO()
+    num_bytes = write_binary(x, f)
+    buf = f.getvalue()
+    assert num_bytes == len(buf)
+    assert buf == encode_binary(x)
+    assert is_binary_encoded(buf)
+    y = decode_binary(buf)
+    assert np.array_equal(y['a'], x['a'])
+    assert y['b'][1] == 'text'
+    # read-only views of the buffer
+    assert not y['a'].flags.writeable
+
+def test_binary_encoding_rejects_object_arrays():
+    with pytest.raises(Exception, match='dtype'):
+        encode_binary({'x': np.array([{}, []], dtype=object)})
+
+def test_decode_binary_rejects_other_content():
+    assert not is_binary_encoded(b'{"a": 1}')
+    with pytest.raises(Exception):
+        decode_binary(b'{"a": 1}')
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from labbox.api._sessionresume import ResumableSession, SessionRegistry, parse_num_received
+
+class _Session:
+    # stand-in for Session, whose worker process sends the messages in self.outgoing
+    def __init__(self):
+        self.outgoing = []
+        self.incoming = []
+        self.cleaned_up = False
+    def handle_message(self, msg):
+        self.incoming.append(msg)
+    def elapsed_sec_since_incoming_keepalive(self):
+        return 0
+    async def wait_for_outgoing_messages(self, *, timeout_sec: float):
+        await asyncio.sleep(0.001)
+    def check_for_outgoing_messages(self):
+        ret = self.outgoing
+        self.outgoing = []
+        return ret
+    def cleanup(self):
+        self.cleaned_up = True
+
+def _messages(start: int, stop: int):
+    return [{'type': 'm', 'index': i} for i in range(start, stop)]
+
+@pytest.mark.parametrize('x,expected', [
+    (0, 0), (12, 12), ('7', 7), (3.0, 3),
+    (-1, None), ('abc', None), (None, None), ([1], None), (float('inf'), None), (float('nan'), None)
+])
+def test_parse_num_received(x, expected):
+    assert parse_num_received(x) == expected
+
+def test_acknowledged_messages_are_trimmed():
+    rs = ResumableSession(session=_Session(), token='t', max_retained_messages=100)
+    rs._receive(_messages(0, 10))
+    assert rs.check_for_outgoing_messages() == _messages(0, 10)
+    assert rs.check_for_outgoing_messages() == []
+    rs.handle_message({'type': 'keepAlive', 'received': 6})
+    assert list(rs._retained) == _messages(6, 10)
+    # a malformed count is ignored, and the keepalive still goes to the session
+    rs.handle_message({'type': 'keepAlive', 'received': 'x'})
+    assert list(rs._retained) == _messages(6, 10)
+    assert len(rs.session.incoming) == 2
+    assert rs._can_resume(6)
+    assert rs._can_resume(10)
+    assert not rs._can_resume(5)
+    assert not rs._can_resume(11)
+
+def test_messages_dropped_before_they_were_sent_prevent_resuming():
+    rs = ResumableSession(session=_Session(), token='t', max_retained_messages=5)
+    rs._receive(_messages(0, 3))
+    assert len(rs.check_for_outgoing_messages()) == 3
+    rs._receive(_messages(3, 10))
+    assert list(rs._retained) == _messages(5, 10)
+    assert not rs._can_resume(5)
+
+def test_resume_replays_the_missed_messages():
+    async def run():
+        sessions = []
+        def create_session():
+            sessions.append(_Session())
+            return sessions[-1]
+        registry = SessionRegistry(create_session=create_session, grace_sec=60, max_retained_messages=100)
+        rs, connection_id, resumed = registry.attach(None, 0)
+        assert not resumed
+        sessions[0].outgoing = _messages(0, 5)
+        await asyncio.sleep(0.05)
+        assert rs.check_for_outgoing_messages() == _messages(0, 5)
+        # the connection drops after the client received 3 of them, and more messages arrive meanwhile
+        registry.detach(rs, connection_id)
+        assert registry.get_num_detached_sessions() == 1
+        assert sessions[0].incoming[-1] == {'type': 'sessionDetached'}
+        sessions[0].outgoing = _messages(5, 7)
+        await asyncio.sleep(0.05)
+        rs2, connection_id2, resumed = registry.attach(rs.token, 3)
+        assert resumed
+        assert rs2 is rs
+        assert registry.is_attached(rs, connection_id2)
+        assert not registry.is_attached(rs, connection_id)
+        assert {'type': 'sessionAttached'} in sessions[0].incoming
+        assert rs.check_for_outgoing_messages() == _messages(3, 7)
+        assert len(sessions) == 1
+        # the client says it received messages that were never sent
+        rs3, _, resumed = registry.attach(rs.token, 100)
+        assert not resumed
+        assert rs3 is not rs
+        assert sessions[0].cleaned_up
+        registry.cleanup()
+        assert sessions[1].cleaned_up
+    asyncio.run(run())
+
+def test_detached_session_expires_after_grace_period():
+    async def run():
+        session = _Session()
+        registry = SessionRegistry(create_session=lambda: session, grace_sec=0.05, max_retained_messages=100)
+        rs, connection_id, _ = registry.attach(None, 0)
+        registry.detach(rs, connection_id)
+        await asyncio.sleep(0.2)
+        assert session.cleaned_up
+        _, _, resumed = registry.attach(rs.token, 0)
+        assert not resumed
+        registry.cleanup()
+    asyncio.run(run())
@@ -0,0 +1,105 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+from labbox.api._shmpipe import SharedMemoryPipe, _is_writable
+
+@pytest.fixture
+def pipes():
+    a, b = multiprocessing.Pipe()
+    sender = SharedMemoryPipe(a, shm_min_bytes=64 * 1024, direction='to_worker')
+    receiver = SharedMemoryPipe(b, shm_min_bytes=64 * 1024, direction='from_worker')
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+def test_small_messages(pipes):
+    sender, receiver = pipes
+    sender.send({'type': 'incoming_message', 'message': {'x': 1}})
+    sender.send('exit')
+    assert receiver.poll()
+    assert receiver.recv() == {'type': 'incoming_message', 'message': {'x': 1}}
+    assert receiver.recv() == 'exit'
+    assert not receiver.poll()
+    assert sender.get_stats()['numShmMessagesSent'] == 0
+
+def test_small_message_with_buffers(pipes):
+    sender, receiver = pipes
+    x = np.arange(10, dtype=np.float32)
+    y = np.arange(5)
+    y.flags.writeable = False
+    sender.send({'x': x, 'y': y})
+    z = receiver.recv()
+    assert np.array_equal(z['x'], x)
+    assert np.array_equal(z['y'], y)
+    # as with an in-band pickle
+    assert z['x'].flags.writeable
+    assert not z['y'].flags.writeable
+    assert sender.get_stats()['numShmMessagesSent'] == 0
+
+def test_large_messages_reuse_the_segment(pipes):
+    sender, receiver = pipes
+    for i in range(3):
+        sender.send({'kwargs': list(range(i, 50000 + i))})
+        assert receiver.recv()['kwargs'][0] == i
+        # the acknowledgement is handled when the sender polls
+        assert not sender.poll()
+    stats = sender.get_stats()
+    assert stats['numShmMessagesSent'] == 3
+    assert stats['numSegmentsCreated'] == 1
+    assert stats['numSegmentsInUse'] == 0
+    assert stats['numFreeSegments'] == 1
+    assert receiver.get_stats()['numShmMessagesReceived'] == 3
+
+def test_large_message_with_buffers_is_received_in_place(pipes):
+    sender, receiver = pipes
+    x = np.random.RandomState(0).randn(100000)
+    sender.send({'x': x})
+    y = receiver.recv()['x']
+    assert np.array_equal(x, y)
+    assert not sender.poll()
+    # the segment is left to the receiver, whose array refers to it
+    stats = sender.get_stats()
+    assert stats['numSegmentsInUse'] == 0
+    assert stats['numFreeSegments'] == 0
+    assert receiver.get_stats()['numRetainedSegments'] == 1
+    del y
+    receiver.poll()
+    assert receiver.get_stats()['numRetainedSegments'] == 0
+
+def test_acks_wait_while_the_pipe_is_full(pipes):
+    sender, receiver = pipes
+    # the sender is not reading what the receiver sends
+    num_fillers = 0
+    while _is_writable(receiver._conn):
+        receiver.send('filler')
+        num_fillers += 1
+    sender.send(b'x' * 100000)
+    # does not block on writing the acknowledgement
+    assert len(receiver.recv()) == 100000
+    for _ in range(num_fillers):
+        assert sender.recv() == 'filler'
+    assert sender.get_stats()['numSegmentsInUse'] == 1
+    receiver.poll()
+    assert not sender.poll()
+    assert sender.get_stats()['numSegmentsInUse'] == 0
+
+def test_acks_go_out_with_the_next_message(pipes):
+    sender, receiver = pipes
+    sender.send(b'x' * 100000)
+    assert len(receiver.recv()) == 100000
+    receiver.send('reply')
+    assert sender.recv() == 'reply'
+    assert sender.get_stats()['numSegmentsInUse'] == 0
+
+def test_without_shared_memory():
+    a, b = multiprocessing.Pipe()
+    sender = SharedMemoryPipe(a, shm_min_bytes=0, direction='to_worker')
+    receiver = SharedMemoryPipe(b, shm_min_bytes=0, direction='from_worker')
+    # small enough for the buffer of the pipe, since both ends are in this thread
+    x = np.arange(1000)
+    sender.send({'x': x})
+    assert np.array_equal(receiver.recv()['x'], x)
+    assert sender.get_stats()['numShmMessagesSent'] == 0
+    sender.close()
+    receiver.close()
@@ -1,13 +1,25 @@
+import { decode, encode } from "@msgpack/msgpack"
 import { ApiConfig } from "./LabboxProvider"
 
+// websocket subprotocols of the session protocol (see python/labbox/api/_framing.py)
+const SUBPROTOCOL_MSGPACK = 'labbox.msgpack.v1'
+const SUBPROTOCOL_JSON = 'labbox.json.v1'
+
 class ApiConnection {
     _ws: WebSocket | null = null
     _isConnected: boolean = false
     _onMessageCallbacks: ((m: any) => void)[] = []
     _onConnectCallbacks: (() => void)[] = []
     _onDisconnectCallbacks: (() => void)[] = []
-    _isDisconnected = false // once disconnected, cannot reconnect - need to create a new instance
+    _isDisconnected = false
     _queuedMessages: any[] = []
+    // the server keeps the session of a dropped connection for graceSec, and a reconnect with
+    // the token resumes it: jobs keep running and the messages missed in the meantime are sent
+    _sessionToken: string | null = null
+    _sessionGraceSec = 0
+    _numReceived = 0 // messages of the session received, not counting reportSessionToken
+    _numAcknowledged = 0
+    _disconnectTimestamp = 0
 
     constructor(private apiConfig: ApiConfig | undefined) {
         this._start();
@@ -28,12 +40,17 @@ class ApiConnection {
             this._onConnectCallbacks.forEach(cb => cb())
         }
         else {
-            const url = apiConfig.webSocketUrl;
+            let url = apiConfig.webSocketUrl;
             if (!url) throw Error('No webSocketUrl')
-            const ws = new WebSocket(url)
+            if (this._sessionToken) {
+                url += `${url.includes('?') ? '&' : '?'}resumeToken=${this._sessionToken}&received=${this._numReceived}`
+            }
+            // with msgpack framing, the server falls back to json if it does not support msgpack
+            const ws = apiConfig.webSocketFraming === 'msgpack' ? new WebSocket(url, [SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON]) : new WebSocket(url)
+            ws.binaryType = 'arraybuffer'
             this._ws = ws
-            console.log(ws);
             ws.addEventListener('open', () => {
+                if (this._ws !== ws) return
                 this._isConnected = true;
                 this._isDisconnected = false;
                 const qm = this._queuedMessages;
@@ -44,22 +61,42 @@ class ApiConnection {
                 this._onConnectCallbacks.forEach(cb => cb());
             });
             ws.addEventListener('message', evt => {
-                const x = JSON.parse(evt.data);
+                if (this._ws !== ws) return
+                const x = evt.data instanceof ArrayBuffer ? decode(new Uint8Array(evt.data)) as any : JSON.parse(evt.data);
                 if (!Array.isArray(x)) {
                     console.warn(x)
                     console.warn('Error getting message, expected a list')
                     return
                 }
-                console.info('INCOMING MESSAGES', x);
+                if (apiConfig.verbose) console.info('INCOMING MESSAGES', x);
                 for (const m of x) {
+                    if (m.type === 'reportSessionToken') {
+                        if (!m.resumed) this._numReceived = 0
+                        this._sessionToken = m.token
+                        this._sessionGraceSec = m.graceSec
+                        this._numAcknowledged = this._numReceived
+                        continue
+                    }
+                    this._numReceived ++
                     this._onMessageCallbacks.forEach(cb => cb(m))
                 }
+                if (this._numReceived - this._numAcknowledged >= acknowledgeEveryNumMessages) {
+                    // so that the server does not need to keep many messages for a possible resume
+                    this._sendKeepAlive()
+                }
             });
             ws.addEventListener('close', () => {
-                console.warn('Websocket disconnected.');
+                if (this._ws !== ws) return
+                const wasConnected = this._isConnected
                 this._isConnected = false;
                 this._isDisconnected = true;
-                this._onDisconnectCallbacks.forEach(cb => cb())
+                if (wasConnected) this._disconnectTimestamp = Number(new Date())
+                // failed attempts to resume do not count as another disconnect
+                if ((wasConnected) || (!this._sessionToken)) {
+                    console.warn('Websocket disconnected.');
+                    this._onDisconnectCallbacks.forEach(cb => cb())
+                }
+                this._scheduleResume()
             })
         }
     }
@@ -67,8 +104,24 @@ class ApiConnection {
         if (!this._isDisconnected) {
             throw Error('Error: Cannot reconnect if not disconnected')
         }
+        if ((this._ws) && (this._ws.readyState === WebSocket.CONNECTING)) {
+            // already trying to resume the session
+            return
+        }
         this._connect()
     }
+    _scheduleResume() {
+        // retries with backoff while the server still keeps the session
+        if (!this._sessionToken) return
+        const elapsedMsec = Number(new Date()) - this._disconnectTimestamp
+        if (elapsedMsec > this._sessionGraceSec * 1000) return
+        const delayMsec = Math.min(Math.max(elapsedMsec, 500), 8000)
+        setTimeout(() => {
+            if ((this._isDisconnected) && ((!this._ws) || (this._ws.readyState === WebSocket.CLOSED))) {
+                this._connect()
+            }
+        }, delayMsec)
+    }
     onMessage(cb: (m: any) => void) {
         this._onMessageCallbacks.push(cb);
     }
@@ -96,27 +149,40 @@ class ApiConnection {
         if (apiConfig.jupyterMode) {
             const model = apiConfig.jupyterModel
             if (!model) throw Error('No jupyter model.')
-            console.info('OUTGOING MESSAGE (jupyter)', msg);
+            if (apiConfig.verbose) console.info('OUTGOING MESSAGE (jupyter)', msg);
             model.send(msg, {})
         }
         else {
-            if ((!this._isConnected) && (!this._isDisconnected)) {
+            if (!this._isConnected) {
+                // sent once connected (again)
                 this._queuedMessages.push(msg);
                 return;
             }
             if (!this._ws) throw Error('Unexpected: _ws is null')
-            console.info('OUTGOING MESSAGE', msg);
-            this._ws.send(JSON.stringify(msg));
+            if (apiConfig.verbose) console.info('OUTGOING MESSAGE', msg);
+            if (this._ws.protocol === SUBPROTOCOL_MSGPACK) {
+                this._ws.send(encode(msg));
+            }
+            else {
+                this._ws.send(JSON.stringify(msg));
+            }
         }
     }
     async _start() {
         while (true) {
             await sleepMsec(17000);
-            if (!this._isDisconnected) this.sendMessage({ type: 'keepAlive' });
+            if (!this._isDisconnected) this._sendKeepAlive();
         }
     }
+    _sendKeepAlive() {
+        // also acknowledges the messages received so far
+        this._numAcknowledged = this._numReceived
+        this.sendMessage({ type: 'keepAlive', received: this._numReceived });
+    }
 }
 
+const acknowledgeEveryNumMessages = 500
+
 const sleepMsec = (m: number) => new Promise(r => setTimeout(r, m));
 
 export default ApiConnection
\ No newline at end of file
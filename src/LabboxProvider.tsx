@@ -94,9 +94,6 @@ const useHitherInterface = (apiConnection: ApiConnection, apiConfig: ApiConfig |
                 // if connection has not yet been established, then the message will be queued in the apiConnection
                 // but if disconnected, we will handle queuing here
                 state.current.queuedHitherJobMessages.push(msg)
-                if (msg.type === 'hitherCreateJob') {
-                    state.current.queuedHitherJobMessages.push(msg)
-                }
             }
         })
         apiConnection.onMessage(msg => {
@@ -110,6 +107,9 @@ const useHitherInterface = (apiConnection: ApiConnection, apiConfig: ApiConfig |
             else if (type0 === 'hitherJobCreated') {
                 y.handleHitherJobCreated(msg);
             }
+            else if (type0 === 'hitherJobProgress') {
+                y.handleHitherJobProgress(msg);
+            }
         });
         apiConnection.onConnect(() => {
             console.info('Connected to API server')
@@ -161,6 +161,8 @@ export type ApiConfig = {
     webSocketUrl: string // `ws://${window.location.hostname}:15308`
     baseSha1Url: string // `http://${window.location.hostname}:15309/sha1`
     baseFeedUrl?: string // `http://${window.location.hostname}:15309/feed`
+    webSocketFraming?: 'json' | 'msgpack' // msgpack uses binary frames if the server supports them (default json)
+    verbose?: boolean // log every incoming and outgoing message to the console
     jupyterMode?: boolean
     jupyterModel?: {
         send: (msg: any, o: any) => void
@@ -184,8 +186,26 @@ type SubfeedMessageRequest = {
     callback: (numNewMessages: number) => void
 }
 
+type FetchMessagesResult = {
+    messages: any[]
+    longPoll: boolean
+}
+
+type PendingFetch = {
+    feedUri: string
+    subfeedName: any
+    position: number
+    waitMsec: number
+    resolve: (x: FetchMessagesResult) => void
+    reject: (err: any) => void
+}
+
+const getMessagesBatchWindowMsec = 20
+
 class SubfeedManager {
     _subfeedMessageRequests: {[key: string]: SubfeedMessageRequest} = {}
+    _pendingFetches: PendingFetch[] = []
+    _batchSupported = true
     constructor(private apiConnection: ApiConnection, private baseFeedUrl: string | undefined) {
         apiConnection.onMessage(msg => {
             if (msg.type === 'subfeedMessageRequestResponse') {
@@ -200,14 +220,15 @@ class SubfeedManager {
         })
     }
     async getMessages(a: {feedUri: string, subfeedName: any, position: number, waitMsec: number}): Promise<any[]> {
-        const url = `${this.baseFeedUrl}/getMessages`
         const { feedUri, subfeedName, position, waitMsec } = a
-        const headers = this._postHeaders()
-        const result = await axios.post(url, {feedUri, subfeedName, position, waitMsec}, {headers})
-        const messages = result.data as any[]
+        const { messages, longPoll } = await this._fetchMessages(a)
         if (messages.length > 0) {
             return messages
         }
+        if (longPoll) {
+            // the server already waited up to waitMsec for new messages
+            return messages
+        }
         if (waitMsec > 0) {
             return new Promise((resolve, reject) => {
                 let completed = false
@@ -255,6 +276,71 @@ class SubfeedManager {
         }
         else return []
     }
+    _fetchMessages(a: {feedUri: string, subfeedName: any, position: number, waitMsec: number}): Promise<FetchMessagesResult> {
+        if (!this._batchSupported) {
+            return this._fetchMessagesSingle(a)
+        }
+        // requests made within a short window are sent together to /getMessagesBatch
+        return new Promise((resolve, reject) => {
+            this._pendingFetches.push({...a, resolve, reject})
+            if (this._pendingFetches.length === 1) {
+                setTimeout(() => this._sendPendingFetches(), getMessagesBatchWindowMsec)
+            }
+        })
+    }
+    async _fetchMessagesSingle(a: {feedUri: string, subfeedName: any, position: number, waitMsec: number}): Promise<FetchMessagesResult> {
+        const url = `${this.baseFeedUrl}/getMessages`
+        const { feedUri, subfeedName, position, waitMsec } = a
+        const headers = this._postHeaders()
+        const result = await axios.post(url, {feedUri, subfeedName, position, waitMsec}, {headers})
+        return {messages: result.data as any[], longPoll: result.headers['x-labbox-long-poll'] ? true : false}
+    }
+    _sendPendingFetches() {
+        const pendingFetches = this._pendingFetches
+        this._pendingFetches = []
+        // requests with different waitMsec go in separate batches
+        const batches: {[key: string]: PendingFetch[]} = {}
+        pendingFetches.forEach(f => {
+            const k = f.waitMsec + ''
+            if (!(k in batches)) batches[k] = []
+            batches[k].push(f)
+        })
+        Object.values(batches).forEach(batch => {
+            if (batch.length === 1) {
+                this._fetchMessagesSingle(batch[0]).then(batch[0].resolve).catch(batch[0].reject)
+            }
+            else {
+                this._sendBatch(batch)
+            }
+        })
+    }
+    async _sendBatch(batch: PendingFetch[]) {
+        const url = `${this.baseFeedUrl}/getMessagesBatch`
+        const headers = this._postHeaders()
+        const requests = batch.map(f => ({feedUri: f.feedUri, subfeedName: f.subfeedName, position: f.position}))
+        let result
+        try {
+            result = await axios.post(url, {requests, waitMsec: batch[0].waitMsec}, {headers})
+        }
+        catch(err: any) {
+            if ((err.response) && (err.response.status === 404)) {
+                // the server does not have the batch endpoint
+                this._batchSupported = false
+                batch.forEach(f => {
+                    this._fetchMessagesSingle(f).then(f.resolve).catch(f.reject)
+                })
+            }
+            else {
+                batch.forEach(f => f.reject(err))
+            }
+            return
+        }
+        const messages = result.data.messages as any[][]
+        const longPoll = result.headers['x-labbox-long-poll'] ? true : false
+        batch.forEach((f, i) => {
+            f.resolve({messages: messages[i], longPoll})
+        })
+    }
     async appendMessages(a: {feedUri: string, subfeedName: any, messages: any[]}) {
         const { feedUri, subfeedName, messages } = a
         const url = `${this.baseFeedUrl}/appendMessages`
@@ -4,6 +4,14 @@ import { CalculationPool } from "."
 export interface HitherJobOpts {
     useClientCache?: boolean
     calculationPool?: CalculationPool
+    priority?: number // jobs of a session with a higher priority are started first by the server
+    newestFirst?: boolean // the server starts the most recently created of these jobs first
+}
+
+export interface HitherJobProgress {
+    fraction: number | null // 0 to 1, if reported
+    message: string | null
+    partial?: any // a partial result, only passed to the onProgress callbacks
 }
 
 export interface HitherJob {
@@ -19,8 +27,10 @@ export interface HitherJob {
     timestampStarted: number
     timestampFinished: number | null
     clientCancelled: boolean
+    progress: HitherJobProgress | null // the latest progress reported by the running job
     wait: () => Promise<any>
     cancel: () => void
+    onProgress: (cb: (progress: HitherJobProgress) => void) => void
 }
 
 export const dummyHitherJob: HitherJob = {
@@ -36,8 +46,10 @@ export const dummyHitherJob: HitherJob = {
     timestampStarted: 0,
     timestampFinished: null,
     clientCancelled: false,
+    progress: null,
     wait: async () => {},
-    cancel: () => {}
+    cancel: () => {},
+    onProgress: () => {}
 }
 
 export interface HitherInterface {
@@ -1,8 +1,8 @@
 import createCalculationPool, { CalculationPool } from './createCalculationPool'
 import HitherContext from './HitherContext'
-import { HitherInterface, HitherJob, HitherJobOpts } from './HitherInterface'
+import { HitherInterface, HitherJob, HitherJobOpts, HitherJobProgress } from './HitherInterface'
 import useHitherJob from './useHitherJob'
 
-export type { CalculationPool, HitherInterface, HitherJob, HitherJobOpts }
+export type { CalculationPool, HitherInterface, HitherJob, HitherJobOpts, HitherJobProgress }
 export { HitherContext, useHitherJob, createCalculationPool }
 
@@ -1,9 +1,11 @@
 import { useContext, useState } from "react";
 import HitherContext from "./HitherContext";
-import { dummyHitherJob, HitherJob, HitherJobOpts } from "./HitherInterface";
+import { dummyHitherJob, HitherJob, HitherJobOpts, HitherJobProgress } from "./HitherInterface";
 
-const useHitherJob = <T>(functionName: string, functionArgs: {[key: string]: any}, hitherJobOpts: HitherJobOpts): {result: T | undefined, job: HitherJob} => {
+const useHitherJob = <T>(functionName: string, functionArgs: {[key: string]: any}, hitherJobOpts: HitherJobOpts): {result: T | undefined, job: HitherJob, progress: HitherJobProgress | null} => {
     const hither = useContext(HitherContext)
+    // the latest progress reported by the job (fraction and message), for re-rendering
+    const [progress, setProgress] = useState<{job: HitherJob, progress: HitherJobProgress} | null>(null)
     const [state, setState] = useState<{
         status: 'pending' | 'running' | 'error' | 'finished',
         functionName: string,
@@ -20,7 +22,7 @@ const useHitherJob = <T>(functionName: string, functionArgs: {[key: string]: any
     }
 
     if (!functionName) {
-        return {result: undefined, job: dummyHitherJob}
+        return {result: undefined, job: dummyHitherJob, progress: null}
     }
 
     if (!functionMatch()) {
@@ -32,6 +34,10 @@ const useHitherJob = <T>(functionName: string, functionArgs: {[key: string]: any
             hitherJobOpts,
             job
         })
+        job.onProgress((p: HitherJobProgress) => {
+            if (job.clientCancelled) return
+            setProgress({job, progress: {fraction: p.fraction, message: p.message}})
+        })
         job.wait().then(() => {
             if (job.clientCancelled) return
             setState({
@@ -52,13 +58,14 @@ const useHitherJob = <T>(functionName: string, functionArgs: {[key: string]: any
                 job
             })
         })
-        return {result: undefined, job}
+        return {result: undefined, job, progress: job.progress}
     }
     // functionMatch() is true, i.e. the job is already being tracked. Return the record for it.
     if (!state.job) throw Error('Unexpected: job is not defined')
     let retrievedJob = {
         result: undefined,
-        job: state.job
+        job: state.job,
+        progress: (progress && progress.job === state.job) ? progress.progress : state.job.progress
     }
     switch (state.status) {
         case 'finished':
@@ -1,8 +1,9 @@
 import { useContext } from 'react';
 import { ExtensionContextImpl, LabboxProviderContext } from './LabboxProvider';
 export { createCalculationPool, HitherContext, HitherJob, useHitherJob } from './hither';
-export type { CalculationPool, HitherInterface } from './hither';
+export type { CalculationPool, HitherInterface, HitherJobProgress } from './hither';
 export { default as initializeHitherInterface } from './initializeHitherInterface';
+export type { ChunkedNdarray } from './initializeHitherInterface';
 export { LabboxProvider, LabboxProviderContext } from './LabboxProvider';
 export { default as usePlugins } from './usePlugins';
 export { default as useSubfeed } from './useSubfeed';
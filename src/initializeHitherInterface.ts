@@ -1,11 +1,6 @@
 import axios from 'axios'
 import objectHash from 'object-hash'
-import { CalculationPool, createCalculationPool, HitherJob } from "./hither"
-
-interface HitherJobOpts {
-    useClientCache?: boolean
-    calculationPool?: CalculationPool
-}
+import { createCalculationPool, HitherJob, HitherJobOpts, HitherJobProgress } from "./hither"
 
 const defaultCalculationPool = createCalculationPool({ maxSimultaneous: 20 })
 
@@ -19,6 +14,8 @@ type HitherCreateJobMessage = {
     functionName: string,
     kwargs: { [key: string]: any },
     clientJobId: string
+    priority?: number
+    newestFirst?: boolean
 }
 export type HitherJobMessage = HitherCancelJobMessage | HitherCreateJobMessage
 
@@ -27,7 +24,20 @@ interface HitherJobCreatedMessageFromServer {
     job_id: string
 }
 
+// A result array of a function decorated with @serialize(encoding='chunked').
+// Only its slices are downloaded, from the /array endpoint of the server.
+export interface ChunkedNdarray {
+    _type: 'ndarray_chunked'
+    shape: number[]
+    dtype: string
+    chunks: number[]
+    // one [start, stop) range per axis, where null (or a missing range) stands for the whole axis
+    getSlice: (ranges?: ([number, number] | null)[]) => Promise<number[] | number[][]>
+}
+
 const initializeHitherInterface = (baseSha1Url?: string) => {
+    // the /array endpoint is served alongside /sha1
+    const baseArrayUrl = baseSha1Url ? baseSha1Url.replace(/\/sha1$/, '/array') : undefined
     const globalData: {
         // dispatch: Dispatch<RootAction> | null,
         hitherClientJobCache: { [key: string]: ClientHitherJob },
@@ -56,11 +66,16 @@ const initializeHitherInterface = (baseSha1Url?: string) => {
             timestampStarted: number
             timestampFinished: number | null
             clientCancelled: boolean
+            progress: HitherJobProgress | null
             wait: () => Promise<any>
             cancel: () => void
+            onProgress: (cb: (progress: HitherJobProgress) => void) => void
         }
         _onFinishedCallbacks: ((result: any) => void)[]
         _onErrorCallbacks: ((err: Error) => void)[]
+        _onProgressCallbacks: ((progress: HitherJobProgress) => void)[]
+        // progress messages (whose partial results may have to be fetched) are handled in order, and before the result
+        _progressChain: Promise<void>
         constructor(args: { functionName: string, kwargs: { [key: string]: any }, opts: HitherJobOpts }) {
             this._object = {
                 functionName: args.functionName,
@@ -75,11 +90,15 @@ const initializeHitherInterface = (baseSha1Url?: string) => {
                 timestampStarted: Number(new Date()),
                 timestampFinished: null,
                 clientCancelled: false,
+                progress: null,
                 wait: async () => { return await this.wait() },
-                cancel: () => { this.cancel() }
+                cancel: () => { this.cancel() },
+                onProgress: (cb: (progress: HitherJobProgress) => void) => { this.onProgress(cb) }
             }
             this._onFinishedCallbacks = [];
             this._onErrorCallbacks = [];
+            this._onProgressCallbacks = [];
+            this._progressChain = Promise.resolve();
         }
         object(): HitherJob {
             return this._object
@@ -119,6 +138,14 @@ const initializeHitherInterface = (baseSha1Url?: string) => {
                 cb(new Error(this._object.error_message));
             }
         }
+        onProgress(cb: (progress: HitherJobProgress) => void) {
+            this._onProgressCallbacks.push(cb);
+        }
+        _handleHitherJobProgress(progress: HitherJobProgress) {
+            if (['finished', 'error'].includes(this._object.status)) return
+            this._object.progress = { fraction: progress.fraction, message: progress.message }
+            this._onProgressCallbacks.forEach(cb => cb(progress));
+        }
         _handleHitherJobCreated(a: { jobId: string }) {
             this._object.jobId = a.jobId;
             if (this._object.status === 'pending') {
@@ -138,7 +165,7 @@ const initializeHitherInterface = (baseSha1Url?: string) => {
         }
         _handleHitherJobFinished(a: { result: any, runtime_info: any }) {
             this._object.timestampFinished = Number(new Date())
-            this._object.result = processHitherJobResult(a.result);
+            this._object.result = processHitherJobResult(a.result, baseArrayUrl);
             this._object.runtime_info = a.runtime_info;
             this._object.status = 'finished';
             if ((this._object.jobId) && (this._object.jobId in globalData.runningJobIds)) {
@@ -170,7 +197,9 @@ const initializeHitherInterface = (baseSha1Url?: string) => {
                 type: 'hitherCreateJob',
                 functionName: J._object.functionName,
                 kwargs: J._object.kwargs,
-                clientJobId: J._object.clientJobId
+                clientJobId: J._object.clientJobId,
+                priority: J._object.opts.priority,
+                newestFirst: J._object.opts.newestFirst
             })
         })
 
@@ -186,26 +215,55 @@ const initializeHitherInterface = (baseSha1Url?: string) => {
             console.warn(`No _jobId for job`);
             return;
         }
-        const result_sha1 = msg.result_sha1
-        const url = baseSha1Url ? `${baseSha1Url}/${result_sha1}` : undefined
-        if (url) {
-            axios.get(url).then((result) => {
-                job._handleHitherJobFinished({
-                    result: result.data,
-                    runtime_info: msg.runtime_info
-                })
+        // the partial results reported before are delivered first
+        job._progressChain.then(() => (
+            retrieveResult(msg)
+        )).then((result) => {
+            job._handleHitherJobFinished({
+                result,
+                runtime_info: msg.runtime_info
             })
-            .catch((err: Error) => {
-                job._handleHitherJobError({
-                    errorString: `Problem retrieving result: ${err.message}`,
-                    runtime_info: msg.runtime_info
-                })
+        })
+        .catch((err: Error) => {
+            job._handleHitherJobError({
+                errorString: `Problem retrieving result: ${err.message}`,
+                runtime_info: msg.runtime_info
             })
+        })
+        // dispatchUpdateHitherJob({clientJobId: job.clientJobId(), update: job.object()});
+    }
+    const handleHitherJobProgress = (msg: any) => {
+        const job = globalData.hitherJobs[msg.job_id] || globalData.hitherJobs[msg.client_job_id];
+        if (!job) {
+            console.warn(`job not found (handleHitherJobProgress): ${msg.job_id} ${msg.client_job_id}`);
+            return;
         }
-        else {
-            console.warn('Unable to get result because baseSha1Url is not defined')
+        job._progressChain = job._progressChain.then(async () => {
+            const progress: HitherJobProgress = {
+                fraction: msg.fraction !== undefined ? msg.fraction : null,
+                message: msg.message !== undefined ? msg.message : null
+            }
+            if (msg.partial) {
+                try {
+                    progress.partial = await retrieveResult(msg.partial)
+                }
+                catch (err: any) {
+                    console.warn(`Problem retrieving partial result: ${err.message}`)
+                    return
+                }
+            }
+            job._handleHitherJobProgress(progress)
+        })
+    }
+    const retrieveResult = async (x: { result?: any, result_sha1?: string, result_encoding?: string }): Promise<any> => {
+        if ('result' in x) {
+            // small results are sent inline rather than stored for the client to fetch
+            return x.result
         }
-        // dispatchUpdateHitherJob({clientJobId: job.clientJobId(), update: job.object()});
+        if (!baseSha1Url) throw Error('Unable to get result because baseSha1Url is not defined')
+        const binary = x.result_encoding === 'binary'
+        const result = await axios.get(`${baseSha1Url}/${x.result_sha1}`, binary ? {responseType: 'arraybuffer'} : {})
+        return binary ? decodeBinaryResult(result.data) : result.data
     }
     const handleHitherJobError = (msg: any) => {
         const job = globalData.hitherJobs[msg.job_id] || globalData.hitherJobs[msg.client_job_id];
@@ -252,38 +310,31 @@ const initializeHitherInterface = (baseSha1Url?: string) => {
         handleHitherJobFinished,
         handleHitherJobError,
         handleHitherJobCreated,
+        handleHitherJobProgress,
         getNumActiveJobs,
         getHitherJobs
     }
 }
 
-const processHitherJobResult = (x: any): any => {
-    if (typeof (x) === 'object') {
+const processHitherJobResult = (x: any, baseArrayUrl?: string): any => {
+    if ((x !== null) && (typeof (x) === 'object')) {
         if (Array.isArray(x)) {
-            return x.map(a => processHitherJobResult(a))
+            return x.map(a => processHitherJobResult(a, baseArrayUrl))
         }
-        else if (x._type === 'ndarray') {
+        else if ((x._type === 'ndarray') && (x.data_b64 !== undefined)) {
             const shape = x.shape as number[]
             const dtype = x.dtype as string
             const data_b64 = x.data_b64 as string
             const dataBuffer = _base64ToArrayBuffer(data_b64)
-            if (dtype === 'float32') {
-                return applyShape(new Float32Array(dataBuffer), shape)
-            }
-            else if (dtype === 'int32') {
-                return applyShape(new Int32Array(dataBuffer), shape)
-            }
-            else if (dtype === 'int16') {
-                return applyShape(new Int16Array(dataBuffer), shape)
-            }
-            else {
-                throw Error(`Datatype not yet implemented for ndarray: ${dtype}`)
-            }
+            return applyShape(createTypedArray(dtype, dataBuffer, 0, _numElements(shape)), shape)
+        }
+        else if (x._type === 'ndarray_chunked') {
+            return createChunkedNdarray(x, baseArrayUrl)
         }
         else {
             const ret: { [key: string]: any } = {}
             for (let k in x) {
-                ret[k] = processHitherJobResult(x[k])
+                ret[k] = processHitherJobResult(x[k], baseArrayUrl)
             }
             return ret
         }
@@ -291,7 +342,78 @@ const processHitherJobResult = (x: any): any => {
     else return x
 }
 
-const applyShape = (x: Float32Array | Int32Array | Int16Array, shape: number[]): number[] | number[][] => {
+const createChunkedNdarray = (x: any, baseArrayUrl?: string): ChunkedNdarray => {
+    const shape = x.shape as number[]
+    const getSlice = async (ranges?: ([number, number] | null)[]) => {
+        if (!baseArrayUrl) throw Error('Unable to get array slice because baseSha1Url is not defined')
+        const slice = shape.map((n, i) => {
+            const r = ranges ? ranges[i] : null
+            return r ? `${r[0]}:${r[1]}` : ':'
+        }).join(',')
+        const result = await axios.get(`${baseArrayUrl}/${x.manifest_sha1}`, {params: {slice}, responseType: 'arraybuffer'})
+        return decodeBinaryResult(result.data)
+    }
+    return {
+        _type: 'ndarray_chunked',
+        shape,
+        dtype: x.dtype as string,
+        chunks: x.chunks as number[],
+        getSlice
+    }
+}
+
+type TypedArray = Float32Array | Float64Array | Int8Array | Int16Array | Int32Array | Uint8Array | Uint16Array | Uint32Array
+
+const createTypedArray = (dtype: string, buffer: ArrayBuffer, byteOffset: number, length: number): TypedArray => {
+    // data is little-endian (see labbox.serialize), which is the byte order of all browsers we support
+    switch (dtype) {
+        case 'float32': return new Float32Array(buffer, byteOffset, length)
+        case 'float64': return new Float64Array(buffer, byteOffset, length)
+        case 'int8': return new Int8Array(buffer, byteOffset, length)
+        case 'int16': return new Int16Array(buffer, byteOffset, length)
+        case 'int32': return new Int32Array(buffer, byteOffset, length)
+        case 'uint8': return new Uint8Array(buffer, byteOffset, length)
+        case 'bool': return new Uint8Array(buffer, byteOffset, length)
+        case 'uint16': return new Uint16Array(buffer, byteOffset, length)
+        case 'uint32': return new Uint32Array(buffer, byteOffset, length)
+        default: throw Error(`Datatype not yet implemented for ndarray: ${dtype}`)
+    }
+}
+
+const _numElements = (shape: number[]) => (shape.reduce((a, b) => (a * b), 1))
+
+// Decode a result written by labbox.serialize.write_binary:
+// magic 'LBXB', uint32 header length, JSON header, then 8-byte aligned little-endian buffers
+const decodeBinaryResult = (data: ArrayBuffer): any => {
+    const magic = String.fromCharCode(...Array.from(new Uint8Array(data, 0, 4)))
+    if (magic !== 'LBXB') throw Error('Unexpected binary result')
+    const headerLength = new DataView(data).getUint32(4, true)
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(data, 8, headerLength)))
+    const buffers = header.buffers as {offset: number, nbytes: number}[]
+    const restore = (x: any): any => {
+        if ((x !== null) && (typeof (x) === 'object')) {
+            if (Array.isArray(x)) {
+                return x.map(a => restore(a))
+            }
+            else if ((x._type === 'ndarray') && (x.buffer !== undefined)) {
+                const shape = x.shape as number[]
+                const b = buffers[x.buffer as number]
+                return applyShape(createTypedArray(x.dtype, data, b.offset, _numElements(shape)), shape)
+            }
+            else {
+                const ret: { [key: string]: any } = {}
+                for (let k in x) {
+                    ret[k] = restore(x[k])
+                }
+                return ret
+            }
+        }
+        else return x
+    }
+    return restore(header.root)
+}
+
+const applyShape = (x: TypedArray, shape: number[]): number[] | number[][] => {
     if (shape.length === 1) {
         if (shape[0] !== x.length) throw Error('Unexpected length of array')
         return Array.from(x)